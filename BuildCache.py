@@ -0,0 +1,163 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+from pathlib import Path
+
+from typing import Callable, Dict, List, Optional, Tuple
+
+import logging as log
+
+TABLES_FILENAME = 'tables.json'
+
+
+class BuildCache:
+    """
+    Content-addressed on-disk cache of converted images.
+
+    Each entry is a directory named by its key, holding the artifact files of one
+    converted image and a JSON file with its table values. The modification time of
+    the JSON file records when the entry was last used, for least-recently-used eviction.
+
+    Entries are written to a temporary directory and renamed into place, so worker
+    processes may safely share the cache.
+    """
+    def __init__(self, folder: Path, max_size: int):
+        """
+        :param folder:   Directory holding cache entries
+        :param max_size: Maximum total size of cache entries in bytes
+        """
+        self.folder = folder
+        self.max_size = max_size
+
+    @staticmethod
+    def key(*parts: bytes) -> str:
+        """
+        Compute cache key from a sequence of byte strings
+
+        :param parts: Everything that affects the cached result
+        :return:      Hex digest
+        """
+        h = hashlib.sha256()
+        for part in parts:
+            # Length-prefix each part to keep key unambiguous
+            h.update(len(part).to_bytes(8, 'little'))
+            h.update(part)
+        return h.hexdigest()
+
+    def get(self, key: str, output_files: Dict[str, Path]) -> Optional[dict]:
+        """
+        Restore cached artifact files, if present.
+
+        :param key:          Cache key
+        :param output_files: Artifact name -> path to restore artifact to
+        :return:             Table values, or None on a cache miss
+        """
+        entry = self.folder / key
+        try:
+            with open(entry / TABLES_FILENAME, 'rt') as f:
+                tables = json.load(f)
+            for name, path in output_files.items():
+                shutil.copyfile(entry / name, path)
+            # Mark entry as recently used
+            os.utime(entry / TABLES_FILENAME)
+        except (OSError, ValueError):
+            return None
+        return tables
+
+    def get_data(self, key: str, names: List[str]) -> Optional[Tuple[dict, Dict[str, bytes]]]:
+        """
+        Read cached artifacts into memory, if present.
+
+        :param key:   Cache key
+        :param names: Names of artifacts to read
+        :return:      Table values and artifact name -> contents, or None on a cache miss
+        """
+        entry = self.folder / key
+        try:
+            with open(entry / TABLES_FILENAME, 'rt') as f:
+                tables = json.load(f)
+            data = {name: (entry / name).read_bytes() for name in names}
+            # Mark entry as recently used
+            os.utime(entry / TABLES_FILENAME)
+        except (OSError, ValueError):
+            return None
+        return tables, data
+
+    def put(self, key: str, input_files: Dict[str, Path], tables: dict):
+        """
+        Store artifact files and table values in cache.
+
+        :param key:         Cache key
+        :param input_files: Artifact name -> path to artifact file to store
+        :param tables:      Table values
+        """
+        def copy_files(folder: Path):
+            for name, path in input_files.items():
+                shutil.copyfile(path, folder / name)
+        self._store(key, copy_files, tables)
+
+    def put_data(self, key: str, data: Dict[str, bytes], tables: dict):
+        """
+        Store artifacts held in memory and table values in cache.
+
+        :param key:    Cache key
+        :param data:   Artifact name -> contents
+        :param tables: Table values
+        """
+        def write_files(folder: Path):
+            for name, contents in data.items():
+                (folder / name).write_bytes(contents)
+        self._store(key, write_files, tables)
+
+    def _store(self, key: str, write_artifacts: Callable[[Path], None], tables: dict):
+        entry = self.folder / key
+        if entry.exists():
+            return
+        self.folder.mkdir(parents=True, exist_ok=True)
+        temp_entry = Path(tempfile.mkdtemp(dir=self.folder, prefix='.tmp_'))
+        try:
+            write_artifacts(temp_entry)
+            with open(temp_entry / TABLES_FILENAME, 'wt') as f:
+                json.dump(tables, f)
+            os.replace(temp_entry, entry)
+        except OSError as e:
+            # Lost a race against another process storing the same entry, or out of space
+            log.debug(f'Could not store build cache entry {key}: {e}')
+            shutil.rmtree(temp_entry, ignore_errors=True)
+
+    def _entries(self) -> List[Tuple[float, int, Path]]:
+        """
+        :return: List of (last use time, size, path) for each entry
+        """
+        entries = []
+        if not self.folder.exists():
+            return entries
+        for entry in self.folder.iterdir():
+            if not entry.is_dir() or entry.name.startswith('.'):
+                continue
+            try:
+                last_used = (entry / TABLES_FILENAME).stat().st_mtime
+                size = sum(f.stat().st_size for f in entry.iterdir())
+            except OSError:
+                continue
+            entries.append((last_used, size, entry))
+        return entries
+
+    def evict(self) -> int:
+        """
+        Remove least recently used entries until cache fits within max_size.
+
+        :return: Number of evicted entries
+        """
+        entries = sorted(self._entries(), key=lambda e: e[0])
+        total_size = sum(size for _, size, _ in entries)
+        num_evicted = 0
+        for _, size, entry in entries:
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total_size -= size
+            num_evicted += 1
+        return num_evicted
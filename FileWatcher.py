@@ -0,0 +1,68 @@
+import os
+import time
+from pathlib import Path
+
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+
+def file_signature(path: Path) -> Optional[Tuple[int, int]]:
+    """
+    :param path: Path to file
+    :return:     Modification time in nanoseconds and size of file, or None if it doesn't exist
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+class FileWatcher:
+    """
+    Polls a set of files for changes to their modification time or size.
+
+    Editors often save a file in several steps (truncate, write, rename), so changes are
+    debounced: they are only reported once no file has changed for a while.
+    Polling needs no platform-specific notification API, and is cheap for the handful of
+    files of a build.
+    """
+    def __init__(self, paths: Iterable[Path], interval: float = 0.25, debounce: float = 0.5):
+        """
+        :param paths:    Files to watch. The current state of each file is taken as unchanged
+        :param interval: Time between polls in seconds
+        :param debounce: Time in seconds files must stay unchanged before changes are reported
+        """
+        self.interval = interval
+        self.debounce = debounce
+        self._signatures: Dict[Path, Optional[Tuple[int, int]]] = {path: file_signature(path) for path in paths}
+
+    def poll(self) -> Set[Path]:
+        """
+        Check files once
+
+        :return: Files changed since the previous poll
+        """
+        changed = set()
+        for path, signature in self._signatures.items():
+            new_signature = file_signature(path)
+            if new_signature != signature:
+                self._signatures[path] = new_signature
+                changed.add(path)
+        return changed
+
+    def wait_for_changes(self) -> Set[Path]:
+        """
+        Block until files have changed and then stayed unchanged for the debounce time
+
+        :return: Files changed since the previous call
+        """
+        changed = set()
+        last_change_time = None
+        while True:
+            time.sleep(self.interval)
+            new_changes = self.poll()
+            if new_changes:
+                changed |= new_changes
+                last_change_time = time.monotonic()
+            elif changed and time.monotonic() - last_change_time >= self.debounce:
+                return changed
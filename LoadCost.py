@@ -0,0 +1,378 @@
+from typing import Dict, Sequence, Tuple
+
+# NTSC CPU clock rate divided by NTSC frame rate
+CPU_CYCLES_PER_FRAME = 1789772.5 / 60.0988
+
+# Cycles of CrunchyLib_CopyChrToNextBank copying one 256-byte page, through a CPU RAM page
+_COPY_CHR_PAGE_CYCLES = 6998
+
+
+class _BitReadCounter:
+    """
+    Reads bits from a Tokumaru stream like the decompressor's ReadBit, counting its CPU cycles
+    """
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 1
+        self.bit = 8
+        self.cycles = 0
+
+    def read(self) -> int:
+        if self.bit == 8:
+            if self.pos >= len(self.data):
+                raise ValueError('Tokumaru stream ended prematurely')
+            # Refill bit buffer, incrementing the high byte of the stream pointer when Y wraps
+            self.cycles += 38 if (self.pos & 0xFF) == 0xFF else 34
+            self.pos += 1
+            self.bit = 0
+        else:
+            self.cycles += 20
+        value = (self.data[self.pos - 1] >> (7 - self.bit)) & 1
+        self.bit += 1
+        return value
+
+    def read2(self) -> int:
+        # Read2Bits: jsr, rol, lda, rol, and, rts
+        self.cycles += 24
+        return (self.read() << 1) | self.read()
+
+
+def tokumaru_decompress_cycles(data: bytes) -> int:
+    """
+    CPU cycles taken by asm/decompress.asm to decompress a Tokumaru stream, including its JSR and RTS.
+
+    Follows every branch of the decompressor through the stream. Page-crossing penalties of
+    the indirect stream reads are not counted, adding up to 1 cycle per stream byte read.
+
+    :param data: Compressed data
+    :return:     Number of CPU cycles. 0 for an empty stream
+    """
+    if len(data) == 0:
+        return 0
+    num_tiles = data[0] or 256
+    r = _BitReadCounter(data)
+    cycles = 6 + 17
+    tile = 0
+    while tile < num_tiles:
+        # Block header: Followers of each color 3..0
+        cycles += 2
+        counts = [0] * 4
+        next_colors = [[] for c in range(4)]
+        for c in range(3, -1, -1):
+            counts[c] = r.read2()
+            cycles += 4
+            if counts[c] == 0:
+                cycles += 3
+            else:
+                cycles += 2 + 5
+                e = 1
+                if r.read():
+                    cycles += 2 + 5
+                    e = 2
+                    if r.read():
+                        cycles += 2 + 5
+                        e = 3
+                    else:
+                        cycles += 3
+                else:
+                    cycles += 3
+                cycles += 3
+                if c < e:
+                    cycles += 3
+                    specified = e
+                else:
+                    cycles += 2 + 5
+                    specified = e - 1
+                others = [d for d in range(4) if d not in (c, specified)]
+                cycles += 12
+                if counts[c] == 1:
+                    cycles += 3 + 8
+                    next_colors[c] = [specified]
+                else:
+                    # FindColors loop, then pull the listed colors
+                    cycles += (8 if counts[c] == 2 else 5) + 5 + 74 + 6
+                    if counts[c] == 2:
+                        cycles += 3 + 16
+                        next_colors[c] = others
+                    else:
+                        cycles += 2 + 24
+                        next_colors[c] = [specified] + others
+            cycles += 5 if c > 0 else 4
+        cycles += 8
+        while True:
+            cycles += 2
+            for row in range(8):
+                if r.read():
+                    # Repeat previous row
+                    cycles += 3
+                else:
+                    cycles += 2 + 8
+                    pixel = r.read2()
+                    cycles += 3 + 2
+                    for x in range(8):
+                        if x > 0:
+                            n = counts[pixel]
+                            if n == 0:
+                                cycles += 12
+                            elif r.read():
+                                cycles += 14
+                            elif n == 1:
+                                cycles += 25
+                                pixel = next_colors[pixel][0]
+                            elif not r.read():
+                                cycles += 28
+                                pixel = next_colors[pixel][0]
+                            elif n == 2:
+                                cycles += 38
+                                pixel = next_colors[pixel][1]
+                            elif r.read():
+                                cycles += 37
+                                pixel = next_colors[pixel][2]
+                            else:
+                                cycles += 39
+                                pixel = next_colors[pixel][1]
+                        cycles += 17 if x < 7 else 16
+                    cycles += 3
+                cycles += 19 if row < 7 else 18
+            # Output second plane and count tile
+            cycles += 2 + 103 + 5
+            tile += 1
+            if tile == num_tiles:
+                cycles += 3 + 6
+                break
+            cycles += 2
+            if r.read():
+                cycles += 2 + 3
+                break
+            cycles += 3
+    return cycles + r.cycles
+
+
+def upload_tiles_cycles(data: bytes) -> int:
+    """
+    CPU cycles taken by CrunchyLib_UploadTiles to upload a Tokumaru stream, including its JSR and RTS
+
+    :param data: Compressed data
+    :return:     Number of CPU cycles
+    """
+    return 70 + tokumaru_decompress_cycles(data)
+
+
+def copy_chr_cycles(num_pages: int) -> int:
+    """
+    CPU cycles taken by CrunchyLib_CopyChrToNextBank, excluding the code of its callers
+
+    :param num_pages: Number of 256-byte pages, as passed in X. 0 copies 256 pages
+    :return:          Number of CPU cycles
+    """
+    return 3 + (num_pages & 0xFF or 256) * _COPY_CHR_PAGE_CYCLES - 1 + 6
+
+
+def nametable_block_cycles(data: bytes, pos: int = 0) -> Tuple[int, int]:
+    """
+    CPU cycles taken by CrunchyLib_UploadCompressedNametableBlock, including its JSR and RTS.
+
+    Follows every token of the RLEi block.
+    Page-crossing penalties of the indirect reads are not counted, adding up to 1 cycle per byte read.
+
+    :param data: Compressed data
+    :param pos:  Position of block header in data
+    :return:     Number of CPU cycles, and position following the block
+    """
+    num_bytes = data[pos]
+    rleinc_base = data[pos + 1]
+    rle_value = 0
+    y = 2
+    odd_nibble = False
+    next_nibble = 0
+    cycles = 6 + 28
+
+    def read_nibble() -> int:
+        nonlocal cycles, y, odd_nibble, next_nibble
+        if odd_nibble:
+            cycles += 6 + 19
+            odd_nibble = False
+            return next_nibble
+        cycles += 6 + 44
+        value = data[pos + y]
+        y += 1
+        odd_nibble = True
+        next_nibble = value >> 4
+        return value & 0x0F
+
+    while True:
+        cycles += 3
+        if y == num_bytes:
+            cycles += 2 + 3
+            if not odd_nibble:
+                cycles += 2 + 6
+                break
+            cycles += 3 + 3
+            if next_nibble == 0:
+                cycles += 2 + 6
+                break
+            cycles += 3
+        else:
+            cycles += 3
+        cycles += 5
+        nibble = read_nibble()
+        if nibble == 0:
+            # Literal
+            value = data[pos + y]
+            y += 1
+            if value >= rleinc_base:
+                rleinc_base = (value + 1) & 0xFF
+                cycles += 3 + 6 + 10 + 10 + 6 + 10
+            else:
+                cycles += 3 + 6 + 10 + 3 + 6 + 10
+            continue
+        cycles += 2 + 2
+        if nibble == 1:
+            # New RLE value
+            rle_value = data[pos + y]
+            y += 1
+            cycles += 3 + 13 + 3
+            continue
+        cycles += 2 + 2
+        if nibble >= 9:
+            # RLE
+            length = nibble - 8
+            cycles += 3 + 13
+            if length == 7:
+                cycles += 2 + 6
+                length += read_nibble()
+                cycles += 11
+            else:
+                cycles += 3
+            cycles += 6
+            if rle_value >= rleinc_base:
+                rleinc_base = (rle_value + 1) & 0xFF
+                cycles += 10
+            else:
+                cycles += 3
+            cycles += 3 + 2 + 14 * length - 1 + 5 + 3 + 3
+        else:
+            # RLEINC
+            length = nibble - 1
+            cycles += 2 + 3 + 7
+            if length == 7:
+                cycles += 2 + 6
+                length += read_nibble()
+                cycles += 11
+            else:
+                cycles += 3
+            rleinc_base = (rleinc_base + length) & 0xFF
+            cycles += 2 + 14 * length - 1 + 5 + 5 + 3
+    return cycles, pos + y
+
+
+def stream_nametable_block_cycles(data: bytes, pos: int = 0) -> Tuple[int, int]:
+    """
+    CPU cycles taken by CrunchyLib_StreamNametableBlock to upload one RLEi block, including its JSR and RTS.
+
+    An upper bound, taking the slower path of each pointer increment and a page-crossing penalty for every byte of the block.
+
+    :param data: Compressed data
+    :param pos:  Position of block header in data
+    :return:     Number of CPU cycles, and position following the block
+    """
+    block_cycles, end = nametable_block_cycles(data, pos)
+    return 41 + block_cycles + (end - pos) + 67, end
+
+
+def nametable_upload_cycles(data: bytes) -> int:
+    """
+    CPU cycles taken by CrunchyLib_UploadCompressedNametable, including its JSR and RTS.
+
+    Page-crossing penalties of the indirect reads are not counted, adding up to 1 cycle per byte read.
+
+    :param data: Compressed nametable, as a sequence of blocks ending with a zero byte
+    :return:     Number of CPU cycles
+    """
+    cycles = 30 + 6
+    pos = 0
+    while True:
+        block_cycles, pos = nametable_block_cycles(data, pos)
+        cycles += block_cycles
+        # Advance data pointer past block, and check for the terminating zero byte
+        if data[pos] == 0:
+            cycles += 27
+            return cycles
+        cycles += 28
+
+
+def write_oam_cycles(oam_compressed: bytes, sprite_size_8x16: bool) -> int:
+    """
+    CPU cycles taken by CrunchyLib_WriteOAM, including its JSR and RTS.
+
+    Sprites are assumed to be within the screen, which is the case for the zero scroll coordinates
+    of a picture while it is loaded.
+
+    :param oam_compressed:   Compressed OAM
+    :param sprite_size_8x16: If true, sprites are 8x16
+    :return:                 Number of CPU cycles
+    """
+    cycles = 6 + (42 if sprite_size_8x16 else 41) + 13 + 6 + 32
+    pos = 0
+    while oam_compressed[pos] != 0:
+        num_sprites = oam_compressed[pos] >> 2
+        num_reusing = oam_compressed[pos + 1]
+        cycles += 13 + 39
+        num_new = num_sprites - num_reusing
+        if num_new == 0:
+            cycles += 3
+        else:
+            cycles += 2 + num_new * (90 if sprite_size_8x16 else 85) - 1
+        if num_reusing == 0:
+            cycles += 3 + 2 + 3
+        else:
+            cycles += 3 + 3 + num_reusing * (100 if sprite_size_8x16 else 98) - 1 + 3
+        pos += 2 + 2 * num_new + 3 * num_reusing
+    return cycles + 18
+
+
+def load_picture_cycles(chr_bg_top_compressed: bytes,
+                        chr_bg_sections_compressed: Sequence[bytes],
+                        chr_spr_compressed: bytes,
+                        nametable_compressed: bytes,
+                        oam_compressed: bytes,
+                        num_common_tile_pages: int,
+                        num_sprite_tiles: int,
+                        sprite_size_8x16: bool) -> Dict[str, int]:
+    """
+    Estimate CPU cycles taken by CrunchyLib_LoadPicture, for each step of loading.
+
+    Shared background CHR is assumed to be loaded already.
+    Cycles are counted for the code assembled for the picture's own number of CHR bank sections.
+
+    :param chr_bg_top_compressed:      Compressed background CHR of top section
+    :param chr_bg_sections_compressed: Compressed background CHR of each CHR bank section after the top one
+    :param chr_spr_compressed:         Compressed sprite CHR
+    :param nametable_compressed:       Compressed nametable
+    :param oam_compressed:             Compressed OAM
+    :param num_common_tile_pages:      Number of 256-byte pages of common background tiles
+    :param num_sprite_tiles:           Number of sprite tiles
+    :param sprite_size_8x16:           If true, sprites are 8x16
+    :return:                           Step -> CPU cycles
+    """
+    chr_decompression = sum(upload_tiles_cycles(data) for data in [chr_bg_top_compressed, chr_spr_compressed, *chr_bg_sections_compressed])
+    # Common background CHR and sprite CHR are copied to the CHR bank of each section after the top one.
+    # The sprite CHR copy takes its number of pages from NumSpriteTiles
+    chr_copy = len(chr_bg_sections_compressed) * (copy_chr_cycles(num_common_tile_pages) + copy_chr_cycles(num_sprite_tiles))
+    # LoadPicture, including clearing the OAM page, and UploadCompressedCHR around the uploads and copies
+    other = 2730
+    if not chr_bg_sections_compressed:
+        other += 120
+    else:
+        chr_copy += 2 * 11
+        other += 206
+        num_splits = len(chr_bg_sections_compressed)
+        if num_splits > 1:
+            chr_copy += (num_splits - 1) * 2 * 32
+            other += (num_splits - 1) * (12 + 9 + 70 + 22)
+    return {'chr_decompression': chr_decompression,
+            'chr_copy': chr_copy,
+            'nametable': nametable_upload_cycles(nametable_compressed),
+            'palettes': 551,
+            'oam': write_oam_cycles(oam_compressed, sprite_size_8x16),
+            'other': other}
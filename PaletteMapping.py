@@ -0,0 +1,111 @@
+from functools import lru_cache
+import numpy as np
+
+from typing import Callable, Dict
+
+# PPU color 0x0D is "blacker than black", which confuses the sync detection of some TVs
+BLACKER_THAN_BLACK = 0x0D
+NUM_PPU_COLORS = 64
+
+
+def _squared_rgb_distance(colors: np.ndarray, nes_colors: np.ndarray) -> np.ndarray:
+    """
+    Squared euclidean distance in RGB space
+    """
+    diff = colors[:, None, :].astype(np.int64) - nes_colors[None, :, :].astype(np.int64)
+    return (diff * diff).sum(axis=-1)
+
+
+def _redmean_distance(colors: np.ndarray, nes_colors: np.ndarray) -> np.ndarray:
+    """
+    Squared "redmean" distance, weighting RGB channels by the average red of both colors.
+    A cheap approximation of perceived color difference.
+    """
+    c = colors[:, None, :].astype(np.float64)
+    n = nes_colors[None, :, :].astype(np.float64)
+    r_mean = (c[..., 0] + n[..., 0]) / 2
+    diff2 = (c - n) ** 2
+    return (2 + r_mean / 256) * diff2[..., 0] + 4 * diff2[..., 1] + (2 + (255 - r_mean) / 256) * diff2[..., 2]
+
+
+def srgb_to_lab(colors: np.ndarray) -> np.ndarray:
+    """
+    Convert sRGB colors to CIELAB, with a D65 white point
+
+    :param colors: (..., 3) array of 8-bit sRGB colors
+    :return:       (..., 3) array of L*, a*, b* values
+    """
+    c = colors.astype(np.float64) / 255
+    linear = np.where(c <= 0.04045, c / 12.92, ((c + 0.055) / 1.055) ** 2.4)
+    rgb_to_xyz = np.array([[0.4124564, 0.3575761, 0.1804375],
+                           [0.2126729, 0.7151522, 0.0721750],
+                           [0.0193339, 0.1191920, 0.9503041]])
+    xyz = linear @ rgb_to_xyz.T / np.array([0.95047, 1.0, 1.08883])
+    f = np.where(xyz > (6 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+    return np.stack([116 * f[..., 1] - 16, 500 * (f[..., 0] - f[..., 1]), 200 * (f[..., 1] - f[..., 2])], axis=-1)
+
+
+def _lab_distance(colors: np.ndarray, nes_colors: np.ndarray) -> np.ndarray:
+    """
+    Squared CIE76 distance, i.e. euclidean distance in CIELAB space
+    """
+    diff = srgb_to_lab(colors)[:, None, :] - srgb_to_lab(nes_colors)[None, :, :]
+    return (diff * diff).sum(axis=-1)
+
+
+# Color distance metric name -> function returning (colors, PPU colors) array of distances
+PALETTE_METRICS: Dict[str, Callable[[np.ndarray, np.ndarray], np.ndarray]] = {
+    'rgb': _squared_rgb_distance,
+    'redmean': _redmean_distance,
+    'lab': _lab_distance,
+}
+
+
+class PaletteMapper:
+    """
+    Maps RGB colors to the closest PPU color of a NES palette.
+
+    Colors are mapped in one vectorized step, and remembered in a lookup table
+    so that colors shared by several images are only mapped once.
+    """
+    def __init__(self, nes_palette: bytes, metric: str = 'rgb'):
+        """
+        :param nes_palette: NES color palette as 64 RGB values
+        :param metric:      Name of color distance metric in PALETTE_METRICS
+        """
+        self.nes_colors = np.frombuffer(bytes(nes_palette), dtype=np.uint8)[0:3 * NUM_PPU_COLORS].reshape(NUM_PPU_COLORS, 3)
+        self.metric = metric
+        self.distance = PALETTE_METRICS[metric]
+        # 24-bit RGB value -> PPU color
+        self._lookup: Dict[int, int] = {}
+
+    def map_colors(self, colors: np.ndarray) -> np.ndarray:
+        """
+        Find the closest PPU color of each color, never picking the blacker-than-black color
+
+        Of equally close PPU colors, the lowest one is picked.
+
+        :param colors: (N, 3) array of 8-bit RGB colors
+        :return:       (N,) array of PPU colors
+        """
+        colors = np.asarray(colors, dtype=np.uint8).reshape(-1, 3)
+        rgb = ((colors[:, 0].astype(np.uint32) << 16) | (colors[:, 1].astype(np.uint32) << 8) | colors[:, 2]).tolist()
+        missing = list(dict.fromkeys(value for value in rgb if value not in self._lookup))
+        if missing:
+            missing_colors = np.array([[value >> 16, (value >> 8) & 0xFF, value & 0xFF] for value in missing], dtype=np.uint8)
+            distances = self.distance(missing_colors, self.nes_colors).astype(np.float64)
+            distances[:, BLACKER_THAN_BLACK] = np.inf
+            self._lookup.update(zip(missing, np.argmin(distances, axis=-1).tolist()))
+        return np.array([self._lookup[value] for value in rgb], dtype=np.uint8)
+
+
+@lru_cache(maxsize=16)
+def palette_mapper(nes_palette: bytes, metric: str = 'rgb') -> PaletteMapper:
+    """
+    Get the mapper for a NES palette, shared by all images converted in this process
+
+    :param nes_palette: NES color palette as 64 RGB values
+    :param metric:      Name of color distance metric in PALETTE_METRICS
+    :return:            PaletteMapper
+    """
+    return PaletteMapper(nes_palette, metric)
@@ -0,0 +1,241 @@
+import numpy as np
+
+from RLEiCompression import nametable_decompressed
+from TokumaruCompression import tokumaru_decompressed
+from ScreenConversion import PictureTables
+
+from typing import Dict, List, Sequence
+
+SCREEN_WIDTH = 256
+SCREEN_HEIGHT = 240
+CHR_BANK_SIZE = 0x2000
+BG_PATTERN_TABLE = 0x1000       # CrunchyLib_DoSplits selects the BG pattern table at $1000, and 8x8 sprites at $0000
+NUM_OAM_ENTRIES = 64
+MAX_SPRITES_PER_SCANLINE = 8
+# Pixel of the background tile cloned by ScreenBuilder.make_sprite0_hit_tiles to ensure a sprite#0 hit
+SPRITE0_HIT_PIXEL = (254, 1)
+
+
+def chr_banks(tables: PictureTables,
+              chr_bg_top_compressed: bytes,
+              chr_bg_bottom_compressed: bytes,
+              chr_spr_compressed: bytes,
+              chr_shared_compressed: bytes = b'') -> List[bytearray]:
+    """
+    Get the contents of the CHR bank of each CHR bank section of a picture,
+    as uploaded and copied by CrunchyLib_UploadCompressedCHR to initially blank CHR banks.
+
+    :param tables:                   Table values of picture
+    :param chr_bg_top_compressed:    Compressed background CHR of top section, without any shared tiles
+    :param chr_bg_bottom_compressed: Compressed background CHR of each section after the top one, one stream after the other
+    :param chr_spr_compressed:       Compressed sprite CHR
+    :param chr_shared_compressed:    Compressed shared background CHR, if the picture uses it
+    :return:                         8 KiB of CHR for the top section and each section after it
+    """
+    def upload(bank: bytearray, start_tile: int, background: bool, data: bytes):
+        # CrunchyLib_UploadTiles: C selects the pattern table, Y the starting tile
+        start = (BG_PATTERN_TABLE if background else 0) + 16 * start_tile
+        chr_data = tokumaru_decompressed(data)[:CHR_BANK_SIZE - start]
+        bank[start:start + len(chr_data)] = chr_data
+
+    def copy(src: bytearray, dst: bytearray, first_page: int, num_pages: int):
+        # CrunchyLib_CopyChrToNextBank: 0 pages copies 256, wrapping around the PPU address space.
+        # Pages outside the pattern tables aren't banked, so copying them changes nothing
+        for page in range(first_page, first_page + (num_pages or 256)):
+            start = (page << 8) & 0x3FFF
+            if start < CHR_BANK_SIZE:
+                dst[start:start + 256] = src[start:start + 256]
+
+    top = bytearray(CHR_BANK_SIZE)
+    if tables.num_shared_background_tiles:
+        upload(top, 0, True, chr_shared_compressed)
+    upload(top, tables.num_shared_background_tiles, True, chr_bg_top_compressed)
+    upload(top, tables.sprite_tiles_start_index, False, chr_spr_compressed)
+    banks = [top]
+    if tables.num_background_tiles_bottom:
+        num_common_pages = (tables.num_background_tiles_common + 15) // 16
+        for offset in [0] + tables.split_chr_offsets:
+            bank = bytearray(CHR_BANK_SIZE)
+            copy(banks[-1], bank, BG_PATTERN_TABLE >> 8, num_common_pages)
+            # The number of pages copied is taken from NumSpriteTiles, like CrunchyLib_CopyCHRToSection does
+            copy(banks[-1], bank, tables.sprite_tiles_start_page, tables.num_sprite_tiles)
+            upload(bank, tables.num_background_tiles_common, True, chr_bg_bottom_compressed[offset:])
+            banks.append(bank)
+    return banks
+
+
+def oam_decompressed(oam_compressed: bytes, oam_size: int, sprite_tiles_start_index: int, sprite_size_8x16: bool) -> bytes:
+    """
+    Get the OAM page written by CrunchyLib_LoadPicture, mirroring CrunchyLib_WriteOAM with zero scroll coordinates
+
+    :param oam_compressed:           Compressed OAM
+    :param oam_size:                 Size of OAM of picture in bytes
+    :param sprite_tiles_start_index: First sprite tile of picture
+    :param sprite_size_8x16:         If true, sprites are 8x16
+    :return:                         256 bytes of OAM, starting with the sprite#0 entry, with unused entries hidden
+    """
+    oam = bytearray([0xF0] * (4 * NUM_OAM_ENTRIES))
+    oam[0:4] = [0, 0xFE if sprite_size_8x16 else 0xFF, 0x20, 248]
+    tile_shift = int(sprite_size_8x16)
+    x = -oam_size & 0xFF
+    tile_index = sprite_tiles_start_index
+    pos = 0
+    while oam_compressed[pos] != 0:
+        header = oam_compressed[pos]
+        palette = ((header & 1) << 1) | ((header >> 1) & 1)
+        num_reusing = oam_compressed[pos + 1]
+        num_new = (header >> 2) - num_reusing
+        pos += 2
+        for i in range(num_new):
+            oam[x:x + 4] = [oam_compressed[pos + 1], tile_index & 0xFF, palette, oam_compressed[pos]]
+            tile_index += 1 << tile_shift
+            x = (x + 4) & 0xFF
+            pos += 2
+        for i in range(num_reusing):
+            attributes = oam_compressed[pos + 2]
+            oam[x:x + 4] = [oam_compressed[pos + 1], (((attributes & 0x3F) << tile_shift) + sprite_tiles_start_index) & 0xFF,
+                            (attributes & 0xC0) | palette, oam_compressed[pos]]
+            x = (x + 4) & 0xFF
+            pos += 3
+    return bytes(oam)
+
+
+def tile_pixels(chr_bank: bytes) -> np.ndarray:
+    """
+    :param chr_bank: 8 KiB of CHR
+    :return:         (512, 8, 8) array of the color index of each pixel of each tile
+    """
+    planes = np.unpackbits(np.frombuffer(bytes(chr_bank), dtype=np.uint8).reshape(-1, 2, 8, 1), axis=-1)
+    return planes[:, 0] | (planes[:, 1] << 1)
+
+
+def render_picture(nametable: bytes,
+                   palettes: bytes,
+                   oam: bytes,
+                   banks: Sequence[bytes],
+                   split_rows: Sequence[int],
+                   sprite_size_8x16: bool) -> np.ndarray:
+    """
+    Render a picture the way the PPU displays it with CrunchyLib_Display at zero scroll coordinates.
+
+    Each CHR bank section shows the background and sprite tiles of its own CHR bank.
+    Like the PPU, only the first 8 sprites in OAM order are drawn on each scanline, sprites earlier in OAM
+    are drawn on top, and the backdrop color is the one written last to its mirror at $3F10.
+
+    :param nametable:        Nametable, including attribute table
+    :param palettes:         Background and sprite palettes of 16 PPU colors each
+    :param oam:              256 bytes of OAM
+    :param banks:            CHR of the top section and each section after it, from chr_banks
+    :param split_rows:       Start row of each CHR bank section after the top one
+    :param sprite_size_8x16: If true, sprites are 8x16
+    :return:                 (240, 256) array of PPU colors
+    """
+    pal = np.frombuffer(bytes(palettes), dtype=np.uint8)
+    tiles = np.stack([tile_pixels(bank) for bank in banks])
+    nt = np.frombuffer(bytes(nametable), dtype=np.uint8)
+    rows, cols = SCREEN_HEIGHT // 8, SCREEN_WIDTH // 8
+    indices = nt[0:rows * cols].reshape(rows, cols)
+    attributes = nt[rows * cols:rows * cols + 64].reshape(8, 8)
+    # Background
+    row_sections = np.searchsorted(np.asarray(split_rows, dtype=np.int64), np.arange(rows), side='right')
+    bg = tiles[row_sections[:, None], (BG_PATTERN_TABLE >> 4) + indices.astype(np.int64)]
+    bg = bg.transpose(0, 2, 1, 3).reshape(SCREEN_HEIGHT, SCREEN_WIDTH)
+    r = np.arange(rows)[:, None]
+    c = np.arange(cols)[None, :]
+    groups = (attributes[r // 4, c // 4] >> (((r % 4) // 2) * 4 + ((c % 4) // 2) * 2)) & 3
+    groups = np.repeat(np.repeat(groups, 8, axis=0), 8, axis=1)
+    picture = np.where(bg == 0, pal[16], pal[groups * 4 + bg])
+    # Sprites, drawn from the last OAM entry to the first. Padded to the right for sprites crossing the screen edge
+    height = 16 if sprite_size_8x16 else 8
+    entries = np.frombuffer(bytes(oam), dtype=np.uint8).reshape(NUM_OAM_ENTRIES, 4).astype(np.int64)
+    scanlines = np.arange(SCREEN_HEIGHT)
+    top = entries[:, 0:1] + 1
+    on_scanline = (scanlines >= top) & (scanlines < top + height)
+    drawn = on_scanline & (np.cumsum(on_scanline, axis=0) <= MAX_SPRITES_PER_SCANLINE)
+    scanline_sections = row_sections[scanlines // 8]
+    spr_colors = np.zeros((SCREEN_HEIGHT, SCREEN_WIDTH + 8), dtype=np.uint8)
+    spr_opaque = np.zeros((SCREEN_HEIGHT, SCREEN_WIDTH + 8), dtype=bool)
+    spr_behind = np.zeros((SCREEN_HEIGHT, SCREEN_WIDTH + 8), dtype=bool)
+    for i in range(NUM_OAM_ENTRIES - 1, -1, -1):
+        lines = np.nonzero(drawn[i])[0]
+        if len(lines) == 0:
+            continue
+        y, tile, attribute, x = entries[i]
+        row = lines - (y + 1)
+        if attribute & 0x80:
+            row = height - 1 - row
+        if sprite_size_8x16:
+            tile_indices = ((tile & 1) << 8) + (tile & 0xFE) + row // 8
+        else:
+            tile_indices = np.full(len(lines), tile)
+        pixels = tiles[scanline_sections[lines], tile_indices, row % 8]
+        if attribute & 0x40:
+            pixels = pixels[:, ::-1]
+        opaque = pixels != 0
+        area = (lines[:, None], np.arange(x, x + 8)[None, :])
+        spr_colors[area] = np.where(opaque, pal[16 + (attribute & 3) * 4 + pixels], spr_colors[area])
+        spr_behind[area] = np.where(opaque, bool(attribute & 0x20), spr_behind[area])
+        spr_opaque[area] |= opaque
+    spr_colors, spr_opaque, spr_behind = (a[:, 0:SCREEN_WIDTH] for a in (spr_colors, spr_opaque, spr_behind))
+    return np.where(spr_opaque & (~spr_behind | (bg == 0)), spr_colors, picture)
+
+
+def render_data_files(tables: PictureTables,
+                      data: Dict[str, bytes],
+                      sprite_size_8x16: bool,
+                      chr_shared_compressed: bytes = b'') -> np.ndarray:
+    """
+    Render a picture from the data included in the assembly source, decoding it the way CrunchyLib_LoadPicture does
+
+    :param tables:                Table values of picture
+    :param data:                  Data file name, without image index suffix -> file contents, for the included data files
+    :param sprite_size_8x16:      If true, sprites are 8x16
+    :param chr_shared_compressed: Compressed shared background CHR, if the picture uses it
+    :return:                      (240, 256) array of PPU colors
+    """
+    banks = chr_banks(tables, data['bg_top.tc'], data['bg_bottom_nc.tc'], data['spr.tc'], chr_shared_compressed)
+    oam = oam_decompressed(data['oam_compressed.bin'], tables.oam_size, tables.sprite_tiles_start_index, sprite_size_8x16)
+    return render_picture(nametable_decompressed(data['nametable_compressed.bin']).tobytes(), data['palettes.bin'], oam, banks,
+                          tables.split_rows, sprite_size_8x16)
+
+
+def expected_picture(pixels: np.ndarray, palettes: bytes) -> np.ndarray:
+    """
+    Get the PPU colors an image should be displayed with
+
+    :param pixels:   (height, width) array of palette indices of image
+    :param palettes: Background and sprite palettes of 16 PPU colors each
+    :return:         (height, width) array of PPU colors. Transparent pixels show the background color
+    """
+    pal = np.frombuffer(bytes(palettes), dtype=np.uint8)
+    lookup = np.array([pal[c] if c % 4 != 0 and c < len(pal) else pal[0] for c in range(256)], dtype=np.uint8)
+    return lookup[pixels]
+
+
+def differing_pixels(pixels: np.ndarray, palettes: bytes, picture: np.ndarray, sprite0: bool) -> np.ndarray:
+    """
+    Compare a rendered picture against the image it was converted from
+
+    :param pixels:   (height, width) array of palette indices of image
+    :param palettes: Background and sprite palettes of 16 PPU colors each
+    :param picture:  (240, 256) array of PPU colors from render_picture
+    :param sprite0:  If true, the picture has a pixel added to ensure a sprite#0 hit, which isn't compared
+    :return:         (240, 256) boolean array of pixels differing from the image, or not covered by it
+    """
+    expected = expected_picture(pixels[0:SCREEN_HEIGHT, 0:SCREEN_WIDTH], palettes)
+    differing = np.ones(picture.shape, dtype=bool)
+    differing[0:expected.shape[0], 0:expected.shape[1]] = picture[0:expected.shape[0], 0:expected.shape[1]] != expected
+    if sprite0:
+        x, y = SPRITE0_HIT_PIXEL
+        differing[y, x] = False
+    return differing
+
+
+def ppu_colors_to_rgb(picture: np.ndarray, nes_palette: bytes) -> np.ndarray:
+    """
+    :param picture:     Array of PPU colors
+    :param nes_palette: NES color palette as 64 RGB values
+    :return:            Array of 8-bit RGB colors, with an extra last axis of size 3
+    """
+    nes_colors = np.frombuffer(bytes(nes_palette), dtype=np.uint8)[0:192].reshape(64, 3)
+    return nes_colors[picture & 0x3F]
@@ -0,0 +1,141 @@
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+from typing import List, Dict
+
+_hooks: List['StageHook'] = []
+_no_stage = nullcontext()
+
+
+class StageHook:
+    """
+    Base class for collectors notified at the start and end of each conversion pipeline stage.
+
+    Stages may nest, e.g. for a stage calling other stages. Every stage_started is matched by a
+    stage_finished for the same stage, including when the stage raises an exception.
+    """
+    def stage_started(self, stage: str):
+        pass
+
+    def stage_finished(self, stage: str):
+        pass
+
+
+def add_hook(hook: StageHook):
+    """
+    Start notifying hook of pipeline stages run in this process
+    """
+    _hooks.append(hook)
+
+
+def remove_hook(hook: StageHook):
+    """
+    Stop notifying hook of pipeline stages
+    """
+    _hooks.remove(hook)
+
+
+@contextmanager
+def hook_added(hook: StageHook):
+    """
+    Notify hook of pipeline stages run within context
+    """
+    add_hook(hook)
+    try:
+        yield hook
+    finally:
+        remove_hook(hook)
+
+
+@contextmanager
+def _stage(name: str):
+    hooks = _hooks[:]
+    for hook in hooks:
+        hook.stage_started(name)
+    try:
+        yield
+    finally:
+        for hook in reversed(hooks):
+            hook.stage_finished(name)
+
+
+def stage(name: str):
+    """
+    Context manager marking a pipeline stage.
+    Does nothing unless a hook has been added.
+
+    :param name: Name of stage
+    """
+    if not _hooks:
+        return _no_stage
+    return _stage(name)
+
+
+class ProfileCollector(StageHook):
+    """
+    Records wall time and peak traced memory of each stage, using tracemalloc.
+
+    Peak memory of a stage is relative to the memory allocated when the stage started,
+    and includes the peak of any nested stages.
+    """
+    def __init__(self):
+        # Records of stages in the order they started
+        self.records: List[Dict] = []
+        # Record, start time, traced memory at start, peak traced memory so far
+        self._stack = []
+        self._started_tracemalloc = False
+
+    def __enter__(self) -> 'ProfileCollector':
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        add_hook(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        remove_hook(self)
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def stage_started(self, stage: str):
+        current, peak = tracemalloc.get_traced_memory()
+        # Peak is reset for the new stage - keep track of it for enclosing stages
+        for entry in self._stack:
+            entry[3] = max(entry[3], peak)
+        tracemalloc.reset_peak()
+        record = {'stage': stage, 'depth': len(self._stack), 'wall_time': None, 'peak_memory': None}
+        self.records.append(record)
+        self._stack.append([record, time.perf_counter(), current, current])
+
+    def stage_finished(self, stage: str):
+        end_time = time.perf_counter()
+        current, peak = tracemalloc.get_traced_memory()
+        record, start_time, start_memory, stage_peak = self._stack.pop()
+        assert record['stage'] == stage, f'Stage {stage} finished while in stage {record["stage"]}'
+        stage_peak = max(stage_peak, peak)
+        for entry in self._stack:
+            entry[3] = max(entry[3], stage_peak)
+        record['wall_time'] = end_time - start_time
+        record['peak_memory'] = stage_peak - start_memory
+
+
+def summary_table(records: List[Dict]) -> str:
+    """
+    Format profile records as a table of total wall time and largest peak memory per stage,
+    in order of first use.
+
+    :param records: Records from ProfileCollector, possibly of several images
+    :return:        Table as text
+    """
+    totals: Dict[str, List] = {}
+    for record in records:
+        total = totals.setdefault(record['stage'], [record['depth'], 0, 0.0, 0])
+        total[1] += 1
+        total[2] += record['wall_time']
+        total[3] = max(total[3], record['peak_memory'])
+    lines = [f'{"stage":<36} {"count":>6} {"wall time (ms)":>15} {"peak memory (KiB)":>18}']
+    for stage, (depth, count, wall_time, peak_memory) in totals.items():
+        lines.append(f'{"  " * depth + stage:<36} {count:>6} {1000 * wall_time:>15.1f} {peak_memory / 1024:>18.1f}')
+    return '\n'.join(lines)
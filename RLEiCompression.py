@@ -1,14 +1,178 @@
 from array import array
+from bisect import bisect_right
 
-from typing import Tuple, List, Sequence, Dict, Set, NewType
+from typing import Tuple, List, Sequence, Dict, Set, NewType, Iterator, Optional
 
 MIN_RLE_LENGTH = 1
 MAX_RLE_LENGTH = 22
 MAX_RLE_LENGTH_SHORT = 6
-MAX_COMPRESSED_BLOCK_SIZE = 254
+# Block size including the 2 header bytes must fit in the length byte, where 0 marks the end of the nametable
+MAX_COMPRESSED_BLOCK_SIZE = 253
 
+# Tokens of an encoding, each with a length
+TOKEN_LITERAL = 0
+TOKEN_RLE_VALUE = 1     # New RLEVALUE followed by RLE
+TOKEN_RLEINC = 2
+TOKEN_RLE = 3
 
-def rleinc_compressed(input_data: Sequence[int], rleinc_base: int) -> List[int]:
+
+class NibbleWriter:
+    """
+    Writes RLEi nibbles and data bytes, placing each data byte directly after the byte holding its nibble
+    """
+    def __init__(self, max_input_size: int):
+        """
+        :param max_input_size: Size of data being compressed
+        """
+        # Worst case is a literal byte + nibble per input byte
+        self.out = array('B', bytes(2 * max_input_size + 1))
+        self.out_pos = 0
+        self.nibble_pos = -1     # Position of byte with a free high nibble, or -1
+
+    def put_nibble(self, nibble: int):
+        if self.nibble_pos < 0:
+            self.nibble_pos = self.out_pos
+            self.out[self.out_pos] = nibble
+            self.out_pos += 1
+        else:
+            self.out[self.nibble_pos] |= nibble << 4
+            self.nibble_pos = -1
+
+    def put_byte(self, value: int):
+        self.out[self.out_pos] = value
+        self.out_pos += 1
+
+    def put_length(self, first_nibble_base: int, length: int):
+        assert 1 <= length <= MAX_RLE_LENGTH, 'Max RLE / RLEINC encoding wrong'
+        if length > MAX_RLE_LENGTH_SHORT:
+            self.put_nibble(first_nibble_base + MAX_RLE_LENGTH_SHORT + 1)
+            self.put_nibble(length - (MAX_RLE_LENGTH_SHORT + 1))
+        else:
+            self.put_nibble(first_nibble_base + length)
+
+    def put_token(self, kind: int, length: int, value: int):
+        """
+        :param kind:   Token kind
+        :param length: Number of input bytes encoded by token
+        :param value:  First input byte encoded by token
+        """
+        if kind == TOKEN_LITERAL:
+            self.put_nibble(0)
+            self.put_byte(value)
+        elif kind == TOKEN_RLEINC:
+            self.put_length(1, length)
+        else:
+            if kind == TOKEN_RLE_VALUE:
+                self.put_nibble(1)
+                self.put_byte(value)
+            self.put_length(8, length)
+
+    def data(self) -> array:
+        """
+        :return: Data written so far
+        """
+        return self.out[:self.out_pos]
+
+
+def _run_lengths(d: Sequence[int]) -> Tuple[List[int], List[int]]:
+    """
+    Find length of runs of identical / increasing values starting at each position, capped to MAX_RLE_LENGTH
+
+    :param d: Data to compress
+    :return:  RLE lengths and RLEINC lengths, with one extra entry past the end
+    """
+    n = len(d)
+    rle_lengths = [1] * (n + 1)
+    rleinc_lengths = [1] * (n + 1)
+    for i in range(n - 2, -1, -1):
+        if d[i + 1] == d[i]:
+            rle_lengths[i] = min(rle_lengths[i + 1] + 1, MAX_RLE_LENGTH)
+        elif d[i + 1] == d[i] + 1:
+            rleinc_lengths[i] = min(rleinc_lengths[i + 1] + 1, MAX_RLE_LENGTH)
+    return rle_lengths, rleinc_lengths
+
+
+def _rleinc_bases(d: Sequence[int], rleinc_base: int) -> List[int]:
+    """
+    Every encoding raises RLEINC to one past the largest value output so far.
+    So RLEINC only depends on the position, not on how data before it was encoded.
+
+    :param d:           Data to compress
+    :param rleinc_base: Starting RLEINC value
+    :return:            RLEINC value before decoding each position, with one extra entry past the end
+    """
+    rleinc_bases = [rleinc_base] * (len(d) + 1)
+    for i, value in enumerate(d):
+        rleinc_bases[i + 1] = max(rleinc_bases[i], value + 1)
+    return rleinc_bases
+
+
+def _length_nibbles(length: int) -> int:
+    return 1 if length <= MAX_RLE_LENGTH_SHORT else 2
+
+
+def _token_nibbles(kind: int, length: int) -> int:
+    """
+    :return: Size of token in nibbles, counting each data byte as two nibbles
+    """
+    if kind == TOKEN_LITERAL:
+        return 3
+    elif kind == TOKEN_RLE_VALUE:
+        return 3 + _length_nibbles(length)
+    else:
+        return _length_nibbles(length)
+
+
+def _greedy_tokens(d: Sequence[int],
+                   pos: int,
+                   end: int,
+                   rleinc_base: int,
+                   rle_value: int,
+                   rle_lengths: List[int],
+                   rleinc_lengths: List[int]) -> Iterator[Tuple[int, int, int, int, int]]:
+    """
+    Greedily encode d[pos:end], picking the encoding with the best local compression ratio at each position.
+
+    :param d:              Data to compress
+    :param pos:            Position to start at
+    :param end:            Position to end at
+    :param rleinc_base:    RLEINC value at start
+    :param rle_value:      RLEVALUE at start
+    :param rle_lengths:    RLE lengths of d from _run_lengths
+    :param rleinc_lengths: RLEINC lengths of d from _run_lengths
+    :return:               Per token: Position, RLEVALUE and RLEINC value before it, token kind and length
+    """
+    while pos < end:
+        value = d[pos]
+        # Attempt each encoding and find compression ratio
+        rle_len = min(rle_lengths[pos], end - pos)
+        rle_cr = 0.5 / rle_len if value == rle_value else (0.5 + 0.5 + 1) / rle_len
+        rleinc_len = min(rleinc_lengths[pos], end - pos)
+        rleinc_cr = 0.5 / rleinc_len
+        plain_1_cr = (0.5 + 1) / 1
+        if rleinc_cr <= min([plain_1_cr, rle_cr]) and value == rleinc_base and rleinc_len >= 1:
+            # Encode incrementing RLE
+            yield pos, rle_value, rleinc_base, TOKEN_RLEINC, rleinc_len
+            pos += rleinc_len
+            rleinc_base = max(value + rleinc_len, rleinc_base)
+        elif rle_cr <= plain_1_cr and (value == rle_value or rle_len >= 2):
+            if value != rle_value:
+                # Switch to new rle_value
+                yield pos, rle_value, rleinc_base, TOKEN_RLE_VALUE, rle_len
+                rle_value = value
+            else:
+                # Encode regular RLE
+                yield pos, rle_value, rleinc_base, TOKEN_RLE, rle_len
+            pos += rle_len
+            rleinc_base = max(value + 1, rleinc_base)
+        else:
+            # Single literal byte
+            yield pos, rle_value, rleinc_base, TOKEN_LITERAL, 1
+            pos += 1
+            rleinc_base = max(value + 1, rleinc_base)
+
+
+def rleinc_compressed(input_data: Sequence[int], rleinc_base: int) -> Tuple[array, int]:
     """
     Simple RLE compression variant that is optimised for both repeating and linearly increasing values
     
@@ -26,124 +190,311 @@ def rleinc_compressed(input_data: Sequence[int], rleinc_base: int) -> List[int]:
     9-15  : Repeat RLEVALUE byte B 1-22* times
     
     *Whenever the length is > MAX_RLE_LENGTH_SHORT, the next nibble denotes the additional RLE / RLEINC length, from 0-15.
+    
+    Each byte of nibbles is directly followed by the data bytes of its low and high nibble, in that order.
+    If the number of nibbles is odd, the last byte of nibbles has a zero high nibble.
+    
+    Encoding is greedy, picking the encoding with the best local compression ratio at each position.
+    Runs are found from lengths precomputed in a single backwards pass, making the encoder O(n).
+    
+    :param input_data:  Data to compress
+    :param rleinc_base: Starting RLEINC value
+    :return:            Compressed data, and RLEINC value after decoding it
     """
-    # Regular RLE
-    def rle(v) -> int:
-        first_byte = v[0]
-        i = 0
-        while i < len(v) and i < MAX_RLE_LENGTH and v[i] == first_byte:
-            i += 1
-        return i
-    # RLE-inc
-
-    def rleinc(v) -> int:
-        first_byte = v[0]
-        i = 0
-        while i < len(v) and i < MAX_RLE_LENGTH and v[i] == first_byte + i:
-            i += 1
-        return i
-
-    def encode_bytes(e: List[int]) -> List[int]:
-        eb = []
-        hdr_nibbles = []
-        data_bytes = []
-        last_nibble_extends = False
-        while len(e) > 0:
-            hdr, data = e[0]
-            e = e[1:]
-            last_nibble_extends = False
-            if hdr == 0 or hdr == 1:
-                hdr_nibbles.append(hdr)
-                data_bytes.append(data)
-            elif 2 <= hdr <= 8:
-                # rle-inc
-                hdr_nibbles.append(hdr)
-                if hdr == 8:
-                    hdr_nibbles.append(e[0][0])
-                    data_bytes.append([])
-                    e = e[1:]
-                    last_nibble_extends = True
-                data_bytes.append(data)
-            else:
-                # rle
-                hdr_nibbles.append(hdr)
-                if hdr == 15:
-                    hdr_nibbles.append(e[0][0])
-                    data_bytes.append([])
-                    e = e[1:]
-                    last_nibble_extends = True
-                data_bytes.append(data)
-            can_output = len(hdr_nibbles) == 2 or (len(hdr_nibbles) == 3 and (not last_nibble_extends)) or len(hdr_nibbles) == 4
-            if can_output:
-                # Output two nibbles in byte stream
-                eb.append((hdr_nibbles[1] << 4) | hdr_nibbles[0])
-                hdr_nibbles = hdr_nibbles[2:]
-                eb.extend(data_bytes[0])
-                eb.extend(data_bytes[1])
-                data_bytes = data_bytes[2:]
-            elif len(hdr_nibbles) == 5 and last_nibble_extends:
-                # Output two nibbles in byte stream
-                eb.append((hdr_nibbles[1] << 4) | hdr_nibbles[0])
-                hdr_nibbles = hdr_nibbles[2:]
-                eb.extend(data_bytes[0])
-                eb.extend(data_bytes[1])
-                data_bytes = data_bytes[2:]
-        if len(hdr_nibbles) > 1:
-            eb.append((hdr_nibbles[1] << 4) | hdr_nibbles[0])
-            hdr_nibbles = hdr_nibbles[2:]
-            eb.extend(data_bytes[0])
-            eb.extend(data_bytes[1])
-            data_bytes = data_bytes[2:]
-        if len(hdr_nibbles) > 0:
-            eb.append(hdr_nibbles[0])
-            hdr_nibbles = hdr_nibbles[1:]
-            eb.extend(data_bytes[0])
-            data_bytes = data_bytes[1:]
-        assert len(hdr_nibbles) == 0 and len(data_bytes) == 0
-        return eb
-
-    def skip_bytes(d: List[int], rleinc_base: int, num_bytes: int):
-        rleinc_base_new = max(d[0:num_bytes]) + 1
-        return d[num_bytes:], max([rleinc_base_new, rleinc_base])
+    n = len(input_data)
+    rle_lengths, rleinc_lengths = _run_lengths(input_data)
+    w = NibbleWriter(n)
+    for pos, _, _, kind, length in _greedy_tokens(input_data, 0, n, rleinc_base, 0, rle_lengths, rleinc_lengths):
+        w.put_token(kind, length, input_data[pos])
+    return w.data(), _rleinc_bases(input_data, rleinc_base)[n]
+
+
+def _optimal_states(d: Sequence[int],
+                    start: int,
+                    end: int,
+                    rleinc_bases: List[int],
+                    rle_lengths: List[int],
+                    rleinc_lengths: List[int],
+                    max_nibbles: Optional[int] = None) -> List[Dict[int, Tuple[int, int, int, int, int]]]:
+    """
+    Find the smallest encodings of d[start:p] for every end position p in one forward pass
+
+    The pass is dynamic programming over positions, with the decoder state as part of the search:
+    - RLEINC value is not a choice, see _rleinc_bases.
+    - RLEVALUE is tracked per position. Setting a new RLEVALUE is only ever worth it directly before an RLE
+      of that value, so each state is the RLEVALUE of the last RLE used.
+      A state costing 3 nibbles more than the cheapest one at the same position is never better,
+      as the cheapest one can switch to its RLEVALUE for that cost.
+    - Nibble alignment does not need to be tracked: Data bytes always fill whole bytes, so the compressed size
+      is the number of nibbles rounded up to whole bytes. Minimising the number of nibbles minimises the size.
+
+    :param d:              Data to compress
+    :param start:          Position to start at, with RLEVALUE 0
+    :param end:            Last position to find encodings for
+    :param rleinc_bases:   RLEINC value before each position from start, from _rleinc_bases
+    :param rle_lengths:    RLE lengths of d from _run_lengths
+    :param rleinc_lengths: RLEINC lengths of d from _run_lengths
+    :param max_nibbles:    If not None, stop at the first position where all encodings are larger.
+                           Any states found past that position are larger too
+    :return:               Per position from start to end: RLEVALUE -> (cost in nibbles, previous position,
+                           previous RLEVALUE, token kind, token length)
+    """
+    states = [dict() for i in range(end - start + 1)]
+    states[0][0] = (0, -1, -1, -1, -1)
+
+    def relax(pos: int, rle_value: int, cost: int, prev_pos: int, prev_rle_value: int, kind: int, length: int):
+        state = states[pos - start].get(rle_value)
+        if state is None or cost < state[0]:
+            states[pos - start][rle_value] = (cost, prev_pos, prev_rle_value, kind, length)
+
+    for pos in range(start, end):
+        value = d[pos]
+        best_rle_value, best = min(states[pos - start].items(), key=lambda s: s[1][0])
+        min_cost = best[0]
+        if max_nibbles is not None and min_cost > max_nibbles:
+            # Encodings never get smaller by encoding more data
+            break
+        max_rle_len = min(rle_lengths[pos], end - pos)
+        for rle_value, state in states[pos - start].items():
+            cost = state[0]
+            if cost >= min_cost + 3:
+                continue
+            # Single literal byte
+            relax(pos + 1, rle_value, cost + 3, pos, rle_value, TOKEN_LITERAL, 1)
+            if value == rle_value:
+                for length in range(1, max_rle_len + 1):
+                    relax(pos + length, rle_value, cost + _length_nibbles(length), pos, rle_value, TOKEN_RLE, length)
+            if value == rleinc_bases[pos - start]:
+                for length in range(1, min(rleinc_lengths[pos], end - pos) + 1):
+                    relax(pos + length, rle_value, cost + _length_nibbles(length), pos, rle_value, TOKEN_RLEINC, length)
+        if value != best_rle_value:
+            # Switch to new RLEVALUE from the cheapest state, then encode regular RLE
+            for length in range(1, max_rle_len + 1):
+                relax(pos + length, value, min_cost + 3 + _length_nibbles(length), pos, best_rle_value, TOKEN_RLE_VALUE, length)
+    return states
+
+
+def rleinc_compressed_optimal(input_data: Sequence[int], rleinc_base: int) -> Tuple[array, int]:
+    """
+    Same compression format as rleinc_compressed, but finding the smallest possible encoding.
+    See _optimal_states for how.
+
+    :param input_data:  Data to compress
+    :param rleinc_base: Starting RLEINC value
+    :return:            Compressed data, and RLEINC value after decoding it
+    """
+    n = len(input_data)
+    rle_lengths, rleinc_lengths = _run_lengths(input_data)
+    rleinc_bases = _rleinc_bases(input_data, rleinc_base)
+    states = _optimal_states(input_data, 0, n, rleinc_bases, rle_lengths, rleinc_lengths)
+    # Trace back cheapest path
+    tokens = []
+    pos = n
+    rle_value = min(states[n], key=lambda v: states[n][v][0])
+    while pos > 0:
+        cost, prev_pos, prev_rle_value, kind, length = states[pos][rle_value]
+        tokens.append((prev_pos, kind, length))
+        pos, rle_value = prev_pos, prev_rle_value
     # Encode
-    d = input_data[:]
-    e = []
+    w = NibbleWriter(n)
+    for pos, kind, length in reversed(tokens):
+        w.put_token(kind, length, input_data[pos])
+    return w.data(), rleinc_bases[n]
+
+
+# Selectable RLEi encoders, by name
+RLEI_COMPRESSORS = {
+    'greedy': rleinc_compressed,
+    'optimal': rleinc_compressed_optimal,
+}
+
+
+def rleinc_block_decompressed(data: Sequence[int], pos: int = 0) -> Tuple[array, int]:
+    """
+    Decompress a single RLEi block, including its header, mirroring CrunchyLib_UploadCompressedNametableBlock
+
+    :param data: Compressed data
+    :param pos:  Position of block header in data
+    :return:     Decompressed data, and position following the block
+    """
+    num_bytes = data[pos]
+    rleinc_base = data[pos + 1]
     rle_value = 0
-    while len(d) > 0:
-        # Attempt each encoding and find compression ratio
-        rle_len = rle(d)
-        rle_cr = 0.5 / rle_len if d[0] == rle_value else (0.5 + 0.5 + 1) / rle_len
-        rleinc_len = rleinc(d)
-        rleinc_cr = 0.5 / rleinc_len
-        plain_1_cr = (0.5 + 1) / 1
-        if rleinc_cr <= min([plain_1_cr, rle_cr]) and d[0] == rleinc_base and rleinc_len >= 1:
-            # Encode incrementing RLE
-            assert 1 <= rleinc_len <= MAX_RLE_LENGTH, 'Max RLEINC encoding wrong'
-            if rleinc_len > MAX_RLE_LENGTH_SHORT:
-                rleinc_len_first_nibble = MAX_RLE_LENGTH_SHORT + 1
-            else:
-                rleinc_len_first_nibble = rleinc_len
-            e.append((rleinc_len_first_nibble + 1, []))
-            d, rleinc_base = skip_bytes(d, rleinc_base, rleinc_len)
-            if rleinc_len > MAX_RLE_LENGTH_SHORT:
-                e.append((rleinc_len - (MAX_RLE_LENGTH_SHORT + 1), []))
-        elif rle_cr <= min([plain_1_cr]) and (d[0] == rle_value or rle_len >= 2):
-            if d[0] != rle_value:
-                # Switch to new rle_value
-                e.append((1, array('B', d[0:1])))
-                rle_value = d[0]
-            # Encode regular RLE
-            assert 1 <= rle_len <= MAX_RLE_LENGTH, 'Max RLE encoding wrong'
-            if rle_len > MAX_RLE_LENGTH_SHORT:
-                rle_len_first_nibble = MAX_RLE_LENGTH_SHORT + 1
-            else:
-                rle_len_first_nibble = rle_len
-            e.append((9 + rle_len_first_nibble - 1, []))
-            d, rleinc_base = skip_bytes(d, rleinc_base, rle_len)
-            if rle_len > MAX_RLE_LENGTH_SHORT:
-                e.append((rle_len - (MAX_RLE_LENGTH_SHORT + 1), []))
+    y = 2
+    next_nibble = None      # High nibble of last byte of nibbles, until read
+    out = array('B')
+
+    def read_byte() -> int:
+        nonlocal y
+        if y >= num_bytes:
+            raise ValueError(f'RLEi block at {pos} reads past its length of {num_bytes} bytes')
+        value = data[pos + y]
+        y += 1
+        return value
+
+    def read_nibble() -> int:
+        nonlocal next_nibble
+        if next_nibble is not None:
+            nibble, next_nibble = next_nibble, None
+            return nibble
+        value = read_byte()
+        next_nibble = value >> 4
+        return value & 0x0F
+
+    # With no bytes left, only a pending non-zero nibble is decoded. A zero one pads the block
+    while y != num_bytes or next_nibble:
+        nibble = read_nibble()
+        if nibble == 0:
+            value = read_byte()
+            out.append(value)
+            if value >= rleinc_base:
+                rleinc_base = (value + 1) & 0xFF
+        elif nibble == 1:
+            rle_value = read_byte()
+        elif nibble > MAX_RLE_LENGTH_SHORT + 2:
+            length = nibble - 8
+            if length == MAX_RLE_LENGTH_SHORT + 1:
+                length += read_nibble()
+            out.extend([rle_value] * length)
+            if rle_value >= rleinc_base:
+                rleinc_base = (rle_value + 1) & 0xFF
         else:
-            # Single literal byte
-            e.append((0, d[0:1]))
-            d, rleinc_base = skip_bytes(d, rleinc_base, 1)
-    return encode_bytes(e), rleinc_base
+            length = nibble - 1
+            if length == MAX_RLE_LENGTH_SHORT + 1:
+                length += read_nibble()
+            out.extend((rleinc_base + i) & 0xFF for i in range(length))
+            rleinc_base = (rleinc_base + length) & 0xFF
+    return out, pos + y
+
+
+def nametable_decompressed(data: Sequence[int]) -> array:
+    """
+    Decompress a nametable compressed as RLEi blocks, mirroring CrunchyLib_UploadCompressedNametable
+
+    :param data: Compressed nametable, as a sequence of blocks ending with a zero byte
+    :return:     Decompressed nametable
+    """
+    out = array('B')
+    pos = 0
+    while data[pos] != 0:
+        block, pos = rleinc_block_decompressed(data, pos)
+        out += block
+    return out
+
+
+def nametable_block_sizes(data: Sequence[int]) -> List[int]:
+    """
+    Decompressed size of each RLEi block of a compressed nametable
+
+    :param data: Compressed nametable, as a sequence of blocks ending with a zero byte
+    :return:     Decompressed size of each block
+    """
+    sizes = []
+    pos = 0
+    while data[pos] != 0:
+        block, pos = rleinc_block_decompressed(data, pos)
+        sizes.append(len(block))
+    return sizes
+
+
+class CompressedSizeIndex:
+    """
+    Compressed size of every range of rows of data, when compressing the range as a single block.
+
+    Each block either starts with the RLEINC value reached by compressing all rows before it,
+    so the RLEINC values continue across blocks as if the data was compressed in one go,
+    or starts over with the same RLEINC value.
+
+    All ranges starting at the same row are found from a single encoding pass:
+    - The optimal encoder finds the smallest encoding up to every position in one pass anyway.
+    - The greedy encoder only looks MAX_RLE_LENGTH bytes ahead. So compressing rows [a, b) encodes
+      exactly like compressing rows [a, num_rows), until the first token starting within MAX_RLE_LENGTH
+      bytes of the end of row b. Only the remaining few bytes are encoded again.
+    """
+    def __init__(self,
+                 data: Sequence[int],
+                 row_size: int,
+                 rleinc_base: int,
+                 compression: str = 'greedy',
+                 chain_rleinc: bool = True,
+                 max_size: int = MAX_COMPRESSED_BLOCK_SIZE):
+        """
+        :param data:         Data to compress, as whole rows
+        :param row_size:     Size of each row
+        :param rleinc_base:  RLEINC value at start of data
+        :param compression:  Name of RLEi encoder in RLEI_COMPRESSORS
+        :param chain_rleinc: If true, continue RLEINC value across blocks. Otherwise start each block with rleinc_base
+        :param max_size:     Largest compressed size of interest. Encoding passes stop early past it
+        """
+        assert len(data) % row_size == 0, 'Data must be whole rows'
+        self.data = data
+        self.row_size = row_size
+        self.num_rows = len(data) // row_size
+        self.compression = compression
+        self.rle_lengths, self.rleinc_lengths = _run_lengths(data)
+        self.start_rleinc_base = rleinc_base
+        self.chain_rleinc = chain_rleinc
+        self.max_size = max_size
+        self.chained_rleinc_bases = _rleinc_bases(data, rleinc_base)
+        # sizes[a][b - a - 1] = compressed size of rows [a, b), or None if larger than max_size
+        if compression == 'greedy':
+            self.sizes = [self._greedy_sizes(a) for a in range(self.num_rows)]
+        elif compression == 'optimal':
+            self.sizes = [self._optimal_sizes(a) for a in range(self.num_rows)]
+        else:
+            raise ValueError(f'Unknown RLEi compression {compression}')
+
+    def _greedy_sizes(self, a: int) -> List[Optional[int]]:
+        d = self.data
+        n = len(d)
+        start = a * self.row_size
+        max_nibbles = 2 * self.max_size
+        tokens = []
+        nibbles_before = [0]
+        for token in _greedy_tokens(d, start, n, self.rleinc_base(a), 0, self.rle_lengths, self.rleinc_lengths):
+            if nibbles_before[-1] > max_nibbles:
+                break
+            tokens.append(token)
+            nibbles_before.append(nibbles_before[-1] + _token_nibbles(token[3], token[4]))
+        positions = [token[0] for token in tokens]
+        sizes = []
+        for b in range(a + 1, self.num_rows + 1):
+            end = b * self.row_size
+            # First token that might encode differently when data ends at row b
+            i = bisect_right(positions, end - MAX_RLE_LENGTH)
+            nibbles = nibbles_before[i]
+            if i < len(tokens):
+                pos, rle_value, rleinc_base, _, _ = tokens[i]
+                nibbles += sum(_token_nibbles(kind, length) for _, _, _, kind, length in
+                               _greedy_tokens(d, pos, end, rleinc_base, rle_value, self.rle_lengths, self.rleinc_lengths))
+            sizes.append((nibbles + 1) // 2 if nibbles <= max_nibbles else None)
+        return sizes
+
+    def _optimal_sizes(self, a: int) -> List[Optional[int]]:
+        start = a * self.row_size
+        max_nibbles = 2 * self.max_size
+        rleinc_bases = _rleinc_bases(self.data[start:], self.rleinc_base(a))
+        states = _optimal_states(self.data, start, len(self.data), rleinc_bases, self.rle_lengths, self.rleinc_lengths, max_nibbles)
+        sizes = []
+        for b in range(a + 1, self.num_rows + 1):
+            nibbles = min((state[0] for state in states[b * self.row_size - start].values()), default=max_nibbles + 1)
+            sizes.append((nibbles + 1) // 2 if nibbles <= max_nibbles else None)
+        return sizes
+
+    def size(self, a: int, b: int) -> Optional[int]:
+        """
+        :return: Compressed size of rows [a, b), excluding block header. None if larger than max_size
+        """
+        return self.sizes[a][b - a - 1]
+
+    def rleinc_base(self, row: int) -> int:
+        """
+        :return: RLEINC value of block starting at row
+        """
+        return self.chained_rleinc_bases[row * self.row_size] if self.chain_rleinc else self.start_rleinc_base
+
+    def rows(self, a: int, b: int) -> Sequence[int]:
+        """
+        :return: Data of rows [a, b)
+        """
+        return self.data[a * self.row_size:b * self.row_size]
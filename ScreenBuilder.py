@@ -5,32 +5,55 @@ from distutils.util import strtobool
 import argparse
 import time
 import itertools
+import functools
+import operator
 from math import ceil
 from operator import itemgetter
 from PIL import Image
 from pathlib import Path
-from dataclasses import dataclass, field, asdict
+from dataclasses import dataclass, asdict
 from collections import UserList, defaultdict
 from array import array
+import numpy as np
 
-from RLEiCompression import rleinc_compressed, MAX_COMPRESSED_BLOCK_SIZE
+from RLEiCompression import RLEI_COMPRESSORS, CompressedSizeIndex, MAX_COMPRESSED_BLOCK_SIZE
+from LoadCost import stream_nametable_block_cycles
+from Profiling import stage
+from TokumaruCompression import tokumaru_compressed
 
-from typing import Tuple, List, Dict, Set, Optional, NewType
+from typing import Tuple, List, Dict, Set, Optional, NewType, Sequence
 
 ByteArray = NewType('ByteArray', array)
 
 import logging as log
 
+# Byte value with bits in reverse order, for flipping tile data horizontally
+_REVERSED_BITS = bytes(int(f'{b:08b}'[::-1], 2) for b in range(256))
 
-@dataclass
-class Cell:
-    d: Tuple[int] = field(default_factory=tuple)    # Tile data
-    i: int = 0                                      # Tile index
-    p: int = 0                                      # Palette index
+
+def flip_tile_data(tile_data: bytes, height: int, h_flip: bool, v_flip: bool) -> bytes:
+    """
+    Flip tile data the way the PPU flips a sprite
+    
+    :param tile_data: Tile data of a 8x8 or 8x16 sprite in NES CHR layout, as two consecutive 8x8 tiles for 8x16
+    :param height:    Height of tile
+    :param h_flip:    If true, flip horizontally
+    :param v_flip:    If true, flip vertically. 8x16 sprites are flipped as a whole
+    :return:          Flipped tile data
+    """
+    if h_flip:
+        tile_data = tile_data.translate(_REVERSED_BITS)
+    if v_flip:
+        # (8x8 parts, planes, rows) -> reverse order of parts and rows
+        parts = np.frombuffer(tile_data, dtype=np.uint8).reshape(height // 8, TileTable.NUM_TILE_PLANES, 8)
+        tile_data = parts[::-1, :, ::-1].tobytes()
+    return tile_data
 
 
 @dataclass
 class Sprite:
+    # Slots keep the many sprites of a batch run small, and include the tile data set after creation
+    __slots__ = ('x', 'y', 'i', 'H', 'V', 'p', 'tiledata')
     x: int          # X position
     y: int          # Y position
     i: int          # tile index
@@ -40,6 +63,9 @@ class Sprite:
 
 
 class TileTable(UserList):
+    """
+    List of unique tiles, each stored as immutable bytes of bitplane-packed tile data
+    """
     NUM_TILE_PLANES = 2
 
     def __init__(self, max_tiles: int, width: int, height: int):
@@ -47,33 +73,92 @@ class TileTable(UserList):
         self.max_tiles = max_tiles
         self.width = width
         self.height = height
+        # Hash index mapping tile data -> first tile index holding it
+        self._index: Dict[bytes, int] = {}
+        self._num_indexed = 0
+
+    def _update_index(self):
+        """
+        Bring hash index up-to-date with tiles appended directly to the list.
+        
+        Tiles may be appended via append() or self.data.append() without
+        going through add(), so these are indexed lazily on next lookup.
+        Only the first occurrence of duplicate tiles is indexed, matching list.index().
+        """
+        if self._num_indexed > len(self.data):
+            # List shrunk behind our back - rebuild index from scratch
+            self._index.clear()
+            self._num_indexed = 0
+        for i in range(self._num_indexed, len(self.data)):
+            self._index.setdefault(self.data[i], i)
+        self._num_indexed = len(self.data)
 
-    def add(self, tile_data: Tuple[int]) -> int:
+    def add(self, tile_data: bytes) -> int:
         """
         Add tile data if not already in tile table, and return tile index.
         """
         assert(len(tile_data) == 2 * self.height)
-        try:
-            tile_index = self.data.index(tile_data)
-        except ValueError:
+        self._update_index()
+        tile_index = self._index.get(tile_data)
+        if tile_index is None:
             # Add missing tile_data
             tile_index = len(self.data)
             self.data.append(tile_data)
+            self._index[tile_data] = tile_index
+            self._num_indexed = len(self.data)
         return tile_index
 
-    def tile_data(self, tile_index: int) -> Tuple[int]:
+    def add_flipped(self, tile_data: bytes) -> Tuple[int, bool, bool]:
+        """
+        Add tile data unless it is a flipped version of a tile already in tile table
+        
+        :param tile_data: Tile data to add
+        :return:          Tile index, and horizontal / vertical flip turning that tile into tile_data
+        """
+        self._update_index()
+        for h_flip, v_flip in ((False, False), (True, False), (False, True), (True, True)):
+            tile_index = self._index.get(flip_tile_data(tile_data, self.height, h_flip, v_flip))
+            if tile_index is not None:
+                return tile_index, h_flip, v_flip
+        return self.add(tile_data), False, False
+
+    def clear(self):
+        super().clear()
+        self._index.clear()
+        self._num_indexed = 0
+
+    def tile_data(self, tile_index: int) -> bytes:
         """
         Return tile data for tile index
         
         :param tile_index: Tile index to return data for
         :return:           Tile data bytes
         """
-        tile_size = self.height * self.NUM_TILE_PLANES
-        return self.data[tile_index]  # * tile_size:(tile_index + 1) * tile_size]
+        return self.data[tile_index]
 
 
 TileTableType = NewType('TileTableType', TileTable)
 
+# Objectives for choosing where to switch CHR banks mid-frame:
+# cpu_time:       Switch as high up as possible, returning the most frame time after the last switch
+# common_tiles:   Fewest tiles duplicated in the CHR banks of several sections
+# compressed_chr: Smallest total compressed background CHR
+CHR_SPLIT_OBJECTIVES = ['cpu_time', 'common_tiles', 'compressed_chr']
+
+# Methods for placing sprites:
+# grid: Sprites on the 8x8 / 8x16 grid, shifting horizontally adjacent sprites to save one where possible
+# free: Sprites at any position, keeping within the sprites-per-scanline limit where possible.
+#       The grid placement is kept if it fits the hardware limits better or uses fewer sprites
+SPRITE_PACKINGS = ['grid', 'free']
+
+
+def popcount(mask: int) -> int:
+    """
+    :param mask: Bitset
+    :return:     Number of bits set
+    """
+    return bin(mask).count('1')
+
 
 class ScreenBuilder:
     NAMETABLE_WIDTH = 32
@@ -89,7 +174,11 @@ class ScreenBuilder:
     NUM_PALETTE_GROUPS_SPR = 4
     NUM_TILE_PLANES = 2
     MAX_SPRITES = 64
+    MAX_SPRITES_PER_SCANLINE = 8
     MAX_TILES_BG = 256
+    MAX_CHR_BANKS = 4               # CHR RAM banks of UNROM-512 / mapper 30
+    MAX_STREAMED_BLOCK_SIZE = 255   # Decoded size of a streamed nametable block, stored in a byte
+    MAX_NEAR_TILE_BUCKET_SIZE = 32  # Larger buckets of tiles sharing a part are split by the other parts
 
     """
     Builds a NES screen from an image
@@ -101,16 +190,26 @@ class ScreenBuilder:
     * Sprite OAM
     """
 
-    def __init__(self, image, sprites_8x16: bool, add_sprite0: bool, max_bg_slots: int):
+    def __init__(self, image, sprites_8x16: bool, add_sprite0: bool, max_bg_slots: int, nametable_compression: str = 'greedy',
+                 chr_split_objective: str = 'cpu_time', sprite_packing: str = 'grid', merge_tiles_max_error: int = 0,
+                 nametable_block_cycles: int = 0):
         self.handle_sprite0_hit = True
+        self.nametable_compression = nametable_compression
+        self.nametable_block_cycles = nametable_block_cycles  # If non-zero, CPU cycle budget of streaming each nametable block
+        self.chr_split_objective = chr_split_objective
+        self.sprite_packing = sprite_packing
         self.bottom_start_row = None  # Initialise with None for no-screen-split
+        self.split_rows = []          # Start row of each CHR bank section after the first
+        self.num_shared_tiles = 0     # Background tiles at start of top tile table shared with other pictures
         self.sprites_8x16 = sprites_8x16
         self.image = image
+        # Indexed pixels as a (height, width) uint8 array, read once
+        self.pixels = np.asarray(image, dtype=np.uint8)
         self.screen_width, self.screen_height = image.size
         self.grid_width = self.screen_width // self.TILE_WIDTH
         self.grid_height = self.screen_height // self.TILE_HEIGHT
         #
-        self.tile_table_bg = TileTable(max_tiles=2 * max_bg_slots - self.reserved_tiles_bg,
+        self.tile_table_bg = TileTable(max_tiles=self.MAX_CHR_BANKS * max_bg_slots - self.reserved_tiles_bg,
                                        width=self.TILE_WIDTH,
                                        height=self.TILE_HEIGHT)
         sprite_height_multiplier = 2 if self.sprites_8x16 else 1
@@ -118,21 +217,35 @@ class ScreenBuilder:
                                         width=self.TILE_WIDTH,
                                         height=self.TILE_HEIGHT * sprite_height_multiplier)
         # Make background layer
-        self.make_background()
-        # If > max_bg_slots, split/remap background layer into two dedicated tile tables
+        with stage('make_background'):
+            self.make_background()
+        # If > max_bg_slots, optionally merge similar tiles to avoid splitting the background layer
+        if merge_tiles_max_error and len(self.tile_table_bg) > max_bg_slots - self.reserved_tiles_bg:
+            with stage('merge_similar_tiles'):
+                self.merge_similar_tiles(max_bg_slots - self.reserved_tiles_bg, merge_tiles_max_error)
+        # If > max_bg_slots, split/remap background layer into dedicated tile tables of consecutive CHR banks
         if len(self.tile_table_bg) > max_bg_slots - self.reserved_tiles_bg:
-            # Split into two tile tables and remap background
-            self.split_background_tile_table(max_bg_slots)
+            # Split into several tile tables and remap background
+            with stage('split_background_tile_table'):
+                self.split_background_tile_table(max_bg_slots)
         else:
-            # Tiles fit into one table - make the other one a dummy
+            # Tiles fit into one table - make the bottom one a dummy
             self.tile_table_bg_top = self.tile_table_bg
             self.tile_table_bg_bottom = TileTable(max_bg_slots, self.TILE_WIDTH, self.TILE_HEIGHT)
+            self.tile_tables_bg = [self.tile_table_bg_top]
             self.num_common_tile_indices = 0
         # Make sprite layer
-        self.make_sprites()
-        # Add sprite#0 hit tiles
-        if add_sprite0:
-            self.make_sprite0_hit_tiles()
+        with stage('make_sprites'):
+            self.make_sprites()
+            # Add sprite#0 hit tiles
+            if add_sprite0:
+                self.make_sprite0_hit_tiles()
+        if len(self.tile_table_spr) == 0:
+            # Tokumaru decompressor treats a tile count of 0 as 256 tiles - upload a single blank tile instead
+            spr_tile_size = self.tile_table_spr.NUM_TILE_PLANES * self.tile_table_spr.height
+            self.tile_table_spr.append(bytes(spr_tile_size))
+        # Pixels are only needed while building layers - don't keep them around in batch runs
+        del self.pixels
 
     @property
     def reserved_tiles_bg(self) -> int:
@@ -163,7 +276,8 @@ class ScreenBuilder:
         
         :return: Starting tile index to upload sprite CHR to
         """
-        num_sprite_tiles = len(self.sprites) + 1
+        # Tiles of sprites, followed by the sprite#0 tile
+        num_sprite_tiles = len({s.i for s in self.sprites}) + 1
         start_index = 256 - (num_sprite_tiles << int(self.sprites_8x16))
         return start_index
 
@@ -182,191 +296,430 @@ class ScreenBuilder:
         # screen coordinates (x, y) = (248, 1)
         # This makes the sprite#0 minimally intrusive but functional when blanking leftmost column
         #
-        tile_index = self.background[31][0].i
-        tile_data = list(self.tile_table_bg_top.tile_data(tile_index))
+        tile_index = int(self.background_indices[0, 31])
+        tile_data = bytearray(self.tile_table_bg_top.tile_data(tile_index))
         # Set opaque pixel at (6, 1)
         tile_data[1] |= 0x02
-        tile_index_new = self.tile_table_bg_top.add(tile_data)
-        self.background[31][0].i = tile_index_new
+        # Always clone into a new tile slot
+        tile_index_new = len(self.tile_table_bg_top)
+        self.tile_table_bg_top.append(bytes(tile_data))
+        self.background_indices[0, 31] = tile_index_new
         # Sprite tile with single pixel at (6, 0)
         spr_tile_size = self.tile_table_spr.NUM_TILE_PLANES * self.tile_table_spr.height
-        spr_tile_data = [0] * spr_tile_size
+        spr_tile_data = bytearray(spr_tile_size)
         spr_tile_data[0] = 0x02
-        self.tile_table_spr.add(tuple(spr_tile_data))
-
-    def read_background_cell(self, image, x: int, y: int, w: int, h: int) -> Cell:
-        """
-        Read background cell from image
-        
-        :param image: image
-        :param x:     x position of cell
-        :param y:     y position of cell
-        :param w:     width of cell
-        :param h:     height of cell
-        :return:      Cell object
-        """
-        return self.read_cell(image, x, y, w, h, False)
-
-    def read_sprite_cell(self, image, x: int, y: int, w: int, h: int, palette_filter: int) -> Cell:
-        """
-        Read sprite cell from image
-        
-        :param image:          image
-        :param x:              x position of cell
-        :param y:              y position of cell
-        :param w:              width of cell
-        :param h:              height of cell
-        :param palette_filter: Index of palette group to use for reading
-        :return:               Cell object
-        """
-        return self.read_cell(image, x, y, w, h, True, palette_filter)
-
-    def read_cell(self, image, start_x: int, start_y: int, w: int, h: int, sprite_cell: bool, palette_filter: Optional[int] = None) -> Cell:
-        """
-        Read sprite cell from image
-        
-        :param image:          image
-        :param start_x:        x position of cell
-        :param start_y:        y position of cell
-        :param w:              width of cell
-        :param h:              height of cell
-        :param sprite_cell:    If true, read sprite cell. Otherwise read background cell
-        :param palette_filter: Index of palette group to use for reading
-        :return:               Cell object
-        """
-        background_cell = not sprite_cell
-        cell = Cell(i=-1, p=None)
-        tile_data = [0] * self.NUM_TILE_PLANES * h
-        tile_p = None
-        px_old = None
-        py_old = None
-        for y in range(h):
-            for x in range(w):
-                px = start_x + x
-                py = start_y + y
-                c = image.getpixel((px, py))
-                if c % self.PALETTE_GROUP_SIZE != 0:
-                    p = c // self.PALETTE_GROUP_SIZE
-                    background_match = (background_cell and p < self.NUM_PALETTE_GROUPS_BG)
-                    sprite_match = (palette_filter == p) or ((not palette_filter) and sprite_cell and p >= self.NUM_PALETTE_GROUPS_BG)
-                    if background_match or sprite_match:
-                        # Calculate additional offset in case we are reading an 8x16 tile
-                        offs = (y // self.TILE_HEIGHT) * self.TILE_HEIGHT * self.NUM_TILE_PLANES
-                        # P0
-                        tile_data[offs + (y % self.TILE_HEIGHT)] |= ((c >> 0) & 1) << (w - 1 - x)
-                        # P1
-                        tile_data[offs + (y % self.TILE_HEIGHT) + self.TILE_HEIGHT] |= ((c >> 1) & 1) << (w - 1 - x)
-                        # Check for inconsistency
-                        if tile_p is not None and tile_p != p:
-                            type_str = 'sprite' if sprite_cell else 'background'
-                            log.error(f'Inconsistent {type_str} palette. {p} at pixel ({px},{py}) differs from {tile_p} at pixel ({px_old},{py_old})')
-                            px_old = px
-                            py_old = py
-                        tile_p = p
-        # Empty tile should default to palette index 0
-        if tile_p is None:
-            tile_p = 0
-        # All-zero sprite tiles don't need storing
-        if sprite_cell and sum(tile_data) == 0:
-            return None, tile_p
-        else:
-            return tuple(tile_data), tile_p
+        self.tile_table_spr.add(bytes(spr_tile_data))
+
+    def _cells(self, pixels: np.ndarray, h: int) -> np.ndarray:
+        """
+        View pixel array as a grid of cells
+        
+        :param pixels: (..., screen_height, screen_width) array of pixels
+        :param h:      Height of cell
+        :return:       (..., grid_height, grid_width, h, w) array of cells
+        """
+        w = self.TILE_WIDTH
+        rows = pixels.shape[-2] // h
+        cols = pixels.shape[-1] // w
+        lead = pixels.shape[:-2]
+        return pixels[..., 0:rows * h, 0:cols * w].reshape(lead + (rows, h, cols, w)).swapaxes(-3, -2)
+
+    def _tile_data_grid(self, cells: np.ndarray, mask: np.ndarray) -> np.ndarray:
+        """
+        Convert cells to bitplane-packed tile data
+        
+        :param cells: (..., h, w) array of color indices
+        :param mask:  (..., h, w) boolean array of pixels to include
+        :return:      (..., 2 * h) array of tile data in NES CHR layout: For each 8-pixel high part, 8 rows of
+                      bitplane 0 followed by 8 rows of bitplane 1, with the leftmost pixel in the highest bit
+        """
+        lead = cells.shape[:-2]
+        h = cells.shape[-2]
+        tile_height = self.TILE_HEIGHT
+        planes = []
+        for plane in range(self.NUM_TILE_PLANES):
+            bits = ((cells >> plane) & 1) & mask
+            # MSB is leftmost pixel
+            planes.append(np.packbits(bits, axis=-1).reshape(lead + (h // tile_height, 1, tile_height)))
+        # Interleave planes for each 8-pixel high part, as an 8x16 tile is two consecutive 8x8 tiles
+        return np.concatenate(planes, axis=-2).reshape(lead + (self.NUM_TILE_PLANES * h,))
+
+    def _cell_palettes(self, p: np.ndarray, mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find palette of each cell, along with cells using inconsistent palettes
+        
+        The palette of a cell is that of the last pixel included in row-major order,
+        or 0 if no pixel is included.
+        
+        :param p:    (rows, cols, h, w) array of palette indices
+        :param mask: (rows, cols, h, w) boolean array of pixels to include
+        :return:     (rows, cols) arrays of palette indices and palette-conflict flags
+        """
+        rows, cols = p.shape[0:2]
+        p = p.reshape(rows, cols, -1)
+        mask = mask.reshape(rows, cols, -1)
+        last = mask.shape[-1] - 1 - np.argmax(mask[..., ::-1], axis=-1)
+        tile_p = np.where(mask.any(axis=-1), np.take_along_axis(p, last[..., None], axis=-1)[..., 0], 0)
+        p_min = np.where(mask, p, 255).min(axis=-1)
+        p_max = np.where(mask, p, 0).max(axis=-1)
+        conflicts = mask.any(axis=-1) & (p_min != p_max)
+        return tile_p.astype(np.uint8), conflicts
+
+    def _log_palette_conflicts(self, cells: np.ndarray, mask: np.ndarray, conflicts: np.ndarray, h: int, type_str: str):
+        """
+        Log palette inconsistencies of each conflicting cell: Every included pixel with a different palette than
+        the included pixel before it in row-major order is reported
+        """
+        for y, x in zip(*np.nonzero(conflicts)):
+            tile_p = None
+            px_old = None
+            py_old = None
+            for cy, cx in zip(*np.nonzero(mask[y, x])):
+                px = x * self.TILE_WIDTH + cx
+                py = y * h + cy
+                p = cells[y, x, cy, cx] // self.PALETTE_GROUP_SIZE
+                if tile_p is not None and tile_p != p:
+                    log.error(f'Inconsistent {type_str} palette. {p} at pixel ({px},{py}) differs from {tile_p} at pixel ({px_old},{py_old})')
+                    px_old = px
+                    py_old = py
+                tile_p = p
 
     def make_background(self):
         """
         Create background layer.
+        
+        The layer is stored as parallel (grid_height, grid_width) arrays of tile indices
+        (background_indices) and palette indices (background_palettes).
         """
-        self.background = [[Cell() for y in range(self.grid_height)] for x in range(self.grid_width)]
-        w = self.grid_width
-        h = self.grid_height
-        cell_width = self.TILE_WIDTH
-        cell_height = self.TILE_HEIGHT
-        for y in range(h):
-            for x in range(w):
-                tile_data, tile_p = self.read_background_cell(self.image,
-                                                              x * cell_width,
-                                                              y * cell_height,
-                                                              cell_width,
-                                                              cell_height)
-                tile_index = self.tile_table_bg.add(tile_data)
-                # Add cell to background layer
-                self.background[x][y] = Cell(d=tile_data, i=tile_index, p=tile_p)
+        cells = self._cells(self.pixels, self.TILE_HEIGHT)
+        p = cells // self.PALETTE_GROUP_SIZE
+        mask = (cells % self.PALETTE_GROUP_SIZE != 0) & (p < self.NUM_PALETTE_GROUPS_BG)
+        tile_data_grid = self._tile_data_grid(cells, mask)
+        self.background_palettes, conflicts = self._cell_palettes(p, mask)
+        if conflicts.any():
+            self._log_palette_conflicts(cells, mask, conflicts, self.TILE_HEIGHT, 'background')
+        # Tile data of all cells in row-major order - only the first of identical tiles is kept by the tile table
+        tile_size = tile_data_grid.shape[-1]
+        tile_data = tile_data_grid.tobytes()
+        tile_indices = [self.tile_table_bg.add(tile_data[offs:offs + tile_size]) for offs in range(0, len(tile_data), tile_size)]
+        self.background_indices = np.array(tile_indices, dtype=np.uint16).reshape(self.grid_height, self.grid_width)
 
     @staticmethod
-    def _find_unique_tile_indices_per_row(layer: List[List[Cell]]) -> List[Set[int]]:
-        w = len(layer)
-        h = len(layer[0])
-        unique_tile_indices_per_row = [set() for y in range(h)]
-        for y in range(h):
-            unique_tile_indices_per_row[y].update([layer[x][y].i for x in range(w)])
-        return unique_tile_indices_per_row
-
-    def _find_best_split(self, tile_table: TileTable, layer: List[List[Cell]], max_tiles: int) -> int:
-        # Get the unique tiles used for every row
-        indices_per_row = self._find_unique_tile_indices_per_row(layer)
-        # to get as much CPU time as possible, find the topmost split point that will fit
-        # both split parts within max tile limit.
-        bottom_tiles = set()
-        for y in range(self.grid_height - 1, -1, -1):
-            if len(bottom_tiles.union(indices_per_row[y])) <= min(max_tiles, 255):
-                bottom_tiles.update(indices_per_row[y])
-            else:
-                return y + 1
-        log.error(f'Could not fit background tiles in just two pattern tables.')
+    def _row_tile_masks(indices: np.ndarray) -> List[int]:
+        """
+        Get tile indices used by each row of a layer, as bitsets
+        
+        :param indices: (rows, columns) array of tile indices
+        :return:        Bitset of tile indices for each row, with bit i set if tile i is used
+        """
+        row_masks = []
+        for row in indices.tolist():
+            mask = 0
+            for i in set(row):
+                mask |= 1 << i
+            row_masks.append(mask)
+        return row_masks
+
+    @staticmethod
+    def _mask_indices(mask: int) -> List[int]:
+        """
+        :param mask: Bitset of tile indices
+        :return:     Tile indices in bitset, in increasing order
+        """
+        return [i for i, bit in enumerate(reversed(bin(mask)[2:])) if bit == '1']
+
+    @staticmethod
+    def _common_mask(section_masks: List[int]) -> int:
+        """
+        :param section_masks: Bitset of tile indices used by each section
+        :return:              Bitset of tile indices used by more than one section
+        """
+        seen = 0
+        common = 0
+        for mask in section_masks:
+            common |= seen & mask
+            seen |= mask
+        return common
+
+    def _split_objective(self, tile_table: TileTable, objective: str, chr_sizes: Dict[Tuple[int], int]):
+        """
+        Get sort key function for candidate splits, where a smaller key is better
+        
+        :param tile_table: Tile table of unsplit background layer
+        :param objective:  Name of objective in CHR_SPLIT_OBJECTIVES
+        :param chr_sizes:  Cache of compressed CHR size of each tile index sequence
+        :return:           Function mapping (split rows, section bitsets, common bitset) to sort key
+        """
+        def cpu_time(split_rows, section_masks, common):
+            # Splitting as high up as possible ends the timed splits earliest, leaving more frame time
+            return tuple(reversed(split_rows))
+
+        def common_tiles(split_rows, section_masks, common):
+            return (popcount(common),) + cpu_time(split_rows, section_masks, common)
+
+        def compressed_chr(split_rows, section_masks, common):
+            common_indices = self._mask_indices(common)
+            size = 0
+            for k, mask in enumerate(section_masks):
+                # Top section uploads common tiles, the others copy them from the bank of the previous section
+                own_indices = tuple(self._mask_indices(mask & ~common))
+                indices = tuple(common_indices) + own_indices if k == 0 else own_indices
+                if indices not in chr_sizes:
+                    chr_sizes[indices] = len(tokumaru_compressed(b''.join(tile_table[i] for i in indices)))
+                size += chr_sizes[indices]
+            return (size,) + cpu_time(split_rows, section_masks, common)
+
+        return {'cpu_time': cpu_time, 'common_tiles': common_tiles, 'compressed_chr': compressed_chr}[objective]
+
+    def _find_best_splits(self, tile_table: TileTable, indices: np.ndarray, max_tiles: int, objective: str) -> List[int]:
+        """
+        Find rows to switch CHR bank at, splitting the background layer into sections of at most max_tiles tiles.
+        
+        Each section uses its own CHR bank, holding the tiles used by more than one section first,
+        and the tiles only used by the section after them.
+        The fewest sections needed are used, and of those the best split according to the objective.
+        
+        :param tile_table: Tile table of unsplit background layer
+        :param indices:    (rows, columns) array of tile indices of unsplit background layer
+        :param max_tiles:  Maximum number of tiles of each section
+        :param objective:  Name of objective in CHR_SPLIT_OBJECTIVES
+        :return:           Start row of each section after the first
+        """
+        max_tiles = min(max_tiles, 255)
+        row_masks = self._row_tile_masks(indices)
+        num_rows = len(row_masks)
+        # Tiles used by each range of rows [a, b) that fits in a single CHR bank, built up incrementally
+        range_masks = {}
+        for a in range(num_rows):
+            mask = 0
+            for b in range(a + 1, num_rows + 1):
+                mask |= row_masks[b - 1]
+                if popcount(mask) > max_tiles:
+                    break
+                range_masks[(a, b)] = mask
+        key = self._split_objective(tile_table, objective, {})
+        for num_sections in range(2, self.MAX_CHR_BANKS + 1):
+            candidates = []
+            for split_rows in itertools.combinations(range(1, num_rows), num_sections - 1):
+                bounds = (0,) + split_rows + (num_rows,)
+                section_masks = [range_masks.get(section) for section in zip(bounds[:-1], bounds[1:])]
+                if None in section_masks:
+                    continue
+                common = self._common_mask(section_masks)
+                if all(popcount(common | mask) <= max_tiles for mask in section_masks):
+                    candidates.append((split_rows, section_masks, common))
+            if candidates:
+                return list(min(candidates, key=lambda candidate: key(*candidate))[0])
+        raise ValueError(f'Could not fit background tiles in {self.MAX_CHR_BANKS} pattern tables.')
 
     def _split_tile_table(self,
                           tile_table: TileTable,
-                          indices_top: Set,
-                          indices_bottom: Set,
-                          indices_common: Set,
-                          max_bg_slots: int) -> Tuple[TileTableType, Dict[int, int], TileTableType, Dict[int, int]]:
-        tile_table_top = TileTable(max_bg_slots, self.TILE_WIDTH, self.TILE_HEIGHT)
-        tile_table_bottom = TileTable(max_bg_slots, self.TILE_WIDTH, self.TILE_HEIGHT)
-        remapping_top = {}
-        remapping_bottom = {}
-        # Add / remap common tile indices
-        for i in sorted(indices_common):
-            remapping_top[i] = len(tile_table_top)
-            tile_table_top.append(tile_table[i])
-            remapping_bottom[i] = len(tile_table_bottom)
-            tile_table_bottom.append(tile_table[i])
-        # Add / remap top tile indices
-        for i in sorted(indices_top.difference(indices_common)):
-            remapping_top[i] = len(tile_table_top)
-            tile_table_top.append(tile_table[i])
-        # Add / remap bottom tile indices
-        for i in sorted(indices_bottom.difference(indices_common)):
-            remapping_bottom[i] = len(tile_table_bottom)
-            tile_table_bottom.append(tile_table[i])
-        return tile_table_top, remapping_top, tile_table_bottom, remapping_bottom
+                          section_indices: List[Set[int]],
+                          common_indices: Set[int],
+                          max_bg_slots: int) -> Tuple[List[TileTableType], List[Dict[int, int]]]:
+        tile_tables = []
+        remappings = []
+        for indices in section_indices:
+            section_tile_table = TileTable(max_bg_slots, self.TILE_WIDTH, self.TILE_HEIGHT)
+            remapping = {}
+            # Add / remap common tile indices, followed by the section's own tile indices
+            for i in sorted(common_indices) + sorted(indices.difference(common_indices)):
+                remapping[i] = len(section_tile_table)
+                section_tile_table.append(tile_table[i])
+            if len(tile_tables) > 0 and len(section_tile_table) == len(common_indices):
+                # Tokumaru decompressor can't upload zero tiles - pad with a blank tile
+                section_tile_table.append(bytes(self.NUM_TILE_PLANES * self.TILE_HEIGHT))
+            tile_tables.append(section_tile_table)
+            remappings.append(remapping)
+        return tile_tables, remappings
 
     def _remap_background_indices(self, start: int, end: int, remapping: Dict[int, int]):
-        w = self.grid_width
-        for y in range(start, end):
-            for x in range(self.grid_width):
-                self.background[x][y].i = remapping[self.background[x][y].i]
+        lookup = np.zeros(max(remapping) + 1, dtype=np.uint16)
+        lookup[list(remapping.keys())] = list(remapping.values())
+        self.background_indices[start:end] = lookup[self.background_indices[start:end]]
+
+    @staticmethod
+    def _near_tile_pairs(tiles: List[int], num_bits: int, max_distance: int) -> List[Tuple[int, int, int]]:
+        """
+        Find pairs of tiles within a Hamming distance, with a multi-index hash
+        
+        The bits of tiles are split into parts. Tiles within the distance differ in at most
+        max_distance // num_parts bits in at least one part, so tiles are bucketed by the value of each
+        part and only compared to tiles in buckets of values within that radius.
+        Tiles with blank rows share part values, so a bucket can hold most tiles. A bucket of more than
+        MAX_NEAR_TILE_BUCKET_SIZE tiles is searched recursively with the following parts only: pairs in it
+        not found with an earlier part differ in more than the radius in each earlier part, which leaves
+        less distance for the following parts. Tiles are compared pairwise where that is cheaper than
+        looking up the buckets within the radius.
+        
+        :param tiles:        Tile data of each tile as integer
+        :param num_bits:     Number of bits of tile data
+        :param max_distance: Maximum number of differing bits
+        :return:             Distance and tile indices of each pair, lowest index first
+        """
+        distances = {}
+
+        def compare(bucket: Sequence[int], other_bucket: Sequence[int]):
+            for a in bucket:
+                for b in other_bucket:
+                    distance = popcount(tiles[a] ^ tiles[b])
+                    if distance <= max_distance:
+                        distances[(a, b) if a < b else (b, a)] = distance
+
+        def compare_all(indices: Sequence[int]):
+            # Indices are in increasing order
+            for a, b in itertools.combinations(indices, 2):
+                distance = popcount(tiles[a] ^ tiles[b])
+                if distance <= max_distance:
+                    distances[a, b] = distance
+
+        @functools.lru_cache(maxsize=None)
+        def flips(part_bits: int, radius: int) -> List[int]:
+            # Bits to flip in a part to find the other parts within radius
+            return [sum(1 << bit for bit in bits) for r in range(1, radius + 1) for bits in itertools.combinations(range(part_bits), r)]
+
+        def search(indices: List[int], parts: List[Tuple[int, int]], distance: int):
+            # Find pairs of tiles differing in at most distance bits of parts
+            radius = distance // len(parts) if parts else 0
+            num_pairs = len(indices) * (len(indices) - 1) // 2
+            if (not parts or len(indices) <= ScreenBuilder.MAX_NEAR_TILE_BUCKET_SIZE or
+                    len(flips(max(end - start for start, end in parts), radius)) >= len(indices)):
+                compare_all(indices)
+                return
+            part_buckets = []
+            num_compared = 0
+            for start, end in parts:
+                mask = (1 << (end - start)) - 1
+                buckets = defaultdict(list)
+                for tile_index in indices:
+                    buckets[(tiles[tile_index] >> start) & mask].append(tile_index)
+                part_buckets.append(buckets)
+                for part, bucket in buckets.items():
+                    num_compared += len(bucket) * (len(bucket) - 1) // 2
+                    num_compared += sum(len(bucket) * len(buckets.get(part ^ flip, ())) for flip in flips(end - start, radius) if part ^ flip > part)
+            # Buckets of few distinct part values, such as blank rows, hold most pairs of tiles
+            if num_compared >= num_pairs:
+                compare_all(indices)
+                return
+            for part_index, ((start, end), buckets) in enumerate(zip(parts, part_buckets)):
+                remaining_distance = distance - part_index * (radius + 1)
+                for part, bucket in buckets.items():
+                    if len(bucket) <= ScreenBuilder.MAX_NEAR_TILE_BUCKET_SIZE:
+                        compare_all(bucket)
+                    elif remaining_distance >= 0:
+                        search(bucket, parts[part_index + 1:], remaining_distance)
+                    for flip in flips(end - start, radius):
+                        if part ^ flip > part:
+                            compare(bucket, buckets.get(part ^ flip, ()))
+
+        # Parts of at least 8 bits, allowing exact matching of parts up to a distance of 15
+        num_parts = min(max_distance + 1, num_bits // 8)
+        bounds = [num_bits * part // num_parts for part in range(num_parts + 1)]
+        search(list(range(len(tiles))), list(zip(bounds, bounds[1:])), max_distance)
+        return [(distance, a, b) for (a, b), distance in distances.items()]
+
+    def merge_similar_tiles(self, max_tiles: int, max_error: int):
+        """
+        Lossily merge background tiles that differ in few bits, to fit the tiles into max_tiles
+        and avoid a mid-frame CHR bank switch
+        
+        Pairs of tiles are merged in order of increasing Hamming distance of their bitplanes,
+        replacing the tile used by the fewest cells with the other. The tiles are left unchanged
+        if they can't be fit without exceeding max_error for some tile.
+        
+        :param max_tiles: Number of tiles to fit into
+        :param max_error: Maximum number of bitplane bits differing between a tile and the tile replacing it
+        """
+        tile_table = self.tile_table_bg
+        num_bits = 8 * self.NUM_TILE_PLANES * tile_table.height
+        original = [int.from_bytes(tile_data, 'big') for tile_data in tile_table.data]
+        usage = np.bincount(self.background_indices.ravel(), minlength=len(original)).tolist()
+        pairs_by_distance = defaultdict(list)
+        for distance, a, b in self._near_tile_pairs(original, num_bits, max_error):
+            pairs_by_distance[distance].append((a, b))
+        # Remaining tiles, and the original tiles each of them replaces
+        members = {tile_index: [tile_index] for tile_index in range(len(original))}
+        cluster_usage = usage[:]
+        for distance in sorted(pairs_by_distance):
+            if len(members) <= max_tiles:
+                break
+            pairs = sorted(pairs_by_distance[distance], key=lambda pair: (min(cluster_usage[pair[0]], cluster_usage[pair[1]]), pair))
+            for a, b in pairs:
+                if a not in members or b not in members:
+                    continue
+                keep, drop = (a, b) if cluster_usage[a] >= cluster_usage[b] else (b, a)
+                if any(popcount(original[m] ^ original[keep]) > max_error for m in members[drop]):
+                    continue
+                members[keep] += members.pop(drop)
+                cluster_usage[keep] += cluster_usage[drop]
+                if len(members) <= max_tiles:
+                    break
+        if len(members) > max_tiles:
+            log.info(f'Merging background tiles differing in up to {max_error} bits leaves {len(members)} tiles, '
+                     f'more than {max_tiles} - CHR split not avoided')
+            return
+        # Rebuild tile table from remaining tiles, keeping their order
+        self.tile_table_bg = TileTable(max_tiles=tile_table.max_tiles, width=tile_table.width, height=tile_table.height)
+        remapping = {}
+        errors = [0] * len(original)
+        for keep in sorted(members):
+            new_index = self.tile_table_bg.add(tile_table.data[keep])
+            for m in members[keep]:
+                remapping[m] = new_index
+                errors[m] = popcount(original[m] ^ original[keep])
+        self._remap_background_indices(0, self.grid_height, remapping)
+        num_cells_changed = sum(u for u, error in zip(usage, errors) if error)
+        log.info(f'Merged {len(original) - len(members)} similar background tiles to fit {max_tiles} tiles - CHR split avoided. '
+                 f'Error: {sum(u * error for u, error in zip(usage, errors))} bitplane bits in {num_cells_changed} nametable cells, '
+                 f'at most {max(errors)} bits per cell')
 
     def split_background_tile_table(self, max_bg_slots: int):
         """
-        Split background tile table into a top and bottom part
+        Split background tile table into sections using consecutive CHR banks, switched mid-frame
         """
         # Find best split
-        self.bottom_start_row = self._find_best_split(self.tile_table_bg, self.background, max_bg_slots)
-        unique_tile_indices_per_row = self._find_unique_tile_indices_per_row(self.background)
-        # Find unique indices for top bottom, and common indices
-        unique_top_tile_indices = set(itertools.chain(*unique_tile_indices_per_row[0:self.bottom_start_row]))
-        unique_bottom_tile_indices = set(itertools.chain(*unique_tile_indices_per_row[self.bottom_start_row:]))
-        unique_common_tile_indices = unique_top_tile_indices.intersection(unique_bottom_tile_indices)
+        self.split_rows = self._find_best_splits(self.tile_table_bg, self.background_indices, max_bg_slots, self.chr_split_objective)
+        self.bottom_start_row = self.split_rows[0]
+        bounds = [0] + self.split_rows + [self.grid_height]
+        row_masks = self._row_tile_masks(self.background_indices)
+        section_masks = [functools.reduce(operator.or_, row_masks[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+        # Find unique indices for each section, and common indices used by more than one section
+        section_indices = [set(self._mask_indices(mask)) for mask in section_masks]
+        common_indices = set(self._mask_indices(self._common_mask(section_masks)))
         #
-        self.tile_table_bg_top, remapping_top, self.tile_table_bg_bottom, remapping_bottom = self._split_tile_table(self.tile_table_bg,
-                                                                                                                    unique_top_tile_indices,
-                                                                                                                    unique_bottom_tile_indices,
-                                                                                                                    unique_common_tile_indices,
-                                                                                                                    max_bg_slots)
-        self.num_common_tile_indices = len(unique_common_tile_indices)
+        self.tile_tables_bg, remappings = self._split_tile_table(self.tile_table_bg, section_indices, common_indices, max_bg_slots)
+        self.tile_table_bg_top = self.tile_tables_bg[0]
+        self.tile_table_bg_bottom = self.tile_tables_bg[1]
+        self.num_common_tile_indices = len(common_indices)
         # Remap in-place
-        self._remap_background_indices(0, self.bottom_start_row, remapping_top)
-        self._remap_background_indices(self.bottom_start_row, self.grid_height, remapping_bottom)
+        for (a, b), remapping in zip(zip(bounds[:-1], bounds[1:]), remappings):
+            self._remap_background_indices(a, b, remapping)
+
+    def use_shared_tiles(self, shared_tiles: Sequence[bytes]):
+        """
+        Place background tiles shared with other pictures first in the tile table.
+
+        The shared tiles are always given the same tile indices, so they only need to be
+        uploaded once for a sequence of pictures. The picture's own tiles follow them.
+        Only supported for pictures without a split background tile table.
+
+        :param shared_tiles: Tile data of shared tiles, in tile index order
+        """
+        assert self.bottom_start_row is None
+        shared_indices = {tile_data: i for i, tile_data in enumerate(shared_tiles)}
+        tile_table = TileTable(self.tile_table_bg_top.max_tiles, self.TILE_WIDTH, self.TILE_HEIGHT)
+        tile_table.extend(shared_tiles)
+        remapping = {}
+        for i, tile_data in enumerate(self.tile_table_bg_top):
+            shared_index = shared_indices.get(tile_data)
+            remapping[i] = shared_index if shared_index is not None else tile_table.add(tile_data)
+        if len(tile_table) == len(shared_tiles):
+            # Tokumaru decompressor can't upload zero tiles - pad with a blank tile
+            tile_table.append(bytes(self.NUM_TILE_PLANES * self.TILE_HEIGHT))
+        self.tile_table_bg = self.tile_table_bg_top = tile_table
+        self.tile_tables_bg = [tile_table]
+        self.num_shared_tiles = len(shared_tiles)
+        self._remap_background_indices(0, self.grid_height, remapping)
 
     def merge_horizontally_adjacent_sprites(self, sprites: List[Sprite]) -> List[Sprite]:
         """
@@ -414,91 +767,235 @@ class ScreenBuilder:
             new_sprites.extend(adjacent_slice)
         return new_sprites
 
+    def _sprite_planes(self) -> np.ndarray:
+        """
+        Split sprite pixels into one color plane per sprite palette group
+        
+        :return: (NUM_PALETTE_GROUPS_SPR, screen_height, screen_width) array with
+                 color 1-3 where pixel uses that palette group, and 0 elsewhere
+        """
+        c = self.pixels
+        p = c // self.PALETTE_GROUP_SIZE
+        color = c % self.PALETTE_GROUP_SIZE
+        groups = np.arange(self.NUM_PALETTE_GROUPS_SPR, dtype=np.uint8) + self.NUM_PALETTE_GROUPS_BG
+        return np.where(p[None, :, :] == groups[:, None, None], color[None, :, :], 0).astype(np.uint8)
+
+    def _sprite_tile_data(self, sprite_planes: np.ndarray, sprite: Sprite, h: int) -> Optional[bytes]:
+        """
+        Get tile data of sprite at any position from sprite color planes
+        
+        :param sprite_planes: Sprite color planes, from _sprite_planes
+        :param sprite:        Sprite to get tile data for
+        :param h:             Height of sprite
+        :return:              Tile data, or None if sprite has no opaque pixels
+        """
+        plane = sprite_planes[sprite.p - self.NUM_PALETTE_GROUPS_BG]
+        cell = plane[sprite.y:sprite.y + h, sprite.x:sprite.x + self.SPRITE_WIDTH]
+        if not cell.any():
+            return None
+        return self._tile_data_grid(cell, cell != 0).tobytes()
+
+    def _grid_sprites(self, sprite_planes: np.ndarray, sprite_height: int) -> List[Sprite]:
+        """
+        Place sprites on the sprite grid, merging horizontally adjacent sprites where possible
+        
+        :param sprite_planes: Sprite color planes, from _sprite_planes
+        :param sprite_height: Height of sprites
+        :return:              Sprites with tile data, in palette group order
+        """
+        cells = self._cells(sprite_planes, sprite_height)
+        tile_data_grid = self._tile_data_grid(cells, cells != 0)
+        # Convert gridded sprite layer to linear list of sprites, discarding all-zero tiles
+        sprites = []
+        for p, y, x in np.argwhere(tile_data_grid.any(axis=-1)).tolist():
+            s = Sprite(x=x * self.TILE_WIDTH,
+                       y=y * sprite_height,
+                       i=None,
+                       H=False,
+                       V=False,
+                       p=p + self.NUM_PALETTE_GROUPS_BG)
+            s.tiledata = tile_data_grid[p, y, x].tobytes()
+            sprites.append(s)
+        # Optimise sprites by reducing horizontally adjacent sprites
+        sprites = self.merge_horizontally_adjacent_sprites(sprites)
+        # Get tile data at new sprite positions from color planes, discarding those with empty tile data
+        new_sprites = []
+        for s in sprites:
+            tile_data = self._sprite_tile_data(sprite_planes, s, sprite_height)
+            if tile_data is not None:
+                s.tiledata = tile_data
+                new_sprites.append(s)
+        return new_sprites
+
+    def _free_sprites(self, sprite_planes: np.ndarray, sprite_height: int) -> List[Sprite]:
+        """
+        Cover the pixels of each sprite palette group with sprites at any position
+        
+        Sprites are placed greedily from the top. Each sprite covers the topmost, leftmost
+        pixel not yet covered, at the position covering the most uncovered pixels and overflowing
+        the fewest scanlines. Sprites are then moved off scanlines still overflowing where possible.
+        
+        :param sprite_planes: Sprite color planes, from _sprite_planes
+        :param sprite_height: Height of sprites
+        :return:              Sprites with tile data, in palette group order
+        """
+        h = sprite_height
+        w = self.SPRITE_WIDTH
+        height, width = sprite_planes.shape[1:]
+        scanline_counts = self._sprites_per_scanline([], h)
+        sprites = []
+        for p, plane in enumerate(sprite_planes):
+            uncovered = plane != 0
+            while uncovered.any():
+                y0, x0 = divmod(int(np.argmax(uncovered)), width)
+                # Sprite positions covering pixel (x0, y0). Sprites aren't displayed on the first scanline
+                top_min = max(y0 - h + 1, 1 if y0 > 0 else 0)
+                top_max = max(min(y0, height - h), top_min)
+                left_min = max(x0 - w + 1, 0)
+                left_max = max(min(x0, width - w), left_min)
+                # Uncovered pixels of each position, from summed-area table of the region around the pixel
+                region = uncovered[top_min:top_max + h, left_min:left_max + w]
+                area = np.zeros((region.shape[0] + 1, region.shape[1] + 1), dtype=np.int32)
+                area[1:, 1:] = region.cumsum(axis=0).cumsum(axis=1)
+                tops = np.arange(top_max - top_min + 1)
+                lefts = np.arange(left_max - left_min + 1)
+                coverage = (area[np.ix_(tops + h, lefts + w)] - area[np.ix_(tops, lefts + w)]
+                            - area[np.ix_(tops + h, lefts)] + area[np.ix_(tops, lefts)])
+                # Scanlines each top position would overflow
+                full = np.concatenate([[0], np.cumsum(scanline_counts >= self.MAX_SPRITES_PER_SCANLINE)])
+                overflows = full[top_min + tops + h] - full[top_min + tops]
+                # Most pixels covered first, then fewest overflowing scanlines, then lowest and rightmost position
+                score = overflows[:, None] - coverage * (h + 1)
+                top, left = np.unravel_index(np.argmin(score[::-1, ::-1]), score.shape)
+                s = Sprite(x=left_max - int(left),
+                           y=top_max - int(top),
+                           i=None,
+                           H=False,
+                           V=False,
+                           p=p + self.NUM_PALETTE_GROUPS_BG)
+                s.tiledata = self._sprite_tile_data(sprite_planes, s, h)
+                sprites.append(s)
+                uncovered[s.y:s.y + h, s.x:s.x + w] = False
+                scanline_counts[s.y:s.y + h] += 1
+        self._move_sprites_off_overflowing_scanlines(sprites, sprite_planes, h)
+        return sprites
+
+    def _move_sprites_off_overflowing_scanlines(self, sprites: List[Sprite], sprite_planes: np.ndarray, sprite_height: int):
+        """
+        Move sprites up or down to reduce the scanlines exceeding the sprites-per-scanline limit
+        
+        A sprite is only moved as far as it keeps covering the pixels no other sprite covers.
+        
+        :param sprites:       Sprites to move, with tile data
+        :param sprite_planes: Sprite color planes, from _sprite_planes
+        :param sprite_height: Height of sprites
+        """
+        h = sprite_height
+        w = self.SPRITE_WIDTH
+        height = sprite_planes.shape[1]
+        scanline_counts = self._sprites_per_scanline(sprites, h)
+        # Number of sprites covering each pixel, for each palette group
+        cover_counts = np.zeros(sprite_planes.shape, dtype=np.int32)
+        for s in sprites:
+            cover_counts[s.p - self.NUM_PALETTE_GROUPS_BG, s.y:s.y + h, s.x:s.x + w] += 1
+        moved = True
+        while moved and (scanline_counts > self.MAX_SPRITES_PER_SCANLINE).any():
+            moved = False
+            for s in sprites:
+                if not (scanline_counts[s.y:s.y + h] > self.MAX_SPRITES_PER_SCANLINE).any():
+                    continue
+                p = s.p - self.NUM_PALETTE_GROUPS_BG
+                window = (slice(s.y, s.y + h), slice(s.x, s.x + w))
+                own_rows = np.flatnonzero(((sprite_planes[p][window] != 0) & (cover_counts[p][window] == 1)).any(axis=-1))
+                if len(own_rows) == 0:
+                    continue
+                # Tops keeping pixels of sprite on screen, excluding the first scanline where sprites aren't displayed
+                top_min = max(s.y + int(own_rows[-1]) - h + 1, 1)
+                top_max = min(s.y + int(own_rows[0]), height - h)
+                scanline_counts[s.y:s.y + h] -= 1
+                best_top = s.y
+                best_overflows = int(np.count_nonzero(scanline_counts[s.y:s.y + h] >= self.MAX_SPRITES_PER_SCANLINE))
+                for top in range(top_min, top_max + 1):
+                    overflows = int(np.count_nonzero(scanline_counts[top:top + h] >= self.MAX_SPRITES_PER_SCANLINE))
+                    if overflows < best_overflows:
+                        best_top, best_overflows = top, overflows
+                if best_top != s.y:
+                    cover_counts[p, s.y:s.y + h, s.x:s.x + w] -= 1
+                    s.y = best_top
+                    cover_counts[p, s.y:s.y + h, s.x:s.x + w] += 1
+                    s.tiledata = self._sprite_tile_data(sprite_planes, s, h)
+                    moved = True
+                scanline_counts[s.y:s.y + h] += 1
+
+    def _sprites_per_scanline(self, sprites: List[Sprite], sprite_height: int) -> np.ndarray:
+        """
+        Count sprites on each scanline, including the sprite#0 OAM entry always written by CrunchyLib
+        
+        :param sprites:       Sprites of picture
+        :param sprite_height: Height of sprites
+        :return:              Array of number of sprites on each scanline
+        """
+        counts = np.zeros(self.screen_height, dtype=np.int32)
+        counts[1:1 + sprite_height] += 1
+        for s in sprites:
+            counts[s.y:s.y + sprite_height] += 1
+        return counts
+
+    def _sprites_cost(self, sprites: List[Sprite], sprite_height: int) -> Tuple[int, int, int]:
+        """
+        :return: Sprites over the OAM limit, overflowing scanlines and number of sprites, to be minimized in that order
+        """
+        counts = self._sprites_per_scanline(sprites, sprite_height)
+        return (max(len(sprites) - (self.MAX_SPRITES - 1), 0),
+                int(np.count_nonzero(counts > self.MAX_SPRITES_PER_SCANLINE)),
+                len(sprites))
+
+    def _log_sprite_overflows(self, sprite_height: int):
+        """
+        Log scanlines exceeding the sprites-per-scanline limit of the PPU
+        """
+        counts = self._sprites_per_scanline(self.sprites, sprite_height)
+        overflowing = np.flatnonzero(counts > self.MAX_SPRITES_PER_SCANLINE).tolist()
+        # Report runs of consecutive overflowing scanlines
+        for _, run in itertools.groupby(enumerate(overflowing), lambda item: item[1] - item[0]):
+            scanlines = [scanline for _, scanline in run]
+            log.error(f'Sprites-per-scanline overflow: {int(counts[scanlines].max())} sprites on scanlines {scanlines[0]}-{scanlines[-1]}, '
+                      f'maximum is {self.MAX_SPRITES_PER_SCANLINE}')
+
     def make_sprites(self):
         """
         Create sprite layer
         """
-        #
         sprite_height_multiplier = 2 if self.sprites_8x16 else 1
-        w = self.grid_width
-        h = self.grid_height // sprite_height_multiplier
-        sprite_grid = [[[Cell() for y in range(h)] for x in range(w)] for p in range(self.NUM_PALETTE_GROUPS_SPR)]
-        for p in range(self.NUM_PALETTE_GROUPS_SPR):
-            for y in range(h):
-                for x in range(w):
-                    tile_data, tile_p = self.read_sprite_cell(self.image,
-                                                              x * self.TILE_WIDTH,
-                                                              y * self.TILE_HEIGHT * sprite_height_multiplier,
-                                                              self.TILE_WIDTH,
-                                                              self.TILE_HEIGHT * sprite_height_multiplier,
-                                                              p + self.NUM_PALETTE_GROUPS_BG)
-                    # Add cell to sprite layer
-                    sprite_grid[p][x][y] = Cell(d=tile_data, i=None, p=p + self.NUM_PALETTE_GROUPS_BG)
-        # Convert gridded sprite layer to linear list of sprites
-        self.sprites = []
-        for p in range(self.NUM_PALETTE_GROUPS_SPR):
-            for y in range(h):
-                for x in range(w):
-                    cell = sprite_grid[p - self.NUM_PALETTE_GROUPS_BG][x][y]
-                    if cell.d:
-                        tile_index = self.tile_table_spr.add(cell.d)
-                        # Add sprite
-                        s = Sprite(x=x * self.TILE_WIDTH,
-                                   y=y * self.TILE_HEIGHT * sprite_height_multiplier,
-                                   i=(tile_index << 1) if self.sprites_8x16 else tile_index,
-                                   H=False,
-                                   V=False,
-                                   p=cell.p)
-                        s.tiledata = cell.d
-                        self.sprites.append(s)
-        # Optimise sprites by reducing horizontally adjacent sprites
-        self.sprites = self.merge_horizontally_adjacent_sprites(self.sprites)
-        # Re-create new tile data for reduced adjacent sprites
+        sprite_height = self.TILE_HEIGHT * sprite_height_multiplier
+        # Read color planes of all sprite palette groups in a single pass
+        sprite_planes = self._sprite_planes()
+        self.sprites = self._grid_sprites(sprite_planes, sprite_height)
+        if self.sprite_packing == 'free':
+            free_sprites = self._free_sprites(sprite_planes, sprite_height)
+            if self._sprites_cost(free_sprites, sprite_height) < self._sprites_cost(self.sprites, sprite_height):
+                log.info(f'Free sprite placement: {len(free_sprites)} sprites instead of {len(self.sprites)}')
+                self.sprites = free_sprites
+        # OAM entry 0 is taken by sprite#0
+        max_sprites = self.MAX_SPRITES - 1
+        if len(self.sprites) > max_sprites:
+            raise ValueError(f'Could not fit sprites in OAM: {len(self.sprites)} sprites, maximum is {max_sprites}.')
+        # Re-create tile data for placed sprites, storing identical and flipped tiles only once
         self.tile_table_spr.clear()
-        start_index = self.sprite_tiles_start_page * (16 >> int(self.sprites_8x16))
-        # Re-read tile_data for sprites, discarding those with empty tile data
-        new_sprites = []
         for s in self.sprites:
-            tile_data, tile_p = self.read_sprite_cell(self.image,
-                                                      s.x,
-                                                      s.y,
-                                                      self.TILE_WIDTH,
-                                                      self.TILE_HEIGHT * sprite_height_multiplier,
-                                                      s.p)
-            if tile_data is not None:
-                self.tile_table_spr.add(tile_data) + start_index
-                new_sprites.append(s)
-        self.sprites = new_sprites
-        if len(self.sprites) < 3:
-            # Tokumaru compressor will crash if tiles < 3. Work-around this by padding
-            # TODO: Fix in compressor instead
-            while len(self.sprites) < 3:
-                for i in range(1 + int(self.sprites_8x16)):
-                    self.tile_table_spr.data.append(tuple([0 for i in range(self.TILE_HEIGHT * self.NUM_TILE_PLANES)]))
-                # Add dummy sprite to match tile
-                s = Sprite(x=0,
-                               y=240,
-                               i=0,
-                               H=False,
-                               V=False,
-                               p=self.NUM_PALETTE_GROUPS_BG)
-                self.sprites.append(s)
-        if len(self.sprites) > self.MAX_SPRITES:
-            log.error(f'Number-of-sprites overflow: {self.MAX_SPRITES}')
-        # Re-number sprites as some may have been discarded after merging
-        for i, s in enumerate(self.sprites):
-            s.i = (i << 1) if self.sprites_8x16 else i
+            tile_index, s.H, s.V = self.tile_table_spr.add_flipped(s.tiledata)
+            s.i = (tile_index << 1) if self.sprites_8x16 else tile_index
+        self._log_sprite_overflows(sprite_height)
 
     @staticmethod
-    def chr(tile_data: List[Tuple[int]]) -> ByteArray:
+    def chr(tile_data: List[bytes]) -> ByteArray:
         """
         Convert tile data to byte array
         
         :param tile_data: List of tile data for each tile index
         :return:          Byte array of linearized tile data
         """
-        chr_data = array('B', itertools.chain(*tile_data))
-        return chr_data
+        return array('B', b''.join(tile_data))
 
     def chr_bg(self) -> ByteArray:
         """
@@ -506,7 +1003,8 @@ class ScreenBuilder:
         
         :return:          Byte array of linearized background tile data
         """
-        return self.chr(self.tile_table_bg_top.data + self.tile_table_bg_bottom.data[self.num_common_tile_indices:])
+        return self.chr(self.tile_table_bg_top.data + [tile_data for tile_table in self.tile_tables_bg[1:]
+                                                       for tile_data in tile_table.data[self.num_common_tile_indices:]])
 
     def chr_bg_top(self) -> ByteArray:
         """
@@ -516,13 +1014,21 @@ class ScreenBuilder:
         """
         return self.chr(self.tile_table_bg_top.data)
 
+    def chr_bg_top_unshared(self) -> ByteArray:
+        """
+        Get background CHR (top part without tiles shared with other pictures)
+        
+        :return:          Byte array of linearized background tile data
+        """
+        return self.chr(self.tile_table_bg_top.data[self.num_shared_tiles:])
+
     def chr_bg_bottom(self) -> ByteArray:
         """
-        Get background CHR (bottom part)
+        Get background CHR (bottom part, of every section after the top one)
         
         :return:          Byte array of linearized background tile data
         """
-        return self.chr(self.tile_table_bg_bottom.data)
+        return self.chr([tile_data for tile_table in self.tile_tables_bg[1:] for tile_data in tile_table.data])
 
     def chr_bg_bottom_no_common(self) -> ByteArray:
         """
@@ -530,7 +1036,15 @@ class ScreenBuilder:
         
         :return:          Byte array of linearized background tile data
         """
-        return self.chr(self.tile_table_bg_bottom.data[self.num_common_tile_indices:])
+        return self.chr([tile_data for tile_table in self.tile_tables_bg[1:] for tile_data in tile_table.data[self.num_common_tile_indices:]])
+
+    def chr_bg_sections_no_common(self) -> List[ByteArray]:
+        """
+        Get background CHR of each section after the top one, without common tiles
+        
+        :return:          Byte array of linearized background tile data for each section
+        """
+        return [self.chr(tile_table.data[self.num_common_tile_indices:]) for tile_table in self.tile_tables_bg[1:]]
 
     def chr_spr(self) -> ByteArray:
         """
@@ -546,19 +1060,19 @@ class ScreenBuilder:
         
         :return:          Nametable as byte array
         """
-        nt = array('B', [0] * self.grid_width * self.grid_height)
-        for y in range(self.grid_height):
-            for x in range(self.grid_width):
-                nt[y * self.grid_width + x] = self.background[x][y].i
-        return nt
+        return array('B', self.background_indices.astype(np.uint8).tobytes())
 
-    def _palette_index_table(self) -> List[List[int]]:
-        w = self.NAMETABLE_WIDTH // 2
+    def _palette_index_table(self) -> np.ndarray:
+        """
+        Get 16x16 palette-index table, with one entry per 16x16 pixel area
+        
+        :return: (rows, columns) array of palette indices
+        """
+        bp = self.background_palettes
+        pt = np.zeros((2 * self.ATTRIBUTE_TABLE_HEIGHT, 2 * self.ATTRIBUTE_TABLE_WIDTH), dtype=np.uint8)
         h = self.NAMETABLE_HEIGHT // 2
-        pt = [[0 for y in range(2 * self.ATTRIBUTE_TABLE_HEIGHT)] for x in range(2 * self.ATTRIBUTE_TABLE_WIDTH)]
-        for y in range(h):
-            for x in range(w):
-                pt[x][y] = self.background[2 * x][2 * y].p | self.background[2 * x + 1][2 * y].p | self.background[2 * x][2 * y + 1].p | self.background[2 * x + 1][2 * y + 1].p
+        w = self.NAMETABLE_WIDTH // 2
+        pt[0:h, 0:w] = bp[0:2 * h:2, 0:2 * w:2] | bp[0:2 * h:2, 1:2 * w:2] | bp[1:2 * h:2, 0:2 * w:2] | bp[1:2 * h:2, 1:2 * w:2]
         return pt
 
     def attribute_table(self) -> ByteArray:
@@ -570,15 +1084,12 @@ class ScreenBuilder:
         # Get 16x16 palette-index table
         pt = self._palette_index_table()
         # Create 8x8 attribute table
-        at = array('B', [0] * self.ATTRIBUTE_TABLE_WIDTH * self.ATTRIBUTE_TABLE_HEIGHT)
-        for y in range(self.ATTRIBUTE_TABLE_HEIGHT):
-            for x in range(self.ATTRIBUTE_TABLE_WIDTH):
-                topLeft = pt[2 * x + 0][2 * y + 0]
-                topRight = pt[2 * x + 1][2 * y + 0]
-                bottomLeft = pt[2 * x + 0][2 * y + 1]
-                bottomRight = pt[2 * x + 1][2 * y + 1]
-                at[y * self.ATTRIBUTE_TABLE_WIDTH + x] = (bottomRight << 6) | (bottomLeft << 4) | (topRight << 2) | (topLeft << 0)
-        return at
+        topLeft = pt[0::2, 0::2]
+        topRight = pt[0::2, 1::2]
+        bottomLeft = pt[1::2, 0::2]
+        bottomRight = pt[1::2, 1::2]
+        at = (bottomRight << 6) | (bottomLeft << 4) | (topRight << 2) | (topLeft << 0)
+        return array('B', at.tobytes())
 
     def nametable(self) -> ByteArray:
         """
@@ -588,89 +1099,122 @@ class ScreenBuilder:
         """
         return self.nametable_without_attribute_table() + self.attribute_table()
 
-    def split_nametable_in_half(self, rleinc_base_and_nametable: List[Tuple[int, List[int]]]) -> List[Tuple[int, List[int]]]:
-        """
-        Split nametable in half.
-        
-        :param rleinc_base_and_nametable: List of rleinc_base / nametable pairs
-        :return:                          New list of rleinc_base / nametable pairs
-        """
-        def max_compressed_size(rleinc_base, nametable, row: int) -> int:
-            nametable_top = nametable[0:self.NAMETABLE_WIDTH * row]
-            nametable_bottom = nametable[self.NAMETABLE_WIDTH * row:]
-            nametable_top_compressed, rleinc_base_new = rleinc_compressed(nametable_top, rleinc_base)
-            nametable_bottom_compressed, _ = rleinc_compressed(nametable_bottom, rleinc_base_new)
-            max_size = max([len(nametable_top_compressed), len(nametable_bottom_compressed)])
-            return max_size
-        rleinc_base, nametable = rleinc_base_and_nametable
-        num_rows = len(nametable) // self.NAMETABLE_WIDTH
-        row = num_rows // 2
-        best_size = max_compressed_size(rleinc_base, nametable, row)
-        while True:
-            above_size = max_compressed_size(rleinc_base, nametable, row - 1) if row > 1 else None
-            below_size = max_compressed_size(rleinc_base, nametable, row + 1) if row < num_rows - 1 else None
-            if above_size < best_size and above_size <= below_size:
-                best_size = above_size
-                row = row - 1
-                continue
-            elif below_size < best_size:
-                best_size = below_size
-                row = row + 1
-                continue
-            else:
-                break
-        _, rleinc_base_new = rleinc_compressed(nametable[0:self.NAMETABLE_WIDTH * row], rleinc_base)
-        return [(0, nametable[0:self.NAMETABLE_WIDTH * row]), (rleinc_base_new, nametable[self.NAMETABLE_WIDTH * row:])]
-
-    def split_nametable(self, rleinc_base_and_nametable: List[Tuple[int, List[int]]]) -> List[Tuple[int, List[int]]]:
+    def split_nametable(self, nametable: Sequence[int], rleinc_base: int, compression: str) -> List[Tuple[int, Sequence[int]]]:
         """
-        Split nametable in half.
+        Split nametable rows into the fewest blocks that each compress to at most MAX_COMPRESSED_BLOCK_SIZE,
+        and among those the smallest total compressed size.
+
+        Finds the best split globally, using dynamic programming over the compressed sizes of all row ranges.
+        Each block either continues the RLEINC value of the blocks before it, or starts over from 0.
         
-        :param rleinc_base_and_nametable: List of rleinc_base / nametable pairs
-        :return:                          New list of rleinc_base / nametable pairs
+        :param nametable:   Nametable data, as whole rows
+        :param rleinc_base: RLEINC value at start of nametable
+        :param compression: Name of RLEi encoder in RLEI_COMPRESSORS
+        :return:            List of rleinc_base / nametable pairs
         """
-        rleinc_base, nametable = rleinc_base_and_nametable
-        if len(nametable) <= MAX_COMPRESSED_BLOCK_SIZE:
-            return rleinc_base_and_nametable
-        else:
-            return self.split_nametable_in_half(rleinc_base_and_nametable)
+        indices = [CompressedSizeIndex(nametable, self.NAMETABLE_WIDTH, rleinc_base, compression),
+                   CompressedSizeIndex(nametable, self.NAMETABLE_WIDTH, 0, compression, chain_rleinc=False)]
+        num_rows = indices[0].num_rows
+        # best[b] = (number of blocks, total size, start row of last block, index used) for rows [0, b)
+        best = [None] * (num_rows + 1)
+        best[0] = (0, 0, 0, None)
+        for b in range(1, num_rows + 1):
+            for a in range(b):
+                if best[a] is None:
+                    continue
+                for index in indices:
+                    size = index.size(a, b)
+                    if size is None:
+                        continue
+                    candidate = (best[a][0] + 1, best[a][1] + size, a, index)
+                    if best[b] is None or candidate[0:2] < best[b][0:2]:
+                        best[b] = candidate
+            assert best[b] is not None, f'Nametable row {b - 1} compresses to more than {MAX_COMPRESSED_BLOCK_SIZE} bytes'
+        blocks = []
+        b = num_rows
+        while b > 0:
+            _, _, a, index = best[b]
+            blocks.append((index.rleinc_base(a), index.rows(a, b)))
+            b = a
+        return blocks[::-1]
+
+    @staticmethod
+    def _add_block_header(compressed_nametable, rleinc_base: int) -> ByteArray:
+        length_including_header = (len(compressed_nametable) + 2) & 0xFF
+        compressed_nametable_with_length = array('B', compressed_nametable)
+        # RLEINC value 256 can't be reached by any more RLEINC runs - decoder wraps it to 0 just the same
+        compressed_nametable_with_length.insert(0, rleinc_base & 0xFF)
+        compressed_nametable_with_length.insert(0, length_including_header)
+        return compressed_nametable_with_length
+
+    def split_nametable_streamed(self, nametable: Sequence[int], rleinc_base: int, compression: str,
+                                 max_block_cycles: int) -> List[Tuple[int, Sequence[int]]]:
+        """
+        Split nametable into blocks that CrunchyLib_StreamNametableBlock each uploads within max_block_cycles,
+        decoding to at most MAX_STREAMED_BLOCK_SIZE bytes.
+
+        Blocks may end anywhere within a row. Takes the longest block fitting the budget at each position,
+        found by binary search, which gives the fewest blocks and so the fewest NMIs to stream the nametable.
+        Each block continues the RLEINC value of the blocks before it.
 
-    def nametable_compressed(self) -> ByteArray:
+        :param nametable:        Nametable data
+        :param rleinc_base:      RLEINC value at start of nametable
+        :param compression:      Name of RLEi encoder in RLEI_COMPRESSORS
+        :param max_block_cycles: CPU cycle budget of uploading each block
+        :return:                 List of rleinc_base / nametable pairs
+        """
+        compressor = RLEI_COMPRESSORS[compression]
+        def encoded_block(a: int, b: int) -> Tuple[Optional[ByteArray], int]:
+            encoded, next_rleinc_base = compressor(nametable[a:b], rleinc_base)
+            if len(encoded) > MAX_COMPRESSED_BLOCK_SIZE:
+                return None, next_rleinc_base
+            block = self._add_block_header(encoded, rleinc_base)
+            if stream_nametable_block_cycles(block)[0] > max_block_cycles:
+                return None, next_rleinc_base
+            return block, next_rleinc_base
+        blocks = []
+        a = 0
+        while a < len(nametable):
+            if encoded_block(a, a + 1)[0] is None:
+                raise ValueError(f'A nametable block of a single byte takes more than {max_block_cycles} CPU cycles to stream')
+            # Largest b with a fitting block of [a, b)
+            lo, hi = a + 1, min(a + self.MAX_STREAMED_BLOCK_SIZE, len(nametable))
+            while lo < hi:
+                mid = (lo + hi + 1) // 2
+                if encoded_block(a, mid)[0] is None:
+                    hi = mid - 1
+                else:
+                    lo = mid
+            blocks.append((rleinc_base, nametable[a:lo]))
+            rleinc_base = encoded_block(a, lo)[1]
+            a = lo
+        return blocks
+
+    def nametable_compressed(self, compression: Optional[str] = None) -> ByteArray:
         """
         Get compressed nametable
         
-        :return:          Compressed nametable as byte array
+        :param compression: Name of RLEi encoder in RLEI_COMPRESSORS. Defaults to nametable_compression of builder
+        :return:            Compressed nametable as byte array
         """
-        def add_header(compressed_nametable, rleinc_base: int):
-            length_including_header = (len(compressed_nametable) + 2) & 0xFF
-            compressed_nametable_with_length = array('B', compressed_nametable)
-            compressed_nametable_with_length.insert(0, rleinc_base)
-            compressed_nametable_with_length.insert(0, length_including_header)
-            return compressed_nametable_with_length
+        compression = compression or self.nametable_compression
         nametable = self.nametable()
-        if self.bottom_start_row is not None:
-            # if CHR-banked, start with mandatory split into two
-            nametable_top = nametable[0:self.NAMETABLE_WIDTH * self.bottom_start_row]
-            nametable_bottom = nametable[self.NAMETABLE_WIDTH * self.bottom_start_row:]
-            nametables = [[self.num_common_tile_indices, nametable_top], [self.num_common_tile_indices, nametable_bottom]]
-        else:
-            # One single nametable
-            nametables = [[self.num_common_tile_indices, nametable]]
-        # Keep splitting resulting nametables in half until size matches maximum allowed compressed block size
-        while any([len(rleinc_compressed(nametable, rleinc_base)[0]) > MAX_COMPRESSED_BLOCK_SIZE for rleinc_base, nametable in nametables]):
-            for i, p in enumerate(nametables):
-                rleinc_base = p[0]
-                nametable = p[1]
-                if len(rleinc_compressed(nametable, rleinc_base)[0]) > MAX_COMPRESSED_BLOCK_SIZE:
-                    # split
-                    split_nametables = self.split_nametable(p)
-                    nametables = nametables[0:i] + split_nametables + nametables[i + 1:]
-                    break
-        # Compress final nametables and add header
+        # if CHR-banked, start with mandatory split at each CHR bank switch
+        bounds = [0] + [self.NAMETABLE_WIDTH * row for row in self.split_rows] + [len(nametable)]
+        nametables = [nametable[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+        # Split each nametable into blocks matching maximum allowed compressed block size,
+        # or the cycle budget of streaming one block per NMI
+        blocks = []
+        for nametable in nametables:
+            if self.nametable_block_cycles:
+                blocks += self.split_nametable_streamed(nametable, self.num_common_tile_indices, compression, self.nametable_block_cycles)
+            else:
+                blocks += self.split_nametable(nametable, self.num_common_tile_indices, compression)
+        # Compress final blocks and add header
         nametables_encoded = array('B', [])
-        for rleinc_base, nametable in nametables:
-            nametable_encoded, _ = rleinc_compressed(nametable, rleinc_base)
-            nametables_encoded += add_header(nametable_encoded, rleinc_base)
+        for rleinc_base, nametable in blocks:
+            nametable_encoded, _ = RLEI_COMPRESSORS[compression](nametable, rleinc_base)
+            nametables_encoded += self._add_block_header(nametable_encoded, rleinc_base)
         nametables_encoded += array('B', [0])
         return nametables_encoded
 
@@ -694,36 +1238,53 @@ class ScreenBuilder:
     def oam_compressed(self) -> ByteArray:
         """
         Get a "compressed" version of OAM.
-        Compression consists of a simple ~50% reduction format:
+        Sprites are stored in groups of sprites using the same palette:
         
         Initial byte:
           Bits 7-2: Number of sprites N
           Bits 1-0: Palette of sprites, with bits reversed.
+        Second byte:
+          Number of sprites K re-using a tile, stored after the others
         
-        For each sprite 0..N-1
+        For each sprite 0..N-K-1
           Byte 0: X coordinate of sprite
           Byte 1: Y coordinate of sprite
         
-        Tile index is assumed to start at 0 / 1 and linearly increasing
-        by +1 / +2 for 8x8 / 8x16 sprites respectively.
-        HFlip / VFlip / background priority is not supported.
+        For each sprite N-K..N-1
+          Byte 0: X coordinate of sprite
+          Byte 1: Y coordinate of sprite
+          Byte 2: Bits 7-6: Vertical / horizontal flip, as in OAM attributes
+                  Bits 5-0: Tile number
+        
+        Sprites not re-using a tile each use the next tile number, starting at 0.
+        Tile index is tile number * 1 / 2 for 8x8 / 8x16 sprites respectively.
+        Background priority is not supported.
         
         :return:          Compressed OAM byte array
         """
-        sprites_per_pal = []
-        for p in range(self.NUM_PALETTE_GROUPS_SPR):
-            sprites_per_pal.append([sprite for sprite in self.sprites if sprite.p == (p + self.NUM_PALETTE_GROUPS_BG)])
+        tile_shift = int(self.sprites_8x16)
         encoded_bytes = []
-        tile_index = 0
+        used_tiles = set()
         for p in range(self.NUM_PALETTE_GROUPS_SPR):
-            if sprites_per_pal[p]:
-                encoded_bytes.append((len(sprites_per_pal[p]) << 2) | ((p & 0x1) << 1) | ((p & 0x2) >> 1))
-                for sprite in sprites_per_pal[p]:
-                    assert sprite.p == p + ScreenBuilder.NUM_PALETTE_GROUPS_BG
-                    assert not sprite.H and not sprite.V
-                    assert sprite.i == tile_index
+            new_tile_sprites = []
+            reusing_sprites = []
+            for sprite in self.sprites:
+                if sprite.p == p + self.NUM_PALETTE_GROUPS_BG:
+                    if sprite.i in used_tiles:
+                        reusing_sprites.append(sprite)
+                    else:
+                        assert not sprite.H and not sprite.V
+                        assert sprite.i >> tile_shift == len(used_tiles)
+                        used_tiles.add(sprite.i)
+                        new_tile_sprites.append(sprite)
+            num_sprites = len(new_tile_sprites) + len(reusing_sprites)
+            if num_sprites:
+                encoded_bytes.append((num_sprites << 2) | ((p & 0x1) << 1) | ((p & 0x2) >> 1))
+                encoded_bytes.append(len(reusing_sprites))
+                for sprite in new_tile_sprites:
                     encoded_bytes.extend([sprite.x, sprite.y - 1])
-                    tile_index += 2 if self.sprites_8x16 else 1
+                for sprite in reusing_sprites:
+                    encoded_bytes.extend([sprite.x, sprite.y - 1, (sprite.V << 7) | (sprite.H << 6) | (sprite.i >> tile_shift)])
         # Zero-terminator byte
         encoded_bytes.append(0)
         return array('B', encoded_bytes)
@@ -0,0 +1,258 @@
+from dataclasses import dataclass, field
+from PIL import Image
+import numpy as np
+
+from ScreenBuilder import ScreenBuilder
+from TokumaruCompression import tokumaru_compressed
+from LoadCost import load_picture_cycles, stream_nametable_block_cycles
+from RLEiCompression import nametable_block_sizes
+from Profiling import stage
+from PaletteMapping import palette_mapper
+
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import logging as log
+
+# Data file name, without image index suffix -> ScreenArtifacts attribute holding its contents
+DATA_FILES = {
+    'bg.chr': 'chr_bg',
+    'bg_top.chr': 'chr_bg_top',
+    'bg_bottom.chr': 'chr_bg_bottom',
+    'bg_bottom_nc.chr': 'chr_bg_bottom_no_common',
+    'spr.chr': 'chr_spr',
+    'nametable.nam': 'nametable',
+    'nametable_compressed.bin': 'nametable_compressed',
+    'oam.bin': 'oam',
+    'oam_compressed.bin': 'oam_compressed',
+    'palettes.bin': 'palettes',
+    'bg_top.tc': 'chr_bg_top_compressed',
+    'bg_bottom_nc.tc': 'chr_bg_bottom_no_common_compressed',
+    'spr.tc': 'chr_spr_compressed',
+}
+
+
+def map_palette_to_PPU_colors(rgb_palette_image: Sequence[int], rgb_palette_nes: Sequence[int], metric: str = 'rgb') -> Tuple[List[int], List[int]]:
+    """
+    Map the first 32 colors of an image palette to the closest PPU colors
+    
+    :param rgb_palette_image: Linearized RGB palette of image
+    :param rgb_palette_nes:   NES color palette as linearized 64*RGB values
+    :param metric:            Name of color distance metric in PALETTE_METRICS
+    :return:                  Background and sprite palettes of 16 PPU colors each
+    """
+    colors = np.frombuffer(bytes(rgb_palette_image[0:3 * 32]), dtype=np.uint8).reshape(-1, 3)
+    nes_palette_colors = palette_mapper(bytes(rgb_palette_nes), metric).map_colors(colors).tolist()
+    bg_palette = nes_palette_colors[0:16]
+    spr_palette = nes_palette_colors[16:]
+    return bg_palette, spr_palette
+
+
+def get_image_palette(image: Image) -> List[int]:
+    """
+    Reads the palette from an indexed PIL image and pads it with zeros
+    to yield 256*3 = 768 bytes.
+    
+    This function is a work-around for PIL / Pillow's handling
+    of truncated palettes, which append the palette index rather
+    than black.
+    
+    :param image: Indexed image to get palette from
+    :return:      Zero-padded palette with exactly 768 byte values
+    """
+    imagePaletteLength = len(image.palette.palette)
+    imagePalette = image.getpalette()[0:imagePaletteLength]
+    numFillerBytes = 768 - imagePaletteLength
+    if numFillerBytes > 0:
+        imagePalette += [0] * numFillerBytes
+    return imagePalette
+
+
+@dataclass
+class PictureTables:
+    """
+    Per-picture values for the data tables in includes.inc
+    """
+    num_background_tiles_top: int
+    num_background_tiles_bottom: int
+    num_background_tiles_common: int
+    num_sprite_tiles: int
+    oam_size: int
+    sprite_tiles_start_index: int
+    sprite_tiles_start_page: int
+    bottom_start_row: Optional[int]
+    num_shared_background_tiles: int = 0
+    split_rows: List[int] = field(default_factory=list)         # Start row of each CHR bank section after the top one
+    split_chr_offsets: List[int] = field(default_factory=list)  # Offset in compressed bottom CHR of each section after the top one
+    load_cycles: Dict[str, int] = field(default_factory=dict)   # Estimated CPU cycles of each step of CrunchyLib_LoadPicture
+    nametable_block_sizes: List[int] = field(default_factory=list)  # Decompressed size of each nametable block, if streamed
+
+    @classmethod
+    def from_builder(cls, builder: ScreenBuilder, split_chr_offsets: Optional[List[int]] = None) -> 'PictureTables':
+        return cls(num_background_tiles_top=len(builder.tile_table_bg_top),
+                   num_background_tiles_bottom=len(builder.tile_table_bg_bottom),
+                   num_background_tiles_common=builder.num_common_tile_indices,
+                   num_sprite_tiles=len(builder.tile_table_spr),
+                   oam_size=len(builder.oam()),
+                   sprite_tiles_start_index=builder.sprite_tiles_start_index,
+                   sprite_tiles_start_page=builder.sprite_tiles_start_page,
+                   bottom_start_row=builder.bottom_start_row,
+                   num_shared_background_tiles=builder.num_shared_tiles,
+                   split_rows=list(builder.split_rows),
+                   split_chr_offsets=split_chr_offsets or [])
+
+
+@dataclass
+class BuildOptions:
+    """
+    Settings for converting an image, matching the CrunchyBuild command line options
+    """
+    nes_palette: Optional[bytes] = None                     # NES color palette as 64 RGB values. If present, PPU colors are mapped from the image palette
+    bg_palette: List[int] = field(default_factory=list)     # NES PPU palette values for background palette. Unused if nes_palette is present
+    spr_palette: List[int] = field(default_factory=list)    # NES PPU palette values for sprites palette. Unused if nes_palette is present
+    sprite_size_8x16: bool = True                           # If true, use 8x16 sprites
+    sprite0: bool = True                                    # If true, generate dummy sprite in top-right corner to ensure sprite#0 hit
+    max_bg_slots: int = 256                                 # Maximum number of background tile slots
+    nametable_compression: str = 'greedy'                   # Name of RLEi encoder to compress nametable with
+    shared_tiles: Optional[Sequence[bytes]] = None          # Background tiles shared between pictures
+    palette_metric: str = 'rgb'                             # Name of color distance metric in PALETTE_METRICS for mapping PPU colors
+    chr_split_objective: str = 'cpu_time'                   # Name of objective in CHR_SPLIT_OBJECTIVES for choosing CHR bank switches
+    sprite_packing: str = 'grid'                            # Name of method in SPRITE_PACKINGS for placing sprites
+    merge_tiles_max_error: int = 0                          # If non-zero, merge similar background tiles differing in up to this many bits to avoid a CHR split
+    nametable_block_cycles: int = 0                         # If non-zero, split nametable into blocks each streamed within this many CPU cycles
+
+
+@dataclass
+class ScreenArtifacts:
+    """
+    Data of a converted picture, as written to the data files of CrunchyBuild
+    """
+    chr_bg: bytes
+    chr_bg_top: bytes
+    chr_bg_bottom: bytes
+    chr_bg_bottom_no_common: bytes
+    chr_spr: bytes
+    nametable: bytes
+    nametable_compressed: bytes
+    oam: bytes
+    oam_compressed: bytes
+    palettes: bytes
+    chr_bg_top_compressed: bytes            # Without any shared background tiles
+    chr_bg_bottom_no_common_compressed: bytes   # One stream for each CHR bank section after the top one
+    chr_spr_compressed: bytes
+    tables: PictureTables
+
+    def data_files(self) -> Dict[str, bytes]:
+        """
+        :return: Data file name, without image index suffix -> file contents
+        """
+        return {name: getattr(self, attribute) for name, attribute in DATA_FILES.items()}
+
+
+def indexed_image(image: Union[Image.Image, np.ndarray], palette: Optional[Sequence[int]] = None) -> Image.Image:
+    """
+    :param image:   Indexed-color PIL image, or 2-dimensional array of palette indices
+    :param palette: Linearized RGB palette for an array of palette indices
+    :return:        Indexed-color PIL image
+    """
+    if isinstance(image, Image.Image):
+        return image
+    pixels = np.ascontiguousarray(image, dtype=np.uint8)
+    if pixels.ndim != 2:
+        raise ValueError(f'Expected 2-dimensional array of palette indices, got shape {pixels.shape}')
+    height, width = pixels.shape
+    image = Image.frombytes('P', (width, height), pixels.tobytes())
+    if palette is not None:
+        image.putpalette(list(palette))
+    return image
+
+
+def build_screen(image: Union[Image.Image, np.ndarray],
+                 options: Optional[BuildOptions] = None,
+                 palette: Optional[Sequence[int]] = None) -> ScreenArtifacts:
+    """
+    Convert an image to NES data, without touching the file system.
+
+    :param image:   Indexed-color PIL image, or 2-dimensional array of palette indices
+    :param options: Conversion settings, or None for defaults
+    :param palette: Linearized RGB palette for an array of palette indices.
+                    Only needed for mapping PPU colors with options.nes_palette
+    :return:        Converted data
+    """
+    options = options or BuildOptions()
+    image = indexed_image(image, palette)
+    if image.mode != 'P':
+        log.error('Image is not an indexed-color image.')
+    bg_palette, spr_palette = options.bg_palette, options.spr_palette
+    if options.nes_palette is not None:
+        with stage('palette_mapping'):
+            bg_palette, spr_palette = map_palette_to_PPU_colors(get_image_palette(image), options.nes_palette, options.palette_metric)
+    if not spr_palette:
+        spr_palette = [bg_palette[0]] * 16
+    # Color 0 of sprite palette 0 is written last to $3F10, which mirrors the background color at $3F00
+    spr_palette = [bg_palette[0]] + list(spr_palette[1:])
+    builder = ScreenBuilder(image, options.sprite_size_8x16, options.sprite0, options.max_bg_slots, options.nametable_compression,
+                            options.chr_split_objective, options.sprite_packing, options.merge_tiles_max_error,
+                            options.nametable_block_cycles)
+    if options.shared_tiles and builder.bottom_start_row is None:
+        builder.use_shared_tiles(options.shared_tiles)
+    with stage('nametable_compressed'):
+        nametable_compressed = builder.nametable_compressed().tobytes()
+    if options.nametable_compression != 'greedy':
+        greedy_size = len(builder.nametable_compressed('greedy'))
+        log.info(f'Compressed nametable: {len(nametable_compressed)} bytes with {options.nametable_compression} encoding, '
+                 f'{greedy_size} bytes with greedy encoding ({greedy_size - len(nametable_compressed)} bytes saved)')
+    with stage('oam_compressed'):
+        oam_compressed = builder.oam_compressed().tobytes()
+    # Compress CHR
+    chr_bg_top = builder.chr_bg_top_unshared().tobytes()
+    chr_bg_bottom_nc = builder.chr_bg_bottom_no_common().tobytes()
+    chr_spr = builder.chr_spr().tobytes()
+    with stage('chr_compression'):
+        chr_bg_top_compressed = tokumaru_compressed(chr_bg_top)
+        # Each CHR bank section after the top one is a separate stream, uploaded to its own bank
+        chr_sections = [chr_section.tobytes() for chr_section in builder.chr_bg_sections_no_common()] or [chr_bg_bottom_nc]
+        chr_sections_compressed = [tokumaru_compressed(chr_section) for chr_section in chr_sections]
+        split_chr_offsets = []
+        chr_bg_bottom_nc_compressed = b''
+        for chr_section_compressed in chr_sections_compressed:
+            split_chr_offsets.append(len(chr_bg_bottom_nc_compressed))
+            chr_bg_bottom_nc_compressed += chr_section_compressed
+        chr_spr_compressed = tokumaru_compressed(chr_spr)
+    # Log compression ratio
+    uncompressed_size = len(chr_bg_top) + len(chr_bg_bottom_nc) + len(chr_spr)
+    compressed_size = len(chr_bg_top_compressed) + len(chr_bg_bottom_nc_compressed) + len(chr_spr_compressed)
+    space_saving = 1.0 - compressed_size / uncompressed_size
+    log.info(f'CHR size % of original: {100.0 * (1.0 - space_saving):.2f}%')
+    log.info(f'CHR space saving %: {100.0 * space_saving:.2f}%')
+    tables = PictureTables.from_builder(builder, split_chr_offsets[1:])
+    if options.nametable_block_cycles:
+        tables.nametable_block_sizes = nametable_block_sizes(nametable_compressed)
+        block_cycles = []
+        pos = 0
+        while nametable_compressed[pos] != 0:
+            cycles, pos = stream_nametable_block_cycles(nametable_compressed, pos)
+            block_cycles.append(cycles)
+        log.info(f'Streamed nametable: {len(block_cycles)} blocks, up to {max(block_cycles)} CPU cycles per block')
+    with stage('load_cost'):
+        tables.load_cycles = load_picture_cycles(chr_bg_top_compressed,
+                                                 chr_sections_compressed if tables.num_background_tiles_bottom else [],
+                                                 chr_spr_compressed,
+                                                 nametable_compressed,
+                                                 oam_compressed,
+                                                 (tables.num_background_tiles_common + 15) // 16,
+                                                 tables.num_sprite_tiles,
+                                                 options.sprite_size_8x16)
+    return ScreenArtifacts(chr_bg=builder.chr_bg().tobytes(),
+                           chr_bg_top=builder.chr_bg_top().tobytes(),
+                           chr_bg_bottom=builder.chr_bg_bottom().tobytes(),
+                           chr_bg_bottom_no_common=chr_bg_bottom_nc,
+                           chr_spr=chr_spr,
+                           nametable=builder.nametable().tobytes(),
+                           nametable_compressed=nametable_compressed,
+                           oam=builder.oam().tobytes(),
+                           oam_compressed=oam_compressed,
+                           palettes=bytes(bg_palette + spr_palette),
+                           chr_bg_top_compressed=chr_bg_top_compressed,
+                           chr_bg_bottom_no_common_compressed=chr_bg_bottom_nc_compressed,
+                           chr_spr_compressed=chr_spr_compressed,
+                           tables=tables)
@@ -0,0 +1,302 @@
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from PictureRendering import BG_PATTERN_TABLE, NUM_OAM_ENTRIES, chr_banks, oam_decompressed
+from RLEiCompression import nametable_decompressed
+from ScreenConversion import PictureTables
+
+NAMETABLE_ADDRESS = 0x2000
+NAMETABLE_SIZE = 1024
+NUM_NAMETABLE_TILES = 960
+PALETTES_ADDRESS = 0x3F00
+OAM_ADDRESS = 0x8000            # Pseudo address of CRUNCHY_SPRITE_PAGE in runs. Bit7 of the high byte marks a run of OAM
+MAX_RUN_LENGTH = 255
+# Largest chunk including its terminating zero, keeping CrunchyLib_ApplyDeltaChunk's indexing byte-sized
+MAX_CHUNK_SIZE = 255
+HIDDEN_SPRITE_Y = 0xEF          # Sprites with a Y-coordinate from this value are below the picture
+
+# CPU cycles of CrunchyLib_ApplyDeltaChunk, including its JSR and RTS: fixed cycles, and cycles of each run and each byte in a run.
+# As the address of the data isn't known when building, each read of the data counts the cycle of crossing a page
+_CHUNK_CYCLES = 87
+_CHR_RUN_CYCLES = 45
+_NAMETABLE_RUN_CYCLES = 51
+_PALETTES_RUN_CYCLES = 49
+_PPU_BYTE_CYCLES = 17
+_OAM_RUN_CYCLES = 38
+_OAM_BYTE_CYCLES = 24
+
+
+@dataclass
+class PictureState:
+    """
+    PPU and OAM memory of a displayed picture. Only the CHR bank of the top section is included,
+    as pictures of a sequence don't have mid-frame CHR bank switches.
+    """
+    chr: bytearray          # 8 KiB of CHR
+    nametable: bytearray    # Nametable, including attribute table
+    palettes: bytearray     # Background and sprite palettes of 16 PPU colors each
+    oam: bytearray          # 256 bytes of OAM
+
+    def copy(self) -> 'PictureState':
+        return PictureState(bytearray(self.chr), bytearray(self.nametable), bytearray(self.palettes), bytearray(self.oam))
+
+
+def loaded_picture_state(tables: PictureTables, data: Dict[str, bytes], sprite_size_8x16: bool) -> PictureState:
+    """
+    Get the memory of a picture loaded by CrunchyLib_LoadPicture from its included data
+
+    :param tables:           Table values of picture
+    :param data:             Data file name, without image index suffix -> file contents, for the included data files
+    :param sprite_size_8x16: If true, sprites are 8x16
+    :return:                 Memory of picture
+    """
+    if tables.split_rows:
+        raise ValueError(f'Picture needs {len(tables.split_rows) + 1} CHR bank sections, but pictures of a sequence must fit in one')
+    banks = chr_banks(tables, data['bg_top.tc'], data['bg_bottom_nc.tc'], data['spr.tc'])
+    oam = oam_decompressed(data['oam_compressed.bin'], tables.oam_size, tables.sprite_tiles_start_index, sprite_size_8x16)
+    return PictureState(banks[0], bytearray(nametable_decompressed(data['nametable_compressed.bin']).tobytes()),
+                        bytearray(data['palettes.bin']), bytearray(oam))
+
+
+@dataclass
+class DeltaFrame:
+    chunks: List[bytes] = field(default_factory=list)           # Runs of each chunk, without terminating zero
+    chunk_cycles: List[int] = field(default_factory=list)       # CPU cycles of CrunchyLib_ApplyDeltaChunk applying each chunk
+    num_new_background_tiles: int = 0
+    num_new_sprite_tiles: int = 0
+
+    def data(self) -> bytes:
+        return b''.join(chunk + b'\0' for chunk in self.chunks) + b'\0'
+
+
+def run_cycles(address: int) -> Tuple[int, int]:
+    """
+    :param address: Address of run, OAM_ADDRESS + offset for a run of OAM
+    :return:        CPU cycles taken by CrunchyLib_ApplyDeltaChunk for the run, and for each byte of it
+    """
+    if address >= OAM_ADDRESS:
+        return _OAM_RUN_CYCLES, _OAM_BYTE_CYCLES
+    if address < NAMETABLE_ADDRESS:
+        return _CHR_RUN_CYCLES, _PPU_BYTE_CYCLES
+    if address < NAMETABLE_ADDRESS + NAMETABLE_SIZE:
+        return _NAMETABLE_RUN_CYCLES, _PPU_BYTE_CYCLES
+    return _PALETTES_RUN_CYCLES, _PPU_BYTE_CYCLES
+
+
+def write_run(state: PictureState, address: int, data: bytes):
+    """
+    Write a run to memory the way CrunchyLib_ApplyDeltaChunk does
+
+    :param state:   Memory to write to
+    :param address: Address of run, with nametable addresses relative to the keyframe's nametable at $2000
+    :param data:    Bytes of run
+    """
+    for a, value in enumerate(data, address):
+        if a >= OAM_ADDRESS:
+            state.oam[a - OAM_ADDRESS] = value
+        elif a < NAMETABLE_ADDRESS:
+            state.chr[a] = value
+        elif a < NAMETABLE_ADDRESS + NAMETABLE_SIZE:
+            state.nametable[a - NAMETABLE_ADDRESS] = value
+        else:
+            # Color 0 of each sprite palette mirrors that of the background palette
+            k = (a - PALETTES_ADDRESS) & 0x1F
+            state.palettes[k] = value
+            if k % 4 == 0:
+                state.palettes[k ^ 0x10] = value
+
+
+def apply_delta_frame(state: PictureState, data: bytes, pos: int = 0) -> int:
+    """
+    Apply all chunks of a delta frame, mirroring CrunchyLib_ApplyDeltaChunk
+
+    :param state: Memory to apply delta frame to
+    :param data:  Data of delta frames
+    :param pos:   Position of delta frame in data
+    :return:      Position of next delta frame in data
+    """
+    while True:
+        while data[pos] != 0:
+            length, address = data[pos], (data[pos + 1] << 8) | data[pos + 2]
+            write_run(state, address, data[pos + 3:pos + 3 + length])
+            pos += 3 + length
+        pos += 1
+        if data[pos] == 0:
+            return pos + 1
+
+
+def changed_runs(old: bytes, new: bytes, address: int, indices: Optional[Iterable[int]] = None) -> List[Tuple[int, bytes]]:
+    """
+    Find runs of bytes to write to change memory contents, including unchanged bytes between runs
+    when writing them takes fewer cycles than starting another run
+
+    :param old:     Current memory contents
+    :param new:     New memory contents
+    :param address: Address of memory
+    :param indices: Indices of bytes to compare, or None for all of them
+    :return:        Address and bytes of each run
+    """
+    run, byte = run_cycles(address)
+    max_gap = run // byte
+    changed = [i for i in (range(len(new)) if indices is None else indices) if old[i] != new[i]]
+    runs = []
+    start = end = None
+    for i in changed:
+        if start is None or i - end > max_gap + 1 or i - start >= MAX_RUN_LENGTH:
+            if start is not None:
+                runs.append((address + start, bytes(new[start:end])))
+            start = i
+        end = i + 1
+    if start is not None:
+        runs.append((address + start, bytes(new[start:end])))
+    return runs
+
+
+def delta_chunks(runs: Sequence[Tuple[int, bytes]], vblank_cycles: int) -> Tuple[List[bytes], List[int]]:
+    """
+    Split runs into chunks, each applied by CrunchyLib_ApplyDeltaChunk within a cycle budget.
+    Runs not fitting in the rest of a chunk are split between chunks.
+
+    :param runs:          Address and bytes of each run, in order of application
+    :param vblank_cycles: Budget of CPU cycles for applying each chunk
+    :return:              Data of each chunk without terminating zero, and its CPU cycles
+    """
+    chunks, chunk_cycles = [], []
+    chunk, cycles = bytearray(), _CHUNK_CYCLES
+    for address, data in runs:
+        while data:
+            run, byte = run_cycles(address)
+            length = min(len(data), MAX_RUN_LENGTH, (vblank_cycles - cycles - run) // byte, MAX_CHUNK_SIZE - 1 - 3 - len(chunk))
+            if length < 1:
+                if not chunk:
+                    raise ValueError(f'Budget of {vblank_cycles} cycles is too small to apply a single byte of a delta frame')
+                chunks.append(bytes(chunk))
+                chunk_cycles.append(cycles)
+                chunk, cycles = bytearray(), _CHUNK_CYCLES
+                continue
+            chunk += bytes([length, address >> 8, address & 0xFF]) + data[:length]
+            cycles += run + length * byte
+            address += length
+            data = data[length:]
+    chunks.append(bytes(chunk))
+    chunk_cycles.append(cycles)
+    return chunks, chunk_cycles
+
+
+def _allocate_slots(state: PictureState,
+                    tiles: Dict[bytes, None],
+                    slot_address,
+                    slots: Sequence[int],
+                    visible: Set[int],
+                    known: Set[int]) -> Tuple[Dict[bytes, int], List[Tuple[int, bytes]]]:
+    """
+    Assign a pattern table slot to each tile, reusing resident tiles.
+    New tiles only replace tiles not visible in the currently displayed picture.
+
+    :param state:        Current memory
+    :param tiles:        Tiles to assign slots to
+    :param slot_address: Function returning PPU address of a slot
+    :param slots:        Slots available to the sequence, in order of preference for new tiles
+    :param visible:      Slots used by the currently displayed picture
+    :param known:        Slots with known contents. Updated with slots of new tiles
+    :return:             Slot of each tile, and slot and tile of each new tile
+    """
+    size = len(next(iter(tiles), b''))
+    resident = {}
+    for slot in sorted(known, reverse=True):
+        resident[bytes(state.chr[slot_address(slot):slot_address(slot) + size])] = slot
+    assigned = {tile: resident[tile] for tile in tiles if tile in resident}
+    used = set(assigned.values())
+    free = [slot for slot in slots if slot not in visible and slot not in used]
+    new_tiles = [tile for tile in tiles if tile not in assigned]
+    if len(new_tiles) > len(free):
+        raise ValueError(f'{len(new_tiles)} new tiles need more than the {len(free)} free slots not displayed by the previous picture')
+    for slot, tile in zip(free, new_tiles):
+        assigned[tile] = slot
+        known.add(slot)
+    return assigned, list(zip(free, new_tiles))
+
+
+def sequence_deltas(states: Sequence[PictureState],
+                    sprite_size_8x16: bool,
+                    background_slots: Sequence[int],
+                    sprite_slots: Sequence[int],
+                    vblank_cycles: int) -> List[DeltaFrame]:
+    """
+    Encode the changes from each picture of a sequence to the next one, ending with the change from the last picture
+    back to the first one to allow looping.
+
+    Tiles are placed in slots not used by the displayed picture, and each slot holds a tile for as long as it's used.
+    Nametable, palette and OAM changes are encoded as runs of changed bytes, after the new tiles.
+
+    :param states:           Memory of each picture as loaded by CrunchyLib_LoadPicture
+    :param sprite_size_8x16: If true, sprites are 8x16
+    :param background_slots: Background pattern table slots available to the sequence, in order of preference for new tiles
+    :param sprite_slots:     Sprite pattern table slots available to the sequence, in units of the sprite size,
+                             in order of preference for new tiles
+    :param vblank_cycles:    Budget of CPU cycles for applying each chunk of a delta frame
+    :return:                 Delta frame to each following picture
+    """
+    tile_size = 32 if sprite_size_8x16 else 16
+    tile_shift = int(sprite_size_8x16)
+
+    def bg_address(slot):
+        return BG_PATTERN_TABLE + 16 * slot
+
+    def spr_address(slot):
+        return tile_size * slot
+
+    def bg_tiles(s: PictureState) -> List[bytes]:
+        return [bytes(s.chr[bg_address(i):bg_address(i) + 16]) for i in s.nametable[0:NUM_NAMETABLE_TILES]]
+
+    def visible_sprites(s: PictureState) -> List[int]:
+        # Entry 0 is sprite#0, using a fixed tile written by CrunchyLib_WriteSprite0ToOAM
+        return [e for e in range(1, NUM_OAM_ENTRIES) if s.oam[4 * e] < HIDDEN_SPRITE_Y]
+
+    def spr_tile(s: PictureState, e: int) -> bytes:
+        slot = s.oam[4 * e + 1] >> tile_shift
+        return bytes(s.chr[spr_address(slot):spr_address(slot) + tile_size])
+
+    state = states[0].copy()
+    known_bg = set(state.nametable[0:NUM_NAMETABLE_TILES])
+    known_spr = set(state.oam[4 * e + 1] >> tile_shift for e in visible_sprites(state))
+    sprite0_slot = state.oam[1] >> tile_shift
+    frames = []
+    for index, target in list(enumerate(states))[1:] + [(0, states[0])]:
+        frame = DeltaFrame()
+        try:
+            bg_slots, new_bg = _allocate_slots(state, dict.fromkeys(bg_tiles(target)), bg_address, background_slots,
+                                               set(state.nametable[0:NUM_NAMETABLE_TILES]), known_bg)
+            spr_slots, new_spr = _allocate_slots(state, dict.fromkeys(spr_tile(target, e) for e in visible_sprites(target)), spr_address,
+                                                 sprite_slots, set(state.oam[4 * e + 1] >> tile_shift for e in visible_sprites(state)),
+                                                 known_spr)
+        except ValueError as e:
+            raise ValueError(f'Picture {index} of sequence: {e}')
+        frame.num_new_background_tiles, frame.num_new_sprite_tiles = len(new_bg), len(new_spr)
+        # New tiles, written as whole tiles as the rest of the pattern tables has unknown contents
+        new_chr = sorted([(bg_address(slot), tile) for slot, tile in new_bg] + [(spr_address(slot), tile) for slot, tile in new_spr])
+        sprite0_address = spr_address(sprite0_slot)
+        runs = changed_runs(state.chr[sprite0_address:sprite0_address + tile_size],
+                            target.chr[sprite0_address:sprite0_address + tile_size], sprite0_address)
+        for address, tile in new_chr:
+            if runs and runs[-1][0] + len(runs[-1][1]) == address and len(runs[-1][1]) + len(tile) <= MAX_RUN_LENGTH:
+                runs[-1] = (runs[-1][0], runs[-1][1] + tile)
+            else:
+                runs.append((address, tile))
+        # Nametable, referencing the tile slots
+        nametable = bytearray(target.nametable)
+        nametable[0:NUM_NAMETABLE_TILES] = bytes(bg_slots[tile] for tile in bg_tiles(target))
+        runs += changed_runs(state.nametable, nametable, NAMETABLE_ADDRESS)
+        # Palettes. Color 0 of palettes other than the first one is never displayed.
+        # The backdrop color is written to $3F00, mirrored at $3F10
+        runs += changed_runs(state.palettes, target.palettes, PALETTES_ADDRESS, [k for k in range(32) if k == 0 or k % 4 != 0])
+        # OAM, referencing the tile slots
+        oam = bytearray(target.oam)
+        for e in visible_sprites(target):
+            oam[4 * e + 1] = spr_slots[spr_tile(target, e)] << tile_shift
+        runs += changed_runs(state.oam, oam, OAM_ADDRESS)
+        frame.chunks, frame.chunk_cycles = delta_chunks(runs, vblank_cycles)
+        for address, data in runs:
+            write_run(state, address, data)
+        frames.append(frame)
+    return frames
@@ -0,0 +1,33 @@
+from typing import Dict, List, Optional, Sequence
+
+
+def shared_tile_dictionary(tile_lists: Sequence[Optional[Sequence[bytes]]], max_tiles: int) -> List[bytes]:
+    """
+    Choose background tiles to share between pictures.
+
+    Shared tiles occupy the same tile indices in every sharing picture, whether the picture uses
+    them or not. Tiles used by the most pictures are picked first, and a tile is only picked if
+    every picture can still fit its own tiles after the shared ones.
+
+    :param tile_lists: Background tiles of each picture, or None for pictures not sharing tiles
+    :param max_tiles:  Number of background tile slots available to each picture
+    :return:           Shared tiles, in tile index order
+    """
+    tile_sets = [set(tiles) for tiles in tile_lists if tiles is not None]
+    # Number of pictures using each tile, in order of first use
+    usage: Dict[bytes, int] = {}
+    for tiles in tile_lists:
+        if tiles is not None:
+            for tile_data in dict.fromkeys(tiles):
+                usage[tile_data] = usage.get(tile_data, 0) + 1
+    candidates = sorted((tile_data for tile_data, count in usage.items() if count > 1), key=lambda tile_data: -usage[tile_data])
+    num_own_tiles = [len(tile_set) for tile_set in tile_sets]
+    shared_tiles = []
+    for tile_data in candidates:
+        uses = [tile_data in tile_set for tile_set in tile_sets]
+        # Pictures using the tile move it to the shared tiles, the others need a slot for it.
+        # Every picture keeps at least one tile of its own, as zero tiles can't be uploaded
+        if all(len(shared_tiles) + 1 + max(num_own - used, 1) <= max_tiles for num_own, used in zip(num_own_tiles, uses)):
+            shared_tiles.append(tile_data)
+            num_own_tiles = [num_own - used for num_own, used in zip(num_own_tiles, uses)]
+    return shared_tiles
@@ -0,0 +1,296 @@
+import numpy as np
+
+from typing import Tuple, List
+
+TILE_SIZE = 16
+NUM_COLORS = 4
+MAX_TILES = 256
+
+
+class BitWriter:
+    """
+    Writes bits MSB-first into bytes, matching the decompressor's ReadBit
+    """
+    def __init__(self):
+        self.data = bytearray()
+        self.bit = 0
+
+    def write(self, value: int, num_bits: int = 1):
+        for i in range(num_bits - 1, -1, -1):
+            if self.bit == 0:
+                self.data.append(0)
+            if (value >> i) & 1:
+                self.data[-1] |= 0x80 >> self.bit
+            self.bit = (self.bit + 1) & 7
+
+
+class BitReader:
+    """
+    Reads bits MSB-first from bytes, matching the decompressor's ReadBit
+    """
+    def __init__(self, data: bytes, pos: int):
+        self.data = data
+        self.pos = pos
+        self.bit = 8
+
+    def read(self, num_bits: int = 1) -> int:
+        value = 0
+        for i in range(num_bits):
+            if self.bit == 8:
+                if self.pos >= len(self.data):
+                    raise ValueError('Tokumaru stream ended prematurely')
+                self.pos += 1
+                self.bit = 0
+            value = (value << 1) | ((self.data[self.pos - 1] >> (7 - self.bit)) & 1)
+            self.bit += 1
+        return value
+
+
+def _tile_colors(chr_data: bytes) -> np.ndarray:
+    """
+    :param chr_data: Linear 2bpp NES CHR data
+    :return:         (num_tiles, 8, 8) array of pixel colors
+    """
+    tiles = np.frombuffer(bytes(chr_data), dtype=np.uint8).reshape(-1, 2, 8)
+    bits = np.unpackbits(tiles[..., None], axis=-1)
+    return bits[:, 0] | (bits[:, 1] << 1)
+
+
+def _specified_code_length(follower: np.ndarray, color: np.ndarray) -> np.ndarray:
+    """
+    Bits needed to specify a color other than the current one: 1 for the lowest such color, 2 otherwise
+    """
+    return np.where(follower == np.where(color == 0, 1, 0), 1, 2)
+
+
+def _block_sizes(transitions: np.ndarray) -> np.ndarray:
+    """
+    Size in bits of block header plus all pixel transitions for a number of candidate blocks.
+
+    :param transitions: (..., 4, 4) array counting how often color a is followed by color b in new rows
+    :return:            (...) array of sizes in bits
+    """
+    diag = np.eye(NUM_COLORS, dtype=bool)
+    color = np.arange(NUM_COLORS)
+    off = np.where(diag, 0, transitions)
+    same = transitions[..., color, color]
+    total = off.sum(axis=-1)
+    most = off.max(axis=-1)
+    num_followers = (off > 0).sum(axis=-1)
+    pixel_bits = np.select([num_followers == 1, num_followers == 2, num_followers == 3],
+                           [same + total, same + 2 * total, same + 2 * most + 3 * (total - most)],
+                           0)
+    # Two-follower lists are specified by the one color left out
+    excluded = np.argmax((off == 0) & ~diag, axis=-1)
+    specified = np.where(num_followers == 2, excluded, np.argmax(off, axis=-1))
+    header_bits = 2 + np.where(num_followers > 0, _specified_code_length(specified, color), 0)
+    return (pixel_bits + header_bits).sum(axis=-1)
+
+
+def _block_partition(colors: np.ndarray) -> List[int]:
+    """
+    Find optimal start tiles of blocks using dynamic programming over block boundaries
+
+    :param colors: (num_tiles, 8, 8) array of pixel colors
+    :return:       Sorted list of tile indices starting a new block
+    """
+    num_tiles = len(colors)
+    # Repeated rows cost 1 bit. New rows cost 1 + 2 bits, plus their pixel transitions
+    new_rows = np.ones((num_tiles, 8), dtype=bool)
+    new_rows[:, 1:] = (colors[:, 1:] != colors[:, :-1]).any(axis=-1)
+    row0_new_in_block = np.ones(num_tiles, dtype=bool)
+    row0_new_in_block[1:] = (colors[1:, 0] != colors[:-1, 7]).any(axis=-1)
+    row0_new_at_start = colors[:, 0].any(axis=-1)
+    pairs = (colors[:, :, :-1] * NUM_COLORS + colors[:, :, 1:]).astype(np.intp)
+    offsets = np.arange(num_tiles * 8).reshape(num_tiles, 8, 1) * NUM_COLORS * NUM_COLORS
+    row_transitions = np.bincount((pairs + offsets).ravel(),
+                                  minlength=num_tiles * 8 * NUM_COLORS * NUM_COLORS).reshape(num_tiles, 8, NUM_COLORS, NUM_COLORS)
+    inner_transitions = (row_transitions[:, 1:] * new_rows[:, 1:, None, None]).sum(axis=1)
+    inner_bits = np.where(new_rows[:, 1:], 3, 1).sum(axis=1)
+    # Contribution of each tile when continuing a block (A) or starting a block (B)
+    transitions_a = inner_transitions + row_transitions[:, 0] * row0_new_in_block[:, None, None]
+    transitions_b = inner_transitions + row_transitions[:, 0] * row0_new_at_start[:, None, None]
+    bits_a = inner_bits + np.where(row0_new_in_block, 3, 1)
+    bits_b = inner_bits + np.where(row0_new_at_start, 3, 1)
+    prefix_transitions = np.concatenate([np.zeros((1, NUM_COLORS, NUM_COLORS), dtype=np.int64), np.cumsum(transitions_a, axis=0)])
+    prefix_bits = np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(bits_a)])
+    # best[j] = smallest size of tiles [0, j), with last block starting at start[j]
+    best = np.zeros(num_tiles + 1, dtype=np.int64)
+    start = np.zeros(num_tiles + 1, dtype=np.intp)
+    for j in range(1, num_tiles + 1):
+        transitions = prefix_transitions[j] - prefix_transitions[0:j] - transitions_a[0:j] + transitions_b[0:j]
+        row_bits = prefix_bits[j] - prefix_bits[0:j] - bits_a[0:j] + bits_b[0:j]
+        sizes = best[0:j] + _block_sizes(transitions) + row_bits
+        start[j] = np.argmin(sizes)
+        best[j] = sizes[start[j]]
+    block_starts = []
+    j = num_tiles
+    while j > 0:
+        j = start[j]
+        block_starts.append(int(j))
+    return sorted(block_starts)
+
+
+def _block_header(transitions: np.ndarray) -> Tuple[List[int], List[int], List[List[int]]]:
+    """
+    Choose colors that can follow each color in a block
+
+    :param transitions: (4, 4) array counting how often color a is followed by color b
+    :return:            Per color: Follower count, specified color, and list of next colors
+    """
+    counts = []
+    specified = []
+    next_colors = []
+    for c in range(NUM_COLORS):
+        others = [d for d in range(NUM_COLORS) if d != c]
+        followers = [d for d in others if transitions[c][d] > 0]
+        if len(followers) == 3:
+            first = max(others, key=lambda d: (transitions[c][d], -d))
+            specified.append(first)
+            next_colors.append([first] + [d for d in others if d != first])
+        elif len(followers) == 2:
+            specified.append([d for d in others if d not in followers][0])
+            next_colors.append(followers)
+        else:
+            specified.append(followers[0] if followers else None)
+            next_colors.append(followers)
+        counts.append(len(followers))
+    return counts, specified, next_colors
+
+
+def tokumaru_compressed(chr_data: bytes) -> bytes:
+    """
+    Compress CHR data using Tokumaru compression
+
+    Produces a stream that asm/decompress.asm can decode:
+    [Header byte]
+    1 byte denoting number of tiles. (0 means 256 tiles)
+    [Blocks of tiles, as a bit stream read MSB-first]
+    Block header: For each color 3..0, 2 bits for number of colors that can follow it,
+                  and if non-zero, a 1-2 bit code specifying one of the other colors
+    Per row:      1 bit to repeat previous row, or 0 followed by 2 bits for first pixel
+                  and a 1-3 bit code for each following pixel
+    Per tile:     1 bit to start new block, except after last tile
+
+    Block boundaries are chosen to give the smallest possible stream for this header format.
+
+    See: https://wiki.nesdev.com/w/index.php/Tile_compression#Tokumaru
+
+    :param chr_data: Uncompressed CHR data
+    :return:         Compressed data. Empty if CHR data is empty
+    """
+    assert len(chr_data) % TILE_SIZE == 0, 'CHR data must be whole tiles'
+    num_tiles = len(chr_data) // TILE_SIZE
+    if num_tiles == 0:
+        return b''
+    if num_tiles > MAX_TILES:
+        raise ValueError(f'Tokumaru compression supports at most {MAX_TILES} tiles - got {num_tiles}')
+    colors = _tile_colors(chr_data)
+    block_starts = _block_partition(colors)
+    block_ends = block_starts[1:] + [num_tiles]
+    colors = colors.tolist()
+    w = BitWriter()
+    for start, end in zip(block_starts, block_ends):
+        # Block header
+        transitions = [[0] * NUM_COLORS for c in range(NUM_COLORS)]
+        previous_row = [0] * 8
+        for t in range(start, end):
+            for row in colors[t]:
+                if row != previous_row:
+                    for a, b in zip(row[:-1], row[1:]):
+                        transitions[a][b] += 1
+                previous_row = row
+        counts, specified, next_colors = _block_header(transitions)
+        for c in range(NUM_COLORS - 1, -1, -1):
+            w.write(counts[c], 2)
+            if counts[c]:
+                e = specified[c] + 1 if specified[c] < c else specified[c]
+                if e == 1:
+                    w.write(0b0, 1)
+                else:
+                    w.write(0b10 | (e - 2), 2)
+        # Tiles
+        previous_row = [0] * 8
+        for t in range(start, end):
+            for row in colors[t]:
+                if row == previous_row:
+                    w.write(1)
+                    continue
+                w.write(0)
+                w.write(row[0], 2)
+                for a, b in zip(row[:-1], row[1:]):
+                    if counts[a] == 0:
+                        continue
+                    if a == b:
+                        w.write(1)
+                        continue
+                    w.write(0)
+                    index = next_colors[a].index(b)
+                    if counts[a] == 2:
+                        w.write(index)
+                    elif counts[a] == 3:
+                        w.write([0b0, 0b10, 0b11][index], 1 if index == 0 else 2)
+                previous_row = row
+            if t != num_tiles - 1:
+                w.write(int(t + 1 == end))
+    return bytes([num_tiles & 0xFF]) + bytes(w.data)
+
+
+def tokumaru_decompressed(data: bytes) -> bytes:
+    """
+    Decompress Tokumaru-compressed CHR data, mirroring asm/decompress.asm
+
+    :param data: Compressed data
+    :return:     Uncompressed CHR data
+    """
+    if len(data) == 0:
+        return b''
+    num_tiles = data[0] or MAX_TILES
+    r = BitReader(data, 1)
+    chr_data = bytearray()
+    tile = 0
+    while tile < num_tiles:
+        # Block header
+        counts = [0] * NUM_COLORS
+        next_colors = [[] for c in range(NUM_COLORS)]
+        for c in range(NUM_COLORS - 1, -1, -1):
+            counts[c] = r.read(2)
+            if counts[c] == 0:
+                continue
+            e = 1
+            if r.read():
+                e = 3 if r.read() else 2
+            specified = e if c < e else e - 1
+            others = [d for d in range(NUM_COLORS) if d not in (c, specified)]
+            if counts[c] == 1:
+                next_colors[c] = [specified]
+            elif counts[c] == 2:
+                next_colors[c] = others
+            else:
+                next_colors[c] = [specified] + others
+        plane0 = 0
+        plane1 = 0
+        while True:
+            planes = bytearray(16)
+            for row in range(8):
+                if not r.read():
+                    pixel = r.read(2)
+                    pixels = [pixel]
+                    for x in range(7):
+                        if counts[pixel] != 0 and not r.read():
+                            if counts[pixel] == 1:
+                                pixel = next_colors[pixel][0]
+                            elif counts[pixel] == 2:
+                                pixel = next_colors[pixel][r.read()]
+                            else:
+                                pixel = next_colors[pixel][0 if not r.read() else (2 if r.read() else 1)]
+                        pixels.append(pixel)
+                    plane0 = sum((p & 1) << (7 - x) for x, p in enumerate(pixels))
+                    plane1 = sum(((p >> 1) & 1) << (7 - x) for x, p in enumerate(pixels))
+                planes[row] = plane0
+                planes[row + 8] = plane1
+            chr_data += planes
+            tile += 1
+            if tile == num_tiles or r.read():
+                break
+    return bytes(chr_data)
@@ -1,4 +1,4 @@
-CRUNCHY_VARS_SIZE                       = 14
+CRUNCHY_VARS_SIZE                       = 26
 ; X-scroll coordinate for picture (16 bits)
 CrunchyVar_scrollX                      = CRUNCHY_VARS+0
 ; Y-scroll coordinate for picture (16 bits)
@@ -16,14 +16,30 @@ CrunchyVar_splitR2001                   = CRUNCHY_VARS+7
 CrunchyVar_splitChrBankBitsAndHiX       = CRUNCHY_VARS+8
 ; If bit7=1, sprite#0 hit will be ensured by forcing first two scanlines to not scroll
 CrunchyVar_ensureSprite0Hit             = CRUNCHY_VARS+9
-; Set by loading code to cache Y-coordinate for mid-frame CHR bank-switching
-CrunchyVar_bottomStartScanline          = CRUNCHY_VARS+10
+; Set by loading code to cache Y-coordinates for up to 3 mid-frame CHR bank-switches, 240 for unused switches.
+; Each switch selects the CHR bank following that of the section above it.
+CrunchyVar_splitStartScanlines          = CRUNCHY_VARS+10
+; Y-coordinate of first mid-frame CHR bank-switch
+CrunchyVar_bottomStartScanline          = CrunchyVar_splitStartScanlines
 ; Bits 5-6: First CHR bank used by picture
-CrunchyVar_chrBankBits                  = CRUNCHY_VARS+11
+CrunchyVar_chrBankBits                  = CRUNCHY_VARS+13
 ; Number of scanlines to display picture before bottom split. Must be 3-240
-CrunchyVar_displayScanlines             = CRUNCHY_VARS+12
+CrunchyVar_displayScanlines             = CRUNCHY_VARS+14
 ; Current picture index. Used by loading and OAM write subroutines
-CrunchyVar_pictureIndex                 = CRUNCHY_VARS+13
+CrunchyVar_pictureIndex                 = CRUNCHY_VARS+15
+; Bits 5-6: CHR bank holding shared background CHR. Bit0: Set if shared background CHR is loaded.
+; Must be zero before loading the first picture
+CrunchyVar_sharedChrBankBits            = CRUNCHY_VARS+16
+; Address of the next chunk of sequence delta frames to apply (16 bits)
+CrunchyVar_deltaPtr                     = CRUNCHY_VARS+17
+; Bits 2-3: Nametable of the sequence's keyframe, selecting the nametable written by delta frames
+CrunchyVar_deltaNametableBits           = CRUNCHY_VARS+19
+; Address of the next block of the nametable being streamed (16 bits)
+CrunchyVar_streamDataPtr                = CRUNCHY_VARS+20
+; PPU address of the next block of the nametable being streamed (16 bits)
+CrunchyVar_streamPPUAddress             = CRUNCHY_VARS+22
+; Address of the decoded size of the next block of the nametable being streamed (16 bits)
+CrunchyVar_streamBlockSizesPtr          = CRUNCHY_VARS+24
 
 ;
 ; Executes screen splits prepared by CrunchyLib_Display
@@ -162,7 +178,6 @@ CrunchyLib_DoSplits:
 ;
 CrunchyLib_Display:
     @numScanlinesTop            = CRUNCHY_TEMP+7
-    @numScanlinesBottom         = CRUNCHY_TEMP+8
     @bankBits                   = CRUNCHY_TEMP+10
     @tmp                        = CRUNCHY_TEMP+12
     @numSections                = CRUNCHY_TEMP+13
@@ -187,41 +202,6 @@ CrunchyLib_Display:
     ora #CRUNCHY_PRG_BANK
     ora @HinBit7
     sta @bankBits
-
-    ldx CrunchyVar_pictureIndex
-    lda CrunchyVar_bottomStartScanline
-    cmp #240
-    beq @dontShowBottomScanlines
-    sec
-    sbc CrunchyVar_scrollY
-    sta @tmp
-    ; Bottom number of scanlines
-    tya
-    sec
-    sbc @tmp
-    bcs @showBottomScanlines
-    ; carry clear -> displayScanlines < BottomStartScanlineMinus1
-    ; -> Don't display bottom part
-@dontShowBottomScanlines:
-    lda #0
-@showBottomScanlines:
-    sta @numScanlinesBottom
-    ; For a non-bankswitched image, we always display the full displayScanlines
-    lda CrunchyVar_displayScanlines
-    ldx CrunchyVar_bottomStartScanline
-    cpx #240
-    beq @dontClampTopScanlines
-    ; Top number of scanlines: min(displayScanlines, BottomStartScanline - scrollY)
-    tya
-    lda CrunchyVar_bottomStartScanline
-    sec
-    sbc CrunchyVar_scrollY
-    cmp CrunchyVar_displayScanlines
-    bcc @dontClampTopScanlines
-    lda CrunchyVar_displayScanlines
-@dontClampTopScanlines:
-    ; assert(A > 2)
-    sta @numScanlinesTop
 ;
 ; Prepare sections on stack to be consumed by timed screen-splits, starting from bottom
 ; TODO: Ideally this preparation work would be done outside of the precious vblank period.
@@ -250,28 +230,61 @@ CrunchyLib_Display:
     lda CrunchyVar_splitScrollX
     pha
 @noPartialImageCutOff:
-    ; Conditionally do @bottomScanlines if non-zero
-    ; (this section might not be present if requested display scanlines won't reach it,
+    ; Conditionally do a section for each mid-frame CHR bank switch, from the bottom one up.
+    ; (a section might not be present if requested display scanlines won't reach it,
     ;  or if image already fits in 256 BG tiles)
-    lda @numScanlinesBottom
-    beq @noBottomSection
+    ; Each section ends where the one below it starts, and the bottom one at displayScanlines.
+    ; For a non-bankswitched image, we always display the full displayScanlines
+    lda CrunchyVar_displayScanlines
+    sta @numScanlinesTop
+    ldx #(CRUNCHY_MAX_CHR_SPLITS - 1)
+@splitSectionLoop:
+    lda CrunchyVar_splitStartScanlines,x
+    cmp #240
+    beq @noSplitSection
+    ; Scanline on screen where section starts
+    sec
+    sbc CrunchyVar_scrollY
+    sta @tmp
+    ; Number of scanlines of section
+    lda @numScanlinesTop
+    sec
+    sbc @tmp
+    ; carry clear / zero -> section starts after the end of the section below it
+    ; -> Don't display section
+    bcc @noSplitSection
+    beq @noSplitSection
     iny
+    ; Push number of scanlines
     pha
-     ; Push R2001
+    ; Push R2001
     lda CrunchyVar_R2001
     pha
-    ; Push bank + H bit
-    lda @bankBits
+    ; Push bank + H bit, selecting CHR bank (X + 1) after the top one
+    txa
+    clc
+    adc #1
+    asl
+    asl
+    asl
+    asl
+    asl
     clc
-    adc #(1<<5)
+    adc @bankBits
     pha
     ; Push Y-scroll
-    lda CrunchyVar_bottomStartScanline
+    lda CrunchyVar_splitStartScanlines,x
     pha
     ; Push X-scroll
     lda CrunchyVar_scrollX
     pha
-@noBottomSection:
+    ; Section above ends where this one starts
+    lda @tmp
+    sta @numScanlinesTop
+@noSplitSection:
+    dex
+    bpl @splitSectionLoop
+    ; assert(@numScanlinesTop > 2)
     ; Conditionally do @topScanlines if non-zero
     ; Currently always present... even though image could in theory be scrolled up to hide it
     lda @numScanlinesTop
@@ -515,9 +528,7 @@ CrunchyLib_WriteOAM:
     ldy CrunchyVar_pictureIndex
     lda #0
     sec
-    sbc CrunchyData_NumSpriteTiles,y
-    asl
-    asl
+    sbc CrunchyData_OamSize,y
     tax
     jsr CrunchyLib_WriteCompressedOAM
     rts
@@ -529,10 +540,12 @@ CrunchyLib_WriteOAM:
 ; Input: X = starting index in OAM
 ;
 CrunchyLib_WriteCompressedOAM:
-    @dataPtr    = CRUNCHY_TEMP
-    @sprCount   = CRUNCHY_TEMP+2
-    @tileIndex  = CRUNCHY_TEMP+3
-    @spritePal  = CRUNCHY_TEMP+4
+    @dataPtr        = CRUNCHY_TEMP
+    @sprCount       = CRUNCHY_TEMP+2
+    @tileIndex      = CRUNCHY_TEMP+3
+    @spritePal      = CRUNCHY_TEMP+4
+    @reusingCount   = CRUNCHY_TEMP+5
+    @tilesStart     = CRUNCHY_TEMP+6
 
     lda CrunchyData_OAM_compressed_lo,y
     sta @dataPtr
@@ -540,10 +553,11 @@ CrunchyLib_WriteCompressedOAM:
     sta @dataPtr+1
     lda CrunchyData_SpriteTilesStartIndex,y
     sta @tileIndex
+    sta @tilesStart
     ldy #0
     ;
 @palLoop:
-    ; assert(Y < 136)
+    ; assert(Y < 200)
     lda #0
     sta @spritePal
     lda (@dataPtr),y
@@ -556,9 +570,17 @@ CrunchyLib_WriteCompressedOAM:
     rol @spritePal
     lsr
     rol @spritePal
+    ; Sprites using next tile = number of sprites - sprites re-using a tile
+    sec
+    sbc (@dataPtr),y
     sta @sprCount
+    lda (@dataPtr),y
+    sta @reusingCount
+    iny
+    lda @sprCount
+    beq @reusingSprites
 @oamSpriteLoop:
-    ; assert(Y < 136)
+    ; assert(Y < 200)
     ; X-position
     lda (@dataPtr),y
     iny
@@ -568,7 +590,7 @@ CrunchyLib_WriteCompressedOAM:
     lda #0
     sbc CrunchyVar_scrollX+1
     bne @spriteOutside
-    ; assert(Y < 136)
+    ; assert(Y < 200)
     ; Y-position
     lda (@dataPtr),y
     sec
@@ -596,6 +618,55 @@ CrunchyLib_WriteCompressedOAM:
 .ENDIF
     dec @sprCount
     bne @oamSpriteLoop
+    ;
+    ; Sprites re-using a tile, with tile number and flip bits
+    ;
+@reusingSprites:
+    lda @reusingCount
+    bne @reusingSpriteLoop
+    jmp @palLoop
+@reusingSpriteLoop:
+    ; assert(Y < 200)
+    ; X-position
+    lda (@dataPtr),y
+    iny
+    sec
+    sbc CrunchyVar_scrollX
+    sta CRUNCHY_SPRITE_PAGE+3,x
+    lda #0
+    sbc CrunchyVar_scrollX+1
+    bne @reusingSpriteOutside
+    ; Y-position
+    lda (@dataPtr),y
+    sec
+    sbc CrunchyVar_scrollY
+    sta CRUNCHY_SPRITE_PAGE,x
+    lda #0
+    sbc CrunchyVar_scrollY+1
+    bne @reusingSpriteOutside
+    iny
+    ; Palette + flip bits
+    lda (@dataPtr),y
+    and #$C0
+    ora @spritePal
+    sta CRUNCHY_SPRITE_PAGE+2,x
+    ; Tile index
+    lda (@dataPtr),y
+    iny
+    and #$3F
+.IF CRUNCHY_8x16_PPUCTRL_BITMASK
+    asl
+.ENDIF
+    clc
+    adc @tilesStart
+    sta CRUNCHY_SPRITE_PAGE+1,x
+@continueReusingLoop:
+    inx
+    inx
+    inx
+    inx
+    dec @reusingCount
+    bne @reusingSpriteLoop
     jmp @palLoop
 
 @spriteOutside:
@@ -604,6 +675,14 @@ CrunchyLib_WriteCompressedOAM:
     iny
     jmp @continueLoop
 
+@reusingSpriteOutside:
+    lda #240
+    sta CRUNCHY_SPRITE_PAGE,x
+    ; Skip Y-position and tile number
+    iny
+    iny
+    jmp @continueReusingLoop
+
 ;
 ; Loads a picture's CHR data directly to PPU memory
 ;
@@ -618,16 +697,52 @@ CrunchyLib_UploadCompressedCHR:
     lda CrunchyData_BottomStartScanlineMinus1,y
     sta CrunchyVar_bottomStartScanline
     inc CrunchyVar_bottomStartScanline
+.IF CRUNCHY_MAX_CHR_SPLITS >= 2
+    lda CrunchyData_Split2StartScanlineMinus1,y
+    sta CrunchyVar_splitStartScanlines+1
+    inc CrunchyVar_splitStartScanlines+1
+.ENDIF
+.IF CRUNCHY_MAX_CHR_SPLITS >= 3
+    lda CrunchyData_Split3StartScanlineMinus1,y
+    sta CrunchyVar_splitStartScanlines+2
+    inc CrunchyVar_splitStartScanlines+2
+.ENDIF
     jsr CrunchyLib_SwitchToTopCHR
-    ; Upload BG CHR (top)
+.IF CRUNCHY_NUM_SHARED_BG_TILES
+    ;
+    ; Upload shared BG CHR, unless already loaded to this CHR bank
+    ;
+    lda CrunchyData_NumSharedBackgroundTiles,y
+    bne @usesSharedCHR
+    ; Picture overwrites shared BG CHR
+    sta CrunchyVar_sharedChrBankBits
+    beq @sharedCHRDone
+@usesSharedCHR:
+    lda CrunchyVar_chrBankBits
+    ora #1
+    cmp CrunchyVar_sharedChrBankBits
+    beq @sharedCHRDone
+    sta CrunchyVar_sharedChrBankBits
+    lda #<CrunchyData_SharedBackgroundCHR
+    sta @dataPtr
+    lda #>CrunchyData_SharedBackgroundCHR
+    sta @dataPtr+1
+    sec
+    ldy #0
+    jsr CrunchyLib_UploadTiles
+    ldy CrunchyVar_pictureIndex
+@sharedCHRDone:
+.ENDIF
+    ; Upload BG CHR (top), following any shared BG CHR
     lda CrunchyData_NumBackgroundTilesTop,y
     tax
     lda CrunchyData_BackgroundCHR_top_lo,y
     sta @dataPtr
     lda CrunchyData_BackgroundCHR_top_hi,y
     sta @dataPtr+1
+    lda CrunchyData_NumSharedBackgroundTiles,y
+    tay
     sec
-    ldy #0
     jsr CrunchyLib_UploadTiles
 
     ; Upload Sprite CHR
@@ -678,8 +793,86 @@ CrunchyLib_UploadCompressedCHR:
     tay
     sec
     jsr CrunchyLib_UploadTiles
+.IF CRUNCHY_MAX_CHR_SPLITS >= 2
+    ;
+    ; Upload BG CHR of further sections, each to the CHR bank following that of the section above
+    ;
+    lda CrunchyVar_splitStartScanlines+1
+    cmp #240
+    beq @noMoreSections
+    lda #(2 << 5)
+    jsr CrunchyLib_CopyCHRToSection
+    lda CrunchyData_BackgroundCHR_split2_lo,y
+    sta @dataPtr
+    lda CrunchyData_BackgroundCHR_split2_hi,y
+    sta @dataPtr+1
+    lda CrunchyData_NumBackgroundTilesCommon,y
+    tay
+    sec
+    jsr CrunchyLib_UploadTiles
+.IF CRUNCHY_MAX_CHR_SPLITS >= 3
+    lda CrunchyVar_splitStartScanlines+2
+    cmp #240
+    beq @noMoreSections
+    lda #(3 << 5)
+    jsr CrunchyLib_CopyCHRToSection
+    lda CrunchyData_BackgroundCHR_split3_lo,y
+    sta @dataPtr
+    lda CrunchyData_BackgroundCHR_split3_hi,y
+    sta @dataPtr+1
+    lda CrunchyData_NumBackgroundTilesCommon,y
+    tay
+    sec
+    jsr CrunchyLib_UploadTiles
+.ENDIF
+@noMoreSections:
+.ENDIF
+    rts
+
+.IF CRUNCHY_MAX_CHR_SPLITS >= 2
+;
+; Copy common BG CHR and sprite CHR to the CHR bank of a section from the bank of the section above it,
+; and switch to the CHR bank of the section
+;
+; Inputs:
+;   A: Offset of section's CHR bank from first CHR bank of picture, in bits 5-6
+; Outputs:
+;   Y: Picture index
+;
+CrunchyLib_CopyCHRToSection:
+    @sectionBankBits = CRUNCHY_TEMP+5
+    sta @sectionBankBits
+    ; Copy common BG CHR
+    ldy CrunchyVar_pictureIndex
+    lda CrunchyData_NumCommonBackgroundTilePages,y
+    tax
+    ldy #$10
+    jsr @getPreviousBankBits
+    jsr CrunchyLib_CopyChrToNextBank
+    ; Copy sprite CHR
+    ldy CrunchyVar_pictureIndex
+    lda CrunchyData_NumSpriteTiles,y
+    tax
+    lda CrunchyData_SpriteTilesStartPage,y
+    tay
+    jsr @getPreviousBankBits
+    jsr CrunchyLib_CopyChrToNextBank
+    ; Switch to CHR bank of section
+    lda @sectionBankBits
+    jsr CrunchyLib_SwitchCHR
+    ldy CrunchyVar_pictureIndex
     rts
 
+@getPreviousBankBits:
+    lda @sectionBankBits
+    sec
+    sbc #(1 << 5)
+    clc
+    adc CrunchyVar_chrBankBits
+    ora #CRUNCHY_PRG_BANK
+    rts
+.ENDIF
+
 ;------------------------------------------------------------------------------
 
 ;
@@ -768,6 +961,16 @@ CrunchyLib_CopyChrToNextBank:
     sta $2006
     rts
 
+;
+; Forget that shared background CHR is loaded, forcing the next picture using it to upload it again.
+;
+; Call this after writing your own data to a CHR bank used for pictures.
+;
+CrunchyLib_InvalidateSharedCHR:
+    lda #0
+    sta CrunchyVar_sharedChrBankBits
+    rts
+
 CrunchyLib_SwitchToTopCHR:
     lda #0
     bpl CrunchyLib_SwitchCHR
@@ -946,3 +1149,178 @@ CrunchyLib_WritePalettes:
     cpy #32
     bne @writePaletteLoop
     rts
+
+;
+; Start playing the delta frames of a sequence built with --sequence, after loading its keyframe
+;
+; Inputs:
+;   X = Lo byte of address of delta frames, e.g. <CrunchyData_Sequence
+;   Y = Hi byte of address of delta frames, e.g. >CrunchyData_Sequence
+;   A = High byte of nametable address the keyframe was loaded to
+;
+CrunchyLib_StartDeltaFrames:
+    stx CrunchyVar_deltaPtr
+    sty CrunchyVar_deltaPtr+1
+    and #$0C
+    sta CrunchyVar_deltaNametableBits
+    rts
+
+;
+; Apply the next chunk of the current delta frame of a sequence
+;
+; Must be called during vblank, before CrunchyLib_Display. CrunchyBuild sizes each chunk to fit
+; the --sequence_vblank_cycles budget, and stores the delta frames one after the other, so calling
+; this once per NMI plays the sequence. Runs of CHR, nametable and palettes are written to PPU memory,
+; using the picture's CHR bank, and runs of OAM to CRUNCHY_SPRITE_PAGE.
+;
+; Outputs:
+;   C: Set if the delta frame is complete
+;
+CrunchyLib_ApplyDeltaChunk:
+    @count      = CRUNCHY_TEMP
+    jsr CrunchyLib_SwitchToTopCHR
+    ldy #0
+@runLoop:
+    ; Run length, or zero at end of chunk
+    lda (CrunchyVar_deltaPtr),y
+    beq @endOfChunk
+    tax
+    iny
+    ; High byte of PPU address, or bit7 set for a run of OAM
+    lda (CrunchyVar_deltaPtr),y
+    bmi @oamRun
+    iny
+    cmp #$20
+    bcc @ppuRun
+    cmp #$24
+    bcs @ppuRun
+    ora CrunchyVar_deltaNametableBits
+@ppuRun:
+    sta $2006
+    lda (CrunchyVar_deltaPtr),y
+    iny
+    sta $2006
+@ppuRunLoop:
+    lda (CrunchyVar_deltaPtr),y
+    iny
+    sta $2007
+    dex
+    bne @ppuRunLoop
+    beq @runLoop
+@oamRun:
+    iny
+    stx @count
+    ; Offset in OAM
+    lda (CrunchyVar_deltaPtr),y
+    iny
+    tax
+@oamRunLoop:
+    lda (CrunchyVar_deltaPtr),y
+    iny
+    sta CRUNCHY_SPRITE_PAGE,x
+    inx
+    dec @count
+    bne @oamRunLoop
+    beq @runLoop
+@endOfChunk:
+    ; Advance data pointer past end of chunk
+    ; (crunchybuild limits chunk sizes to keep indexing byte-sized)
+    iny
+    tya
+    clc
+    adc CrunchyVar_deltaPtr
+    sta CrunchyVar_deltaPtr
+    bcc @noCarry
+    inc CrunchyVar_deltaPtr+1
+@noCarry:
+    ; A second zero byte ends the delta frame
+    ldy #0
+    lda (CrunchyVar_deltaPtr),y
+    bne @frameIncomplete
+    inc CrunchyVar_deltaPtr
+    bne @frameComplete
+    inc CrunchyVar_deltaPtr+1
+@frameComplete:
+    sec
+    rts
+@frameIncomplete:
+    clc
+    rts
+
+.IF CRUNCHY_NAMETABLE_STREAMING
+;
+; Start streaming the nametable of a picture built with --nametable_block_cycles
+;
+; Inputs:
+;   Y = Picture index
+;   A = High byte of nametable address to stream to
+;
+CrunchyLib_StartNametableStream:
+    sta CrunchyVar_streamPPUAddress+1
+    lda #0
+    sta CrunchyVar_streamPPUAddress
+    lda CrunchyData_NameTable_compressed_lo,y
+    sta CrunchyVar_streamDataPtr
+    lda CrunchyData_NameTable_compressed_hi,y
+    sta CrunchyVar_streamDataPtr+1
+    lda CrunchyData_NameTableBlockSizes_lo,y
+    sta CrunchyVar_streamBlockSizesPtr
+    lda CrunchyData_NameTableBlockSizes_hi,y
+    sta CrunchyVar_streamBlockSizesPtr+1
+    rts
+
+;
+; Upload the next block of the nametable being streamed
+;
+; Must be called during vblank, before CrunchyLib_Display. CrunchyBuild sizes each block to fit
+; the --nametable_block_cycles budget, so calling this once per NMI uploads the nametable while
+; rendering stays enabled.
+;
+; Outputs:
+;   C: Set if the whole nametable has been uploaded
+;
+CrunchyLib_StreamNametableBlock:
+    @dataPtr    = CRUNCHY_TEMP
+    ldy #0
+    lda (CrunchyVar_streamDataPtr),y
+    beq @streamComplete
+    lda CrunchyVar_streamPPUAddress+1
+    sta $2006
+    lda CrunchyVar_streamPPUAddress
+    sta $2006
+    lda CrunchyVar_streamDataPtr
+    sta @dataPtr
+    lda CrunchyVar_streamDataPtr+1
+    sta @dataPtr+1
+    jsr CrunchyLib_UploadCompressedNametableBlock
+    ; Advance data pointer past block
+    tya
+    clc
+    adc CrunchyVar_streamDataPtr
+    sta CrunchyVar_streamDataPtr
+    bcc @noDataCarry
+    inc CrunchyVar_streamDataPtr+1
+@noDataCarry:
+    ; Advance PPU address by the decoded size of the block
+    ldy #0
+    lda (CrunchyVar_streamBlockSizesPtr),y
+    clc
+    adc CrunchyVar_streamPPUAddress
+    sta CrunchyVar_streamPPUAddress
+    bcc @noAddressCarry
+    inc CrunchyVar_streamPPUAddress+1
+@noAddressCarry:
+    inc CrunchyVar_streamBlockSizesPtr
+    bne @noSizesCarry
+    inc CrunchyVar_streamBlockSizesPtr+1
+@noSizesCarry:
+    ; A zero-sized block ends the nametable
+    lda (CrunchyVar_streamDataPtr),y
+    bne @streamIncomplete
+@streamComplete:
+    sec
+    rts
+@streamIncomplete:
+    clc
+    rts
+.ENDIF
@@ -12,7 +12,7 @@ CRUNCHY_SPRITE_PAGE = $200
 
 CRUNCHY_TEMP                 = $00
 CRUNCHY_VARS                 = $10
-TOKUMARU_DECOMPRESS_MEM_BASE = $20
+TOKUMARU_DECOMPRESS_MEM_BASE = $30
 
 ;
 ; Declare macro for bank-switching. This can be a trivial one as CrunchyView disables NMIs during picture loading.
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Benchmark ScreenBuilder._near_tile_pairs scaling with the number of tiles.
+
+Compares the multi-index hash search against comparing all pairs of tiles, for random tiles
+and for mostly-blank tiles, whose blank rows put most tiles into the same hash bucket.
+Each tile has near-duplicates differing in a few bits, like the tiles merged by --merge_tiles_max_error.
+"""
+import sys
+import random
+import argparse
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from ScreenBuilder import ScreenBuilder, popcount
+
+from typing import List, Tuple
+
+TILE_BITS = 128
+TILE_KINDS = ['random', 'blank']
+
+
+def near_duplicate_tiles(kind: str, num_tiles: int, seed: int = 0) -> List[int]:
+    """
+    Create unique 8x8 tiles in groups of a tile and near-duplicates of it
+
+    :param kind:      'random' for random tiles, 'blank' for tiles with 2 non-blank rows
+    :param num_tiles: Number of tiles
+    :param seed:      Random seed
+    :return:          Tile data of each tile as integer
+    """
+    rnd = random.Random(seed)
+    tiles = set()
+    while len(tiles) < num_tiles:
+        if kind == 'random':
+            tile = rnd.getrandbits(TILE_BITS)
+        else:
+            tile = sum(rnd.randrange(1, 256) << (8 * rnd.randrange(TILE_BITS // 8)) for _ in range(2))
+        tiles.add(tile)
+        for _ in range(rnd.randrange(4)):
+            tiles.add(tile ^ sum(1 << rnd.randrange(TILE_BITS) for _ in range(rnd.randint(1, 3))))
+    return list(tiles)[:num_tiles]
+
+
+def all_pairs(tiles: List[int], max_distance: int) -> List[Tuple[int, int, int]]:
+    """
+    Find pairs of tiles within a Hamming distance by comparing all pairs
+    """
+    return [(popcount(tiles[a] ^ tiles[b]), a, b) for a in range(len(tiles)) for b in range(a + 1, len(tiles))
+            if popcount(tiles[a] ^ tiles[b]) <= max_distance]
+
+
+def timed(function, *args) -> Tuple[float, list]:
+    t = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - t, result
+
+
+def main(tile_counts: List[int], max_distances: List[int], repeat: int):
+    print(f'{"kind":>6} {"tiles":>6} {"distance":>8} {"pairs":>7} {"all pairs (ms)":>15} {"index (ms)":>11} {"speedup":>8}')
+    for kind in TILE_KINDS:
+        for num_tiles in tile_counts:
+            tiles = near_duplicate_tiles(kind, num_tiles)
+            for max_distance in max_distances:
+                t_all, expected = min(timed(all_pairs, tiles, max_distance) for _ in range(repeat))
+                t_index, pairs = min(timed(ScreenBuilder._near_tile_pairs, tiles, TILE_BITS, max_distance) for _ in range(repeat))
+                assert sorted(pairs) == sorted(expected), 'Multi-index hash search missed pairs'
+                print(f'{kind:>6} {num_tiles:>6} {max_distance:>8} {len(pairs):>7} {1000 * t_all:>15.1f} {1000 * t_index:>11.1f} '
+                      f'{t_all / t_index:>7.1f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark search of near-duplicate tiles')
+    parser.add_argument('--tiles', type=int, nargs='+',
+                        default=[256, 512, 1024],
+                        help='Tile counts to benchmark')
+    parser.add_argument('--distances', type=int, nargs='+',
+                        default=[2, 8, 15],
+                        help='Maximum Hamming distances to benchmark')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of repetitions - best time is reported')
+    args = parser.parse_args()
+    main(args.tiles, args.distances, args.repeat)
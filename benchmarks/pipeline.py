@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+Benchmark the CrunchyBuild conversion pipeline.
+
+Times each stage of converting an image on its own, and the conversion end to end,
+for synthetic images (see synthetic_images.py) and the test images of the repository,
+in both 8x8 and 8x16 sprite mode.
+
+Usage:
+    pipeline.py run --output results.json
+    pipeline.py compare baseline.json results.json
+
+Results are stored as JSON. Store the results of one run as a baseline, and compare
+later runs against it to find regressions.
+"""
+import sys
+import json
+import platform
+import argparse
+import tempfile
+import statistics
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from PIL import Image
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from ScreenBuilder import ScreenBuilder
+from TokumaruCompression import tokumaru_compressed
+from ScreenConversion import BuildOptions
+import crunchybuild
+from synthetic_images import make_image, IMAGE_KINDS
+
+from typing import Dict, List
+
+RESULTS_FORMAT_VERSION = 1
+REPOSITORY_FOLDER = Path(__file__).resolve().parent.parent
+TEST_IMAGES = [REPOSITORY_FOLDER / 'testimages' / 'Bernie-converted.png']
+STAGES = ['make_background', 'split_background_tile_table', 'make_sprites', 'nametable_compressed',
+          'oam_compressed', 'chr_compression', 'file_writing', 'end_to_end']
+
+
+class TimedScreenBuilder(ScreenBuilder):
+    """
+    ScreenBuilder recording the time spent in each stage run by its constructor
+    """
+    def __init__(self, *args, **kwargs):
+        self.timings: Dict[str, float] = {}
+        super().__init__(*args, **kwargs)
+
+    @contextmanager
+    def _timed(self, stage: str):
+        t = time.perf_counter()
+        yield
+        self.timings[stage] = self.timings.get(stage, 0.0) + time.perf_counter() - t
+
+    def make_background(self):
+        with self._timed('make_background'):
+            return super().make_background()
+
+    def split_background_tile_table(self, max_bg_slots: int):
+        with self._timed('split_background_tile_table'):
+            return super().split_background_tile_table(max_bg_slots)
+
+    def make_sprites(self):
+        with self._timed('make_sprites'):
+            return super().make_sprites()
+
+
+def timed(function, *args) -> float:
+    t = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - t
+
+
+def write_files(output_folder: Path, builder: ScreenBuilder, compressed: Dict[str, bytes]):
+    """
+    Write the same data files as crunchybuild.build_image, from already converted data
+    """
+    for name, data in [('bg', builder.chr_bg()),
+                       ('bg_top', builder.chr_bg_top()),
+                       ('bg_bottom', builder.chr_bg_bottom()),
+                       ('bg_bottom_nc', builder.chr_bg_bottom_no_common()),
+                       ('spr', builder.chr_spr())]:
+        with open(output_folder / f'{name}_0.chr', 'wb') as f:
+            data.tofile(f)
+    for name, data in [('nametable_0.nam', builder.nametable()),
+                       ('nametable_compressed_0.bin', compressed['nametable']),
+                       ('oam_0.bin', builder.oam()),
+                       ('oam_compressed_0.bin', compressed['oam'])]:
+        with open(output_folder / name, 'wb') as f:
+            data.tofile(f)
+    for name in ['bg_top', 'bg_bottom_nc', 'spr']:
+        with open(output_folder / f'{name}_0.tc', 'wb') as f:
+            f.write(compressed[name])
+
+
+def benchmark_case(image_path: Path, sprite_size_8x16: bool, nes_palette: bytes, output_folder: Path) -> Dict[str, float]:
+    """
+    Time each stage of converting an image once.
+
+    :param image_path:       Path to indexed-color image
+    :param sprite_size_8x16: If true, use 8x16 sprites
+    :param nes_palette:      NES color palette as 64 RGB values, for end-to-end conversion
+    :param output_folder:    Folder to write data files to
+    :return:                 Stage -> time in seconds
+    """
+    image = Image.open(image_path)
+    image.load()
+    builder = TimedScreenBuilder(image, sprite_size_8x16, True, 256)
+    timings = dict(builder.timings)
+    compressed = {}
+    t = time.perf_counter()
+    compressed['nametable'] = builder.nametable_compressed()
+    timings['nametable_compressed'] = time.perf_counter() - t
+    t = time.perf_counter()
+    compressed['oam'] = builder.oam_compressed()
+    timings['oam_compressed'] = time.perf_counter() - t
+    t = time.perf_counter()
+    for name, chr_data in [('bg_top', builder.chr_bg_top()),
+                           ('bg_bottom_nc', builder.chr_bg_bottom_no_common()),
+                           ('spr', builder.chr_spr())]:
+        compressed[name] = tokumaru_compressed(chr_data.tobytes())
+    timings['chr_compression'] = time.perf_counter() - t
+    timings['file_writing'] = timed(write_files, output_folder, builder, compressed)
+    timings['end_to_end'] = timed(crunchybuild.build_image, image_path, 0, output_folder,
+                                  BuildOptions(nes_palette=nes_palette, sprite_size_8x16=sprite_size_8x16))
+    return timings
+
+
+def run(output_path: Path, repeat: int, kinds: List[str], seed: int):
+    """
+    Run all benchmark cases and write results to a JSON file
+    """
+    with open(REPOSITORY_FOLDER / 'nespalettes' / 'default.pal', 'rb') as f:
+        nes_palette = f.read(192)
+    with tempfile.TemporaryDirectory() as temp_folder:
+        temp_folder = Path(temp_folder)
+        image_paths = []
+        for kind in kinds:
+            image_paths.append(temp_folder / f'{kind}.png')
+            make_image(kind, seed).save(image_paths[-1])
+        image_paths += TEST_IMAGES
+        output_folder = temp_folder / 'output'
+        output_folder.mkdir()
+        results = {}
+        for image_path in image_paths:
+            for sprite_size_8x16 in [False, True]:
+                case = f'{image_path.stem}_{"8x16" if sprite_size_8x16 else "8x8"}'
+                runs = [benchmark_case(image_path, sprite_size_8x16, nes_palette, output_folder) for i in range(repeat)]
+                results[case] = {stage: {'min': min(run[stage] for run in runs),
+                                         'median': statistics.median(run[stage] for run in runs)}
+                                 for stage in STAGES if stage in runs[0]}
+                print(f'{case:<28} ' + ' '.join(f'{stage}={1000 * timing["min"]:.1f}ms' for stage, timing in results[case].items()))
+    report = {
+        'format_version': RESULTS_FORMAT_VERSION,
+        'environment': {
+            'crunchynes': crunchybuild.VERSION_STRING,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pillow': Image.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+        },
+        'repeat': repeat,
+        'seed': seed,
+        'results': results,
+    }
+    with open(output_path, 'wt') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results written to {output_path}')
+
+
+def compare(baseline_path: Path, results_path: Path, metric: str, threshold: float, min_delta: float) -> int:
+    """
+    Compare benchmark results against a baseline.
+
+    :param baseline_path: Baseline results JSON file
+    :param results_path:  New results JSON file
+    :param metric:        Timing statistic to compare ('min' or 'median')
+    :param threshold:     Relative slowdown counted as a regression, e.g. 0.1 for 10%
+    :param min_delta:     Smallest absolute slowdown in seconds counted as a regression, to ignore noise in short stages
+    :return:              1 if any stage regressed, 0 otherwise
+    """
+    with open(baseline_path, 'rt') as f:
+        baseline = json.load(f)
+    with open(results_path, 'rt') as f:
+        results = json.load(f)
+    for report in [baseline, results]:
+        if report.get('format_version') != RESULTS_FORMAT_VERSION:
+            print(f'Unsupported results format version {report.get("format_version")}')
+            return 1
+    if baseline['environment'] != results['environment']:
+        print('Warning: Results were measured in different environments')
+    num_regressions = 0
+    print(f'{"case":<28} {"stage":<28} {"baseline (ms)":>13} {"new (ms)":>9} {"change":>8}')
+    for case, stages in results['results'].items():
+        for stage, timing in stages.items():
+            if stage not in baseline['results'].get(case, {}):
+                print(f'{case:<28} {stage:<28} {"-":>13} {1000 * timing[metric]:>9.2f} {"new":>8}')
+                continue
+            old = baseline['results'][case][stage][metric]
+            new = timing[metric]
+            change = new / old - 1 if old > 0 else 0.0
+            regression = change > threshold and new - old > min_delta
+            num_regressions += regression
+            print(f'{case:<28} {stage:<28} {1000 * old:>13.2f} {1000 * new:>9.2f} {100 * change:>+7.1f}%{" REGRESSION" if regression else ""}')
+    for case in baseline['results']:
+        if case not in results['results']:
+            print(f'{case:<28} missing from new results')
+    print(f'{num_regressions} regressions above {100 * threshold:.0f}%')
+    return int(num_regressions > 0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the CrunchyBuild conversion pipeline')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help='Run benchmarks and write results')
+    run_parser.add_argument('--output', type=str, default='benchmark_results.json',
+                            help='JSON file to write results to')
+    run_parser.add_argument('--repeat', type=int, default=5,
+                            help='Number of repetitions of each case - minimum and median times are reported')
+    run_parser.add_argument('--kinds', type=str, nargs='+',
+                            default=IMAGE_KINDS, choices=IMAGE_KINDS,
+                            help='Kinds of synthetic images to benchmark')
+    run_parser.add_argument('--seed', type=int, default=0,
+                            help='Random seed for synthetic images')
+    compare_parser = subparsers.add_parser('compare', help='Compare results against a baseline')
+    compare_parser.add_argument('baseline', type=str,
+                                help='Baseline results JSON file')
+    compare_parser.add_argument('results', type=str,
+                                help='New results JSON file')
+    compare_parser.add_argument('--metric', type=str, default='min', choices=['min', 'median'],
+                                help='Timing statistic to compare')
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help='Relative slowdown reported as a regression')
+    compare_parser.add_argument('--min_delta_ms', type=float, default=1.0,
+                                help='Smallest absolute slowdown in milliseconds reported as a regression')
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(Path(args.output), args.repeat, args.kinds, args.seed)
+    else:
+        sys.exit(compare(Path(args.baseline), Path(args.results), args.metric, args.threshold, args.min_delta_ms / 1000))
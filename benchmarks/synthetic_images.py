@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Generate synthetic indexed-color images for benchmarking the conversion pipeline.
+
+Each kind of image stresses a different part of the pipeline:
+
+* noise:     Every area filled with noisy tiles from a bank of 200 patterns. Worst case for RLEi
+* gradient:  Dithered gradients with few unique tiles. Best case for RLEi
+* blank:     Mostly background color, with a handful of details
+* split:     Over 256 unique tiles, forcing the background to be split into two CHR banks
+* sprites:   Gradient background with a sprite overlay using close to the 64 sprite limit
+
+Images follow the palette layout CrunchyBuild expects: 4 background palettes in indices 0-15
+and 4 sprite palettes in indices 16-31, with index 0 as the shared background color.
+Palettes are fixed per 16x16 attribute area for background, and per 8x8 area for sprites.
+"""
+import random
+import argparse
+from pathlib import Path
+from PIL import Image
+
+from typing import List
+
+WIDTH = 256
+HEIGHT = 240
+AREA_SIZE = 16
+TILE_SIZE = 8
+NUM_COLORS = 4
+NUM_PALETTE_GROUPS_BG = 4
+NUM_PALETTE_GROUPS_SPR = 4
+
+IMAGE_KINDS = ['noise', 'gradient', 'blank', 'split', 'sprites']
+
+
+def random_palette(rnd: random.Random) -> List[int]:
+    """
+    :return: Linearized RGB palette of 256 entries, with distinct colors in the first 32 entries
+    """
+    palette = [0, 0, 0]
+    for i in range(1, (NUM_PALETTE_GROUPS_BG + NUM_PALETTE_GROUPS_SPR) * NUM_COLORS):
+        palette += [rnd.randrange(256) for c in range(3)]
+    return palette + [0] * (768 - len(palette))
+
+
+def random_tile(rnd: random.Random, density: float) -> List[List[int]]:
+    """
+    :return: 8x8 tile of colors 0-3, with given fraction of non-zero pixels
+    """
+    return [[rnd.randrange(1, NUM_COLORS) if rnd.random() < density else 0 for x in range(TILE_SIZE)]
+            for y in range(TILE_SIZE)]
+
+
+def dither_level(x: int, y: int, level: float) -> int:
+    """
+    :return: Color 0-3 approximating level in [0, 1] using a 4x4 ordered dither
+    """
+    bayer = [[0, 8, 2, 10], [12, 4, 14, 6], [3, 11, 1, 9], [15, 7, 13, 5]]
+    value = level * (NUM_COLORS - 1)
+    base = int(value)
+    return min(NUM_COLORS - 1, base + int(value - base > (bayer[y % 4][x % 4] + 0.5) / 16))
+
+
+def area_palettes(rnd: random.Random) -> List[List[int]]:
+    """
+    :return: Background palette group of each 16x16 area
+    """
+    return [[rnd.randrange(NUM_PALETTE_GROUPS_BG) for x in range(WIDTH // AREA_SIZE)] for y in range(HEIGHT // AREA_SIZE)]
+
+
+def fill_tiles(pixels, palettes: List[List[int]], tiles: List[List[List[int]]], pick):
+    """
+    Fill background with tiles.
+
+    :param pixels:   Pixel access object of image
+    :param palettes: Background palette group of each 16x16 area
+    :param tiles:    List of 8x8 tiles of colors 0-3
+    :param pick:     Function (tile_x, tile_y) -> index into tiles
+    """
+    for ty in range(HEIGHT // TILE_SIZE):
+        for tx in range(WIDTH // TILE_SIZE):
+            tile = tiles[pick(tx, ty)]
+            p = palettes[ty * TILE_SIZE // AREA_SIZE][tx * TILE_SIZE // AREA_SIZE]
+            for y in range(TILE_SIZE):
+                for x in range(TILE_SIZE):
+                    c = tile[y][x]
+                    pixels[tx * TILE_SIZE + x, ty * TILE_SIZE + y] = p * NUM_COLORS + c if c else 0
+
+
+def fill_gradient(pixels, palettes: List[List[int]]):
+    """
+    Fill background with a diagonal dithered gradient
+    """
+    for y in range(HEIGHT):
+        for x in range(WIDTH):
+            c = dither_level(x, y, ((x + y) % 128) / 127)
+            p = palettes[y // AREA_SIZE][x // AREA_SIZE]
+            pixels[x, y] = p * NUM_COLORS + c if c else 0
+
+
+def add_sprites(pixels, rnd: random.Random, num_sprites: int):
+    """
+    Add small sprite details, each within its own 8x8 area at the top of a 8x16 area.
+    This gives the same number of sprites in 8x8 and 8x16 sprite mode.
+    Sprites start below the first 16 lines, as OAM can't place sprites at Y = 0.
+    """
+    cells = [(x, y) for y in range(1, HEIGHT // (2 * TILE_SIZE)) for x in range(WIDTH // TILE_SIZE)]
+    for cx, cy in rnd.sample(cells, num_sprites):
+        p = NUM_PALETTE_GROUPS_BG + rnd.randrange(NUM_PALETTE_GROUPS_SPR)
+        tile = random_tile(rnd, 0.5)
+        for y in range(TILE_SIZE):
+            for x in range(TILE_SIZE):
+                if tile[y][x]:
+                    pixels[cx * TILE_SIZE + x, cy * 2 * TILE_SIZE + y] = p * NUM_COLORS + tile[y][x]
+
+
+def make_image(kind: str, seed: int = 0) -> Image.Image:
+    """
+    Create a synthetic image.
+
+    :param kind: One of IMAGE_KINDS
+    :param seed: Random seed
+    :return:     Indexed-color image
+    """
+    rnd = random.Random(f'{kind} {seed}')
+    image = Image.new('P', (WIDTH, HEIGHT), 0)
+    image.putpalette(random_palette(rnd))
+    pixels = image.load()
+    palettes = area_palettes(rnd)
+    if kind == 'noise':
+        tiles = [random_tile(rnd, 0.7) for i in range(200)]
+        fill_tiles(pixels, palettes, tiles, lambda tx, ty: rnd.randrange(len(tiles)))
+        add_sprites(pixels, rnd, 8)
+    elif kind == 'gradient':
+        fill_gradient(pixels, palettes)
+        add_sprites(pixels, rnd, 8)
+    elif kind == 'blank':
+        tiles = [[[0] * TILE_SIZE for y in range(TILE_SIZE)]] + [random_tile(rnd, 0.3) for i in range(8)]
+        fill_tiles(pixels, palettes, tiles, lambda tx, ty: rnd.randrange(1, len(tiles)) if rnd.random() < 0.02 else 0)
+    elif kind == 'split':
+        # Unique tiles appearing in raster order, so each half of the screen fits in one CHR bank
+        tiles = [random_tile(rnd, 0.5) for i in range(400)]
+        fill_tiles(pixels, palettes, tiles, lambda tx, ty: (ty * WIDTH // TILE_SIZE + tx) * len(tiles) // 960)
+    elif kind == 'sprites':
+        fill_gradient(pixels, palettes)
+        add_sprites(pixels, rnd, 56)
+    else:
+        raise ValueError(f'Unknown image kind {kind}')
+    return image
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic benchmark images')
+    parser.add_argument('--output', type=str, default='.',
+                        help='Directory to write images to')
+    parser.add_argument('--kinds', type=str, nargs='+',
+                        default=IMAGE_KINDS, choices=IMAGE_KINDS,
+                        help='Kinds of images to generate')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed')
+    args = parser.parse_args()
+    output_folder = Path(args.output)
+    output_folder.mkdir(parents=True, exist_ok=True)
+    for kind in args.kinds:
+        path = output_folder / f'{kind}.png'
+        make_image(kind, args.seed).save(path)
+        print(path)
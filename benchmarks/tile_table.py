@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Benchmark TileTable.add scaling with the number of unique tiles.
+
+Compares the hash-indexed TileTable against a plain linear list.index() scan,
+for a nametable-sized stream of cells with a given number of unique tiles.
+"""
+import sys
+import random
+import argparse
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from ScreenBuilder import TileTable
+
+from typing import List, Tuple
+
+
+def random_tiles(num_unique_tiles: int, num_cells: int, seed: int = 0) -> List[Tuple[int]]:
+    """
+    Create a stream of 8x8 tile data with a given number of unique tiles.
+
+    :param num_unique_tiles: Number of unique tiles in stream
+    :param num_cells:        Total number of cells in stream (at least num_unique_tiles)
+    :param seed:             Random seed
+    :return:                 List of tile data tuples
+    """
+    rnd = random.Random(seed)
+    unique_tiles = set()
+    while len(unique_tiles) < num_unique_tiles:
+        unique_tiles.add(tuple(rnd.randrange(256) for _ in range(16)))
+    unique_tiles = list(unique_tiles)
+    cells = unique_tiles + [rnd.choice(unique_tiles) for _ in range(max(0, num_cells - num_unique_tiles))]
+    rnd.shuffle(cells)
+    return cells
+
+
+def time_linear(cells: List[Tuple[int]]) -> float:
+    """
+    Time the original linear-scan deduplication.
+    """
+    t = time.perf_counter()
+    data = []
+    for tile_data in cells:
+        try:
+            data.index(tile_data)
+        except ValueError:
+            data.append(tile_data)
+    return time.perf_counter() - t
+
+
+def time_tile_table(cells: List[Tuple[int]]) -> float:
+    """
+    Time hash-indexed TileTable deduplication.
+    """
+    t = time.perf_counter()
+    tile_table = TileTable(len(cells), width=8, height=8)
+    for tile_data in cells:
+        tile_table.add(tile_data)
+    return time.perf_counter() - t
+
+
+def main(unique_tile_counts: List[int], num_cells: int, repeat: int):
+    print(f'{"unique tiles":>12} {"list.index (ms)":>16} {"TileTable (ms)":>15} {"speedup":>8}')
+    for num_unique_tiles in unique_tile_counts:
+        cells = random_tiles(num_unique_tiles, num_cells)
+        t_linear = min(time_linear(cells) for _ in range(repeat))
+        t_table = min(time_tile_table(cells) for _ in range(repeat))
+        print(f'{num_unique_tiles:>12} {1000 * t_linear:>16.2f} {1000 * t_table:>15.2f} {t_linear / t_table:>7.1f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark TileTable deduplication')
+    parser.add_argument('--unique', type=int, nargs='+',
+                        default=[64, 128, 256, 512, 960],
+                        help='Unique tile counts to benchmark')
+    parser.add_argument('--cells', type=int, default=960,
+                        help='Number of cells added per run (960 = full nametable)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of repetitions - best time is reported')
+    args = parser.parse_args()
+    main(args.unique, max(args.cells, max(args.unique)), args.repeat)
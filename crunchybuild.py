@@ -1,19 +1,36 @@
 #!/usr/bin/env python3
 import sys
 import shutil
-import subprocess
 from distutils.util import strtobool
 import argparse
 import time
+import os
+import traceback
+import json
+from contextlib import nullcontext
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import itertools
 from math import ceil
-from operator import itemgetter
 from PIL import Image
+import numpy as np
 from pathlib import Path
-from dataclasses import dataclass, field, asdict
+from dataclasses import dataclass, field, asdict, replace
 from collections import UserList, defaultdict
 
-from ScreenBuilder import ScreenBuilder, ByteArray, ScreenBuilderType, TileTableType
+from ScreenBuilder import ScreenBuilder, ByteArray, TileTableType, CHR_SPLIT_OBJECTIVES, SPRITE_PACKINGS
+from TokumaruCompression import tokumaru_compressed
+from BuildCache import BuildCache
+from RLEiCompression import RLEI_COMPRESSORS
+from Profiling import stage, ProfileCollector, summary_table
+from FileWatcher import FileWatcher
+from SharedTiles import shared_tile_dictionary
+from PaletteMapping import PALETTE_METRICS
+from LoadCost import CPU_CYCLES_PER_FRAME
+from PictureRendering import render_data_files, render_picture, differing_pixels, ppu_colors_to_rgb
+from SequenceEncoding import loaded_picture_state, sequence_deltas, apply_delta_frame
+from ScreenConversion import BuildOptions, ScreenArtifacts, PictureTables, DATA_FILES, build_screen, get_image_palette
 
 try:
     from versioning import VERSION_STRING
@@ -22,13 +39,26 @@ except:
 
 from typing import Optional, Tuple, List, Sequence, Dict, Set, NewType
 
-import array
-
 import logging as log
 
 BUILD_PREFIX_CONSTANT = 'CRUNCHY_'
 BUILD_PREFIX_DATA = 'CrunchyData_'
 
+# Data files written for each image, without image index suffix
+ARTIFACT_NAMES = list(DATA_FILES)
+# Data files included in assembly source, without image index suffix -> label of data
+INCLUDED_DATA_FILES = {'bg_top.tc': 'BackgroundCHR_top',
+                       'bg_bottom_nc.tc': 'BackgroundCHR_bottom',
+                       'spr.tc': 'SpriteCHR',
+                       'nametable_compressed.bin': 'NameTable_compressed',
+                       'oam_compressed.bin': 'OAM_compressed',
+                       'palettes.bin': 'Palettes'}
+# Data file holding the data of all images with --packed
+PACK_FILENAME = 'crunchy_data.bin'
+# Data file holding the delta frames of the pictures with --sequence
+SEQUENCE_FILENAME = 'sequence.bin'
+PRG_BANK_SIZE = 16384
+
 def get_script_directory() -> Path:
     """
     Return path to current scripts directory.
@@ -42,153 +72,206 @@ def get_script_directory() -> Path:
     elif __file__:
         return Path(__file__).parent
 
-def nes_closest_palette_entry(rgb: Tuple[int, int, int], NESPaletteRGB: List[Tuple[int, int, int]]) -> int:
-    def dist2(rgbA, rgbB):
-        return sum((rgbA[i] - rgbB[i])**2 for i in range(3))
-    minIndex = min(enumerate([dist2(rgb, nprgb) for i, nprgb in enumerate(NESPaletteRGB)]), key=itemgetter(1))[0]
-    return minIndex
+def write_artifact(files: Dict[str, Path], name: str, data):
+    """
+    Write data file of image as its own profiling stage
 
+    :param files: Artifact name -> path of data file, from artifact_files
+    :param name:  Artifact name
+    :param data:  Bytes-like data to write
+    """
+    with stage(f'write {name}'):
+        with open(files[name], 'wb') as f:
+            f.write(data)
 
-def to_triplets(data: List[int]) -> List[Tuple[int, int, int]]:
-    assert(len(data) % 3 == 0)
-    length = len(data) // 3
-    data_triplets = []
-    for i in range(length):
-        data_triplets.append((data[3 * i + 0], data[3 * i + 1], data[3 * i + 2]))
-    return data_triplets
+
+def build_image(image_path: Path,
+                image_index: int,
+                outputFolder: Path,
+                options: BuildOptions,
+                write_files: bool = True) -> ScreenArtifacts:
+    """
+    :param image_path:   Path to input image
+    :param image_index:  Index of image in assembly source
+    :param outputFolder: Folder to write data files to
+    :param options:      Conversion settings
+    :param write_files:  If false, only return the converted data without writing data files
+    :return:             Converted data
+    """
+    with stage('load_image'):
+        image = Image.open(image_path)
+        image.load()
+    log.info(f'Converting image {image_path}')
+    artifacts = build_screen(image, options)
+    if not write_files:
+        return artifacts
+    # Write data for built image
+    outputFolder.mkdir(exist_ok=True)
+    files = artifact_files(outputFolder, image_index)
+    for name, data in artifacts.data_files().items():
+        write_artifact(files, name, data)
+    return artifacts
 
 
-def map_palette_to_PPU_colors(rgb_palette_image: List[int], rgb_palette_nes: List[int]) -> Tuple[List[int], List[int]]:
-    rgb_palette_image = to_triplets(rgb_palette_image)
-    rgb_palette_nes = to_triplets(rgb_palette_nes)
-    rgb_palette_nes[0x0D] = (1000000, 1000000, 1000000)  # Prevent blacker-than-black
-    nes_palette_colors = []
-    for rgb_color in rgb_palette_image[0:32]:
-        # print(rgb_color)
-        closest_palette_entry = nes_closest_palette_entry(rgb_color, rgb_palette_nes)
-        nes_palette_colors.append(closest_palette_entry)
-    bg_palette = nes_palette_colors[0:16]
-    spr_palette = nes_palette_colors[16:]
-    return bg_palette, spr_palette
+@dataclass
+class BuildResult:
+    """
+    Result of converting a single image, as returned from a worker process
+    """
+    image_index: int
+    tables: Optional[PictureTables]
+    log_records: List[Tuple[int, str]] = field(default_factory=list)
+    error: Optional[str] = None
+    cache_hit: Optional[bool] = None
+    profile: Optional[List[dict]] = None    # Stage records from ProfileCollector, if profiling
+    data: Optional[Dict[str, bytes]] = None # Contents of included data files, if packing data
 
 
-def tokumaru_compress(inputFilename: Path, outputFilename: Path):
+def artifact_files(outputFolder: Path, image_index: int) -> Dict[str, Path]:
+    """
+    :param outputFolder: Folder data files are written to
+    :param image_index:  Index of image in assembly source
+    :return:             Artifact name -> path of data file for image
     """
-    Compress CHR file using Tokumaru compression
+    files = {}
+    for name in ARTIFACT_NAMES:
+        stem, suffix = name.rsplit('.', 1)
+        files[name] = outputFolder / f'{stem}_{image_index}.{suffix}'
+    return files
+
 
-    See: https://wiki.nesdev.com/w/index.php/Tile_compression#Tokumaru
+def tool_version() -> str:
     """
-    url = 'http://membler-industries.com/tokumaru/tokumaru_tile_compression.7z'
-    exePath = get_script_directory() / 'tokumaru_tile_compression' / 'bin' / 'compress.exe'
-    if not exePath.exists():
-        log.error(f'{str(exePath)} is missing! - download from {url}')
-        return
-    if inputFilename.stat().st_size:
-        result = subprocess.run([str(exePath),
-                                 str(inputFilename),
-                                 str(outputFilename)],
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-    else:
-        # Bottom CHR may be zero - but create zero-sized file for consistency
-        outputFilename.touch()
+    Version identifying the conversion code, for use in build cache keys.
+    For a source checkout without a version, a hash of the scripts is used instead.
 
-def get_image_palette(image: Image) -> List[int]:
+    :return: Version string
     """
-    Reads the palette from an indexed PIL image and pads it with zeros
-    to yield 256*3 = 768 bytes.
-    
-    This function is a work-around for PIL / Pillow's handling
-    of truncated palettes, which append the palette index rather
-    than black.
-    
-    :param image: Indexed image to get palette from
-    :return:      Zero-padded palette with exactly 768 byte values
+    if VERSION_STRING != 'unknown':
+        return VERSION_STRING
+    h = hashlib.sha256()
+    for path in sorted(get_script_directory().glob('*.py')):
+        h.update(path.read_bytes())
+    return h.hexdigest()
+
+
+def build_cache_key(image: Image, options: BuildOptions) -> str:
     """
-    imagePaletteLength = len(image.palette.palette)
-    imagePalette = image.getpalette()[0:imagePaletteLength]
-    numFillerBytes = 768 - imagePaletteLength
-    if numFillerBytes > 0:
-        imagePalette += [0] * numFillerBytes
-    return imagePalette
+    Compute build cache key of everything affecting the conversion of an image
 
-def build_image(image_path: Path,
-                image_index: int,
-                outputFolder: Path,
-                nes_palette: Optional[List[int]],
-                bg_palette: Optional[List[int]],
-                spr_palette: Optional[List[int]],
-                sprite_size_8x16: bool,
-                sprite0: bool,
-                max_bg_slots: int) -> ScreenBuilderType:
+    :param image:   Input image
+    :param options: Conversion settings
+    :return:        Cache key
+    """
+    image_palette = bytes(get_image_palette(image)) if image.mode == 'P' else b''
+    # Byte data is added as separate parts, and all other settings by name
+    settings = {name: value for name, value in asdict(options).items() if name not in ('nes_palette', 'shared_tiles')}
+    return BuildCache.key(tool_version().encode(),
+                          f'{image.mode} {image.size}'.encode(),
+                          image.tobytes(),
+                          image_palette,
+                          bytes(options.nes_palette) if options.nes_palette is not None else b'',
+                          repr(sorted(settings.items())).encode(),
+                          b''.join(options.shared_tiles) if options.shared_tiles else b'')
+
+
+class LogRecordBuffer(log.Handler):
+    """
+    Logging handler buffering formatted messages, to keep log output of each image together
+    """
+    def __init__(self, level: int):
+        super().__init__(level)
+        self.records = []
+
+    def emit(self, record: log.LogRecord):
+        self.records.append((record.levelno, record.getMessage()))
+
+
+def build_image_cached(image_path: Path,
+                       image_index: int,
+                       cache: Optional[BuildCache],
+                       outputFolder: Path,
+                       options: BuildOptions,
+                       packed: bool = False) -> BuildResult:
     """
+    Convert a single image, or restore its conversion from the build cache.
+
     :param image_path:   Path to input image
     :param image_index:  Index of image in assembly source
+    :param cache:        Build cache to restore / store conversion from / to. None disables caching
     :param outputFolder: Folder to write data files to
-    :param nes_palette:  NES color palette as linearized 64*RGB values
-    :bg_palette:         NES PPU palette values for background palette. Unused if nes_palette is present
-    :spr_palette:        NES PPU palette values for sprites palette. Unused if nes_palette is present
-    :sprite_size_8x16:   If true, use 8x16 sprites
-    :sprite0:            If true, generate dummy sprite in top-right corner to ensure sprite#0 hit
-    :return:             ScreenBuilder object
-    """
-    image = Image.open(image_path)
-    if image.mode != 'P':
-        log.error(f'image {imagePath} is not an indexed-color image.')
-    log.info(f'Converting image {image_path}')
-    if nes_palette is not None:
-        bg_palette, spr_palette = map_palette_to_PPU_colors(array.array('B', get_image_palette(image)), array.array('B', nes_palette))
-    builder = ScreenBuilder(image, sprite_size_8x16, sprite0, max_bg_slots)
-    # Write data for built image
-    outputFolder.mkdir(exist_ok=True)
-    # BG chr
-    with open(outputFolder / f'bg_{image_index}.chr', 'wb') as f:
-        builder.chr_bg().tofile(f)
-    # BG chr (top)
-    with open(outputFolder / f'bg_top_{image_index}.chr', 'wb') as f:
-        builder.chr_bg_top().tofile(f)
-    # BG chr (bottom)
-    with open(outputFolder / f'bg_bottom_{image_index}.chr', 'wb') as f:
-        builder.chr_bg_bottom().tofile(f)
-    # BG chr (bottom no common)
-    with open(outputFolder / f'bg_bottom_nc_{image_index}.chr', 'wb') as f:
-        builder.chr_bg_bottom_no_common().tofile(f)
-    # Sprite CHR
-    with open(outputFolder / f'spr_{image_index}.chr', 'wb') as f:
-        builder.chr_spr().tofile(f)
-    # nametable
-    with open(outputFolder / f'nametable_{image_index}.nam', 'wb') as f:
-        builder.nametable().tofile(f)
-    with open(outputFolder / f'nametable_compressed_{image_index}.bin', 'wb') as f:
-        builder.nametable_compressed().tofile(f)
-    # OAM
-    with open(outputFolder / f'oam_{image_index}.bin', 'wb') as f:
-        builder.oam().tofile(f)
-    with open(outputFolder / f'oam_compressed_{image_index}.bin', 'wb') as f:
-        builder.oam_compressed().tofile(f)
-    # palette
-    if not spr_palette:
-        spr_palette = [bg_palette[0]] * 16
-    with open(outputFolder / f'palettes_{image_index}.bin', 'wb') as f:
-        array.array('B', bg_palette + spr_palette).tofile(f)
-    # Compress CHR
-    tokumaru_compress(outputFolder / f'bg_top_{image_index}.chr', outputFolder / f'bg_top_{image_index}.tc')
-    tokumaru_compress(outputFolder / f'bg_bottom_nc_{image_index}.chr', outputFolder / f'bg_bottom_nc_{image_index}.tc')
-    tokumaru_compress(outputFolder / f'spr_{image_index}.chr', outputFolder / f'spr_{image_index}.tc')
-    # Log compression ratio
-    has_bottom_bg = len(builder.tile_table_bg_bottom) > 0
-    compressed_size_bg_top = Path(outputFolder / f'bg_top_{image_index}.tc').stat().st_size
-    compressed_size_bg_bottom = Path(outputFolder / f'bg_bottom_nc_{image_index}.tc').stat().st_size if has_bottom_bg else 0
-    compressed_size_spr = Path(outputFolder / f'spr_{image_index}.tc').stat().st_size
-    uncompressed_size_bg_top = Path(outputFolder / f'bg_top_{image_index}.chr').stat().st_size
-    uncompressed_size_bg_bottom = Path(outputFolder / f'bg_bottom_nc_{image_index}.chr').stat().st_size if has_bottom_bg else 0
-    uncompressed_size_spr = Path(outputFolder / f'spr_{image_index}.chr').stat().st_size
-    uncompressed_size = uncompressed_size_bg_top + uncompressed_size_bg_bottom + uncompressed_size_spr
-    compressed_size = compressed_size_bg_top + compressed_size_bg_bottom + compressed_size_spr
-    space_saving = 1.0 - compressed_size / uncompressed_size
-    log.info(f'CHR size % of original: {100.0 * (1.0 - space_saving):.2f}%')
-    log.info(f'CHR space saving %: {100.0 * space_saving:.2f}%')
-    return builder
+    :param options:      Conversion settings
+    :param packed:       If true, return contents of included data files instead of writing data files
+    :return:             BuildResult with table values
+    """
+    files = artifact_files(outputFolder, image_index)
+    if cache is not None:
+        with stage('cache_restore'):
+            key = build_cache_key(Image.open(image_path), options)
+            if packed:
+                tables, data = cache.get_data(key, list(INCLUDED_DATA_FILES)) or (None, None)
+            else:
+                outputFolder.mkdir(exist_ok=True)
+                tables, data = cache.get(key, files), None
+        if tables is not None:
+            log.info(f'Using cached conversion of image {image_path}')
+            return BuildResult(image_index, PictureTables(**tables), cache_hit=True, data=data)
+    artifacts = build_image(image_path, image_index, outputFolder, options, write_files=not packed)
+    result = BuildResult(image_index, artifacts.tables)
+    if packed:
+        result.data = {name: data for name, data in artifacts.data_files().items() if name in INCLUDED_DATA_FILES}
+    if cache is not None:
+        with stage('cache_store'):
+            if packed:
+                cache.put_data(key, artifacts.data_files(), asdict(artifacts.tables))
+            else:
+                cache.put(key, files, asdict(artifacts.tables))
+        result.cache_hit = False
+    return result
+
+
+def build_image_job(image_path: Path,
+                    image_index: int,
+                    log_level: int,
+                    cache: Optional[BuildCache],
+                    outputFolder: Path,
+                    options: BuildOptions,
+                    profile: bool = False,
+                    packed: bool = False) -> BuildResult:
+    """
+    Convert a single image with buffered logging, catching any error.
+
+    Runs either in the main process or in a worker process of the --jobs pool.
+
+    :param image_path:   Path to input image
+    :param image_index:  Index of image in assembly source
+    :param log_level:    Logging level to buffer messages at
+    :param cache:        Build cache to restore / store conversion from / to. None disables caching
+    :param outputFolder: Folder to write data files to
+    :param options:      Conversion settings
+    :param profile:      If true, record wall time and peak memory of each stage
+    :param packed:       If true, return contents of included data files instead of writing data files
+    :return:             BuildResult with table values, or error message
+    """
+    root_logger = log.getLogger()
+    old_handlers = root_logger.handlers[:]
+    old_level = root_logger.level
+    buffer = LogRecordBuffer(log_level)
+    root_logger.handlers = [buffer]
+    root_logger.setLevel(log_level)
+    collector = ProfileCollector() if profile else nullcontext()
+    try:
+        with collector:
+            result = build_image_cached(image_path, image_index, cache, outputFolder, options, packed=packed)
+    except Exception:
+        result = BuildResult(image_index, None, error=traceback.format_exc())
+    finally:
+        root_logger.handlers = old_handlers
+        root_logger.setLevel(old_level)
+    result.log_records = buffer.records
+    if profile:
+        result.profile = collector.records
+    return result
 
 
 def hi_and_lo_bytes(name: str, indices: List[int]) -> str:
@@ -204,17 +287,44 @@ def hi_and_lo_bytes(name: str, indices: List[int]) -> str:
     return '\n'.join([lo_bytes_str, hi_bytes_str])
 
 
-def builder_bytes(name: str, builder_accessor, builders: List[ScreenBuilder]) -> str:
+def packed_hi_and_lo_bytes(name: str, base: str, offsets: List[int]) -> str:
+    """
+    Create assembly source for separate table of lo / hi byte of addresses in packed data
+
+    :param name:    Name of of label
+    :param base:    Label of packed data
+    :param offsets: Offset from base of each entry in table
+    :return:        Assembly source string
+    """
+    lo_bytes_str = f'{name}_lo: .byte {",".join([f"<({base}+{offset})" for offset in offsets])}'
+    hi_bytes_str = f'{name}_hi: .byte {",".join([f">({base}+{offset})" for offset in offsets])}'
+    return '\n'.join([lo_bytes_str, hi_bytes_str])
+
+
+def address_hi_and_lo_bytes(name: str, addresses: List[str]) -> str:
+    """
+    Create assembly source for separate table of lo / hi byte of address expressions
+
+    :param name:      Name of of label
+    :param addresses: Address expression of each entry in table
+    :return:          Assembly source string
+    """
+    lo_bytes_str = f'{name}_lo: .byte {",".join([f"<({address})" for address in addresses])}'
+    hi_bytes_str = f'{name}_hi: .byte {",".join([f">({address})" for address in addresses])}'
+    return '\n'.join([lo_bytes_str, hi_bytes_str])
+
+
+def table_bytes(name: str, accessor, tables: List[PictureTables]) -> str:
     """
     Create assembly source of byte values given by applying an accessor function
-    to each ScreenBuilder in a list.
+    to each picture's table values in a list.
 
-    :param name:             Label
-    :param builder_accessor: Function to call for each builder
-    :params builders:        List of ScreenBuilder objects
-    :return:                 Assembly source string
+    :param name:     Label
+    :param accessor: Function to call for each picture's table values
+    :params tables:  List of PictureTables objects
+    :return:         Assembly source string
     """
-    values_str = ','.join([str(builder_accessor(builder)) for builder in builders])
+    values_str = ','.join([str(accessor(t)) for t in tables])
     return f'{name}: .byte {values_str}'
 
 
@@ -224,70 +334,568 @@ def copy_template_file(input_folder: Path, input_filename: Path, output_folder,
         f.write(text.format(OverlayPicPrefixDir=prefix_dir))
 
 
-def main(image_paths: List[Path],
-         outputFolder: Path,
-         logFilePath: Path,
-         palette_file: Path,
-         bg_palette: List[int],
-         spr_palette: List[int],
-         sprite_size_8x16: bool,
-         sprite0: bool,
-         max_bg_slots: int,
-         prg_bank: int,
-         prefix_dir: str):
-    # Read NES palette mapping file if present
-    if palette_file is not None:
-        with open(palette_file, 'rb') as f:
-            nes_palette = f.read(192)
-    else:
-        nes_palette = None
-    # Build each image
-    builders = []
-    for i, image_path in enumerate(image_paths):
-        builder = build_image(image_path, i, outputFolder, nes_palette, bg_palette, spr_palette, sprite_size_8x16, sprite0, max_bg_slots)
-        builders.append(builder)
+def write_includes(outputFolder: Path,
+                   tables: List[PictureTables],
+                   sprite_size_8x16: bool,
+                   prg_bank: int,
+                   prefix_dir: str,
+                   num_shared_tiles: int = 0,
+                   pack_offsets: Optional[Dict[str, List[int]]] = None,
+                   num_delta_frames: int = 0):
+    """
+    Write constants.inc and includes.inc for converted pictures
+
+    :param outputFolder:     Folder to write include files to
+    :param tables:           Table values of each picture, in picture index order
+    :param sprite_size_8x16: If true, use 8x16 sprites
+    :param prg_bank:         PRG bank assumed by generated code
+    :param prefix_dir:       Prefix directory path to prepend to included files
+    :param num_shared_tiles: Number of background tiles in shared CHR block, 0 if none
+    :param pack_offsets:     Label of data -> offset of data of each image in packed data file,
+                             or None to include a data file for each image
+    :param num_delta_frames: Number of delta frames in sequence data file, 0 if none
+    """
+    # Largest number of mid-frame CHR bank switches of any picture, generating code and tables for at least one
+    max_chr_splits = max([len(t.split_rows) for t in tables] + [1])
+    nametable_streaming = any(t.nametable_block_sizes for t in tables)
     # Constant symbols
     with open(outputFolder / 'constants.inc', 'wt') as f:
-        print(f'{BUILD_PREFIX_CONSTANT}NUM_PICTURES = {len(image_paths)}', file=f)
-        ppu_ctrl_bitmask = 0x20 if builder.sprites_8x16 else 0x00
+        print(f'{BUILD_PREFIX_CONSTANT}NUM_PICTURES = {len(tables)}', file=f)
+        ppu_ctrl_bitmask = 0x20 if sprite_size_8x16 else 0x00
         print(f'{BUILD_PREFIX_CONSTANT}8x16_PPUCTRL_BITMASK = ${ppu_ctrl_bitmask:02X}', file=f)
         print(f'{BUILD_PREFIX_CONSTANT}CHR_BANK_TOP = {1}', file=f)
         print(f'{BUILD_PREFIX_CONSTANT}CHR_BANK_BOTTOM = {2}', file=f)
         print(f'{BUILD_PREFIX_CONSTANT}PRG_BANK = {prg_bank}', file=f)
+        print(f'{BUILD_PREFIX_CONSTANT}NUM_SHARED_BG_TILES = {num_shared_tiles}', file=f)
+        print(f'{BUILD_PREFIX_CONSTANT}MAX_CHR_SPLITS = {max_chr_splits}', file=f)
+        print(f'{BUILD_PREFIX_CONSTANT}NAMETABLE_STREAMING = {int(nametable_streaming)}', file=f)
+        if num_delta_frames:
+            print(f'{BUILD_PREFIX_CONSTANT}SEQUENCE_NUM_DELTA_FRAMES = {num_delta_frames}', file=f)
     # Main include file
     with open(outputFolder / 'includes.inc', 'wt') as f:
-        chr_suffix = 'tc'
-        image_indices = range(0, len(image_paths))
-        # Write data
-        for image_index in image_indices:
-            print(f'{BUILD_PREFIX_DATA}BackgroundCHR_top_{image_index}: .incbin "{prefix_dir}bg_top_{image_index}.{chr_suffix}"', file=f)
-            print(f'{BUILD_PREFIX_DATA}BackgroundCHR_bottom_{image_index}: .incbin "{prefix_dir}bg_bottom_nc_{image_index}.{chr_suffix}"', file=f)
-            print(f'{BUILD_PREFIX_DATA}SpriteCHR_{image_index}: .incbin "{prefix_dir}spr_{image_index}.{chr_suffix}"', file=f)
-            print(f'{BUILD_PREFIX_DATA}NameTable_compressed_{image_index}: .incbin "{prefix_dir}nametable_compressed_{image_index}.bin"', file=f)
-            print(f'{BUILD_PREFIX_DATA}OAM_compressed_{image_index}: .incbin "{prefix_dir}oam_compressed_{image_index}.bin"', file=f)
-            print(f'{BUILD_PREFIX_DATA}Palettes_{image_index}: .incbin "{prefix_dir}palettes_{image_index}.bin"', file=f)
-        # Write data pointer tables
-        print(hi_and_lo_bytes(f'{BUILD_PREFIX_DATA}BackgroundCHR_top', image_indices), file=f)
-        print(hi_and_lo_bytes(f'{BUILD_PREFIX_DATA}BackgroundCHR_bottom', image_indices), file=f)
-        print(hi_and_lo_bytes(f'{BUILD_PREFIX_DATA}SpriteCHR', image_indices), file=f)
-        print(hi_and_lo_bytes(f'{BUILD_PREFIX_DATA}NameTable_compressed', image_indices), file=f)
-        print(hi_and_lo_bytes(f'{BUILD_PREFIX_DATA}OAM_compressed', image_indices), file=f)
-        print(hi_and_lo_bytes(f'{BUILD_PREFIX_DATA}Palettes', image_indices), file=f)
+        image_indices = range(0, len(tables))
+        if pack_offsets is None:
+            # Write data
+            for image_index in image_indices:
+                for name, label in INCLUDED_DATA_FILES.items():
+                    stem, suffix = name.rsplit('.', 1)
+                    print(f'{BUILD_PREFIX_DATA}{label}_{image_index}: .incbin "{prefix_dir}{stem}_{image_index}.{suffix}"', file=f)
+            if num_shared_tiles:
+                print(f'{BUILD_PREFIX_DATA}SharedBackgroundCHR: .incbin "{prefix_dir}bg_shared.tc"', file=f)
+            # Write data pointer tables
+            for label in INCLUDED_DATA_FILES.values():
+                print(hi_and_lo_bytes(f'{BUILD_PREFIX_DATA}{label}', image_indices), file=f)
+        else:
+            # Write packed data, and data pointer tables computed from offsets
+            print(f'{BUILD_PREFIX_DATA}Pack: .incbin "{prefix_dir}{PACK_FILENAME}"', file=f)
+            if num_shared_tiles:
+                print(f'{BUILD_PREFIX_DATA}SharedBackgroundCHR = {BUILD_PREFIX_DATA}Pack+{pack_offsets["SharedBackgroundCHR"][0]}', file=f)
+            for label in INCLUDED_DATA_FILES.values():
+                print(packed_hi_and_lo_bytes(f'{BUILD_PREFIX_DATA}{label}', f'{BUILD_PREFIX_DATA}Pack', pack_offsets[label]), file=f)
+        if num_delta_frames:
+            print(f'{BUILD_PREFIX_DATA}Sequence: .incbin "{prefix_dir}{SEQUENCE_FILENAME}"', file=f)
+        # Write pointer tables of further CHR bank sections, whose CHR follows that of the bottom section
+        for split in range(2, max_chr_splits + 1):
+            if pack_offsets is None:
+                bottom_chr = [f'{BUILD_PREFIX_DATA}BackgroundCHR_bottom_{image_index}' for image_index in image_indices]
+            else:
+                bottom_chr = [f'{BUILD_PREFIX_DATA}Pack+{offset}' for offset in pack_offsets['BackgroundCHR_bottom']]
+            offsets = [t.split_chr_offsets[split - 2] if len(t.split_chr_offsets) > split - 2 else 0 for t in tables]
+            print(address_hi_and_lo_bytes(f'{BUILD_PREFIX_DATA}BackgroundCHR_split{split}',
+                                          [f'{address}+{offset}' for address, offset in zip(bottom_chr, offsets)]), file=f)
+        # Write decompressed size of each streamed nametable block
+        if nametable_streaming:
+            for image_index, t in zip(image_indices, tables):
+                print(f'{BUILD_PREFIX_DATA}NameTableBlockSizes_{image_index}: .byte {",".join(str(size) for size in t.nametable_block_sizes)}', file=f)
+            print(hi_and_lo_bytes(f'{BUILD_PREFIX_DATA}NameTableBlockSizes', image_indices), file=f)
         # Write per-image tables
-        print(builder_bytes(f'{BUILD_PREFIX_DATA}NumBackgroundTilesTop', lambda builder: len(builder.tile_table_bg_top), builders), file=f)
-        print(builder_bytes(f'{BUILD_PREFIX_DATA}NumBackgroundTilesBottom', lambda builder: len(builder.tile_table_bg_bottom), builders), file=f)
-        print(builder_bytes(f'{BUILD_PREFIX_DATA}NumBackgroundTilesCommon', lambda builder: builder.num_common_tile_indices, builders), file=f)
-        print(builder_bytes(f'{BUILD_PREFIX_DATA}NumSpriteTiles', lambda builder: len(builder.tile_table_spr), builders), file=f)
-        print(builder_bytes(f'{BUILD_PREFIX_DATA}OamSize', lambda builder: len(builder.oam()), builders), file=f)
-        print(builder_bytes(f'{BUILD_PREFIX_DATA}NumSpriteTilePages', lambda builder: int(ceil(len(builder.tile_table_spr) / 16)), builders), file=f)
-        print(builder_bytes(f'{BUILD_PREFIX_DATA}SpriteTilesStartIndex', lambda builder: builder.sprite_tiles_start_index, builders), file=f)
-        print(builder_bytes(f'{BUILD_PREFIX_DATA}SpriteTilesStartPage', lambda builder: builder.sprite_tiles_start_page, builders), file=f)
-        print(builder_bytes(f'{BUILD_PREFIX_DATA}NumCommonBackgroundTilePages', lambda builder: int(ceil(builder.num_common_tile_indices / 16)), builders), file=f)
-        print(builder_bytes(f'{BUILD_PREFIX_DATA}BottomStartScanlineMinus1', lambda builder: builder.bottom_start_row * 8 - 1 if builder.bottom_start_row is not None else 239, builders), file=f)
-        print(builder_bytes(f'{BUILD_PREFIX_DATA}NameTableEncodingBits', lambda builder: builder.bottom_start_row if builder.bottom_start_row is not None else 30, builders), file=f)
+        # With shared CHR the top section can hold all 256 tiles, stored as 0 like the tile count of Tokumaru-compressed CHR
+        print(table_bytes(f'{BUILD_PREFIX_DATA}NumBackgroundTilesTop', lambda t: t.num_background_tiles_top & 0xFF, tables), file=f)
+        print(table_bytes(f'{BUILD_PREFIX_DATA}NumBackgroundTilesBottom', lambda t: t.num_background_tiles_bottom, tables), file=f)
+        print(table_bytes(f'{BUILD_PREFIX_DATA}NumBackgroundTilesCommon', lambda t: t.num_background_tiles_common, tables), file=f)
+        print(table_bytes(f'{BUILD_PREFIX_DATA}NumSpriteTiles', lambda t: t.num_sprite_tiles, tables), file=f)
+        print(table_bytes(f'{BUILD_PREFIX_DATA}OamSize', lambda t: t.oam_size, tables), file=f)
+        print(table_bytes(f'{BUILD_PREFIX_DATA}NumSpriteTilePages', lambda t: int(ceil(t.num_sprite_tiles / 16)), tables), file=f)
+        print(table_bytes(f'{BUILD_PREFIX_DATA}SpriteTilesStartIndex', lambda t: t.sprite_tiles_start_index, tables), file=f)
+        print(table_bytes(f'{BUILD_PREFIX_DATA}SpriteTilesStartPage', lambda t: t.sprite_tiles_start_page, tables), file=f)
+        print(table_bytes(f'{BUILD_PREFIX_DATA}NumCommonBackgroundTilePages', lambda t: int(ceil(t.num_background_tiles_common / 16)), tables), file=f)
+        print(table_bytes(f'{BUILD_PREFIX_DATA}BottomStartScanlineMinus1', lambda t: t.bottom_start_row * 8 - 1 if t.bottom_start_row is not None else 239, tables), file=f)
+        for split in range(2, max_chr_splits + 1):
+            print(table_bytes(f'{BUILD_PREFIX_DATA}Split{split}StartScanlineMinus1', lambda t: t.split_rows[split - 1] * 8 - 1 if len(t.split_rows) >= split else 239, tables), file=f)
+        print(table_bytes(f'{BUILD_PREFIX_DATA}NumSharedBackgroundTiles', lambda t: t.num_shared_background_tiles, tables), file=f)
+        print(table_bytes(f'{BUILD_PREFIX_DATA}NameTableEncodingBits', lambda t: t.bottom_start_row if t.bottom_start_row is not None else 30, tables), file=f)
         # Write constants
         print(f'.include "{prefix_dir}constants.inc"', file=f)
-    # Copy sources
+
+
+def build_images(image_paths: List[Path], jobs: int, cache: Optional[BuildCache], outputFolder: Path, options: BuildOptions,
+                 profile: bool = False, image_indices: Optional[Sequence[int]] = None, packed: bool = False) -> List[BuildResult]:
+    """
+    Convert images, optionally in a pool of worker processes.
+
+    Log messages of each image are buffered and re-emitted in image order once
+    the image is done, so output stays readable and deterministic.
+
+    :param image_paths:   Paths to input images
+    :param jobs:          Number of worker processes. 1 converts images in this process
+    :param cache:         Build cache, or None to disable caching
+    :param outputFolder:  Folder to write data files to
+    :param options:       Conversion settings
+    :param profile:       If true, record wall time and peak memory of each stage
+    :param image_indices: Indices of images to convert, or None to convert all images
+    :param packed:        If true, return contents of included data files instead of writing data files
+    :return:              List of BuildResult, in order of image_indices
+    """
+    log_level = log.getLogger().getEffectiveLevel()
+    if image_indices is None:
+        image_indices = range(len(image_paths))
+    results = []
+
+    def report(result: BuildResult):
+        for level, message in result.log_records:
+            log.log(level, message)
+        if result.error is not None:
+            log.error(f'Converting image {image_paths[result.image_index]} failed:\n{result.error}')
+        results.append(result)
+
+    if jobs <= 1 or len(image_indices) <= 1:
+        for i in image_indices:
+            report(build_image_job(image_paths[i], i, log_level, cache, outputFolder, options, profile=profile, packed=packed))
+        return results
+    with ProcessPoolExecutor(max_workers=min(jobs, len(image_indices))) as executor:
+        futures = [executor.submit(build_image_job, image_paths[i], i, log_level, cache, outputFolder, options,
+                                   profile=profile, packed=packed)
+                   for i in image_indices]
+        for i, future in zip(image_indices, futures):
+            try:
+                report(future.result())
+            except Exception as e:
+                # Worker process died, e.g. from running out of memory
+                report(BuildResult(i, None, [], f'{type(e).__name__}: {e}'))
+    return results
+
+
+def shareable_background_tiles(image_path: Path,
+                               sprite_size_8x16: bool,
+                               sprite0: bool,
+                               max_bg_slots: int,
+                               merge_tiles_max_error: int = 0) -> Optional[Tuple[List[bytes], int]]:
+    """
+    Convert image to find the background tiles it could share with other pictures
+
+    :param image_path: Path to input image
+    :return:           Background tiles and compressed size of their CHR,
+                       or None for pictures with a CHR split, which can't share tiles
+    """
+    # Messages and errors are reported when the image is converted for real
+    log.disable(log.CRITICAL)
+    try:
+        image = Image.open(image_path)
+        image.load()
+        builder = ScreenBuilder(image, sprite_size_8x16, sprite0, max_bg_slots, merge_tiles_max_error=merge_tiles_max_error)
+    except Exception:
+        return None
+    finally:
+        log.disable(log.NOTSET)
+    if builder.bottom_start_row is not None:
+        return None
+    return builder.tile_table_bg_top.data, len(tokumaru_compressed(builder.chr_bg_top().tobytes()))
+
+
+def find_shared_tiles(image_paths: List[Path],
+                      jobs: int,
+                      sprite_size_8x16: bool,
+                      sprite0: bool,
+                      max_bg_slots: int,
+                      merge_tiles_max_error: int = 0) -> Tuple[List[bytes], List[Optional[Tuple[List[bytes], int]]]]:
+    """
+    Choose background tiles to share between all pictures without CHR split
+
+    :param image_paths: Paths to input images
+    :param jobs:        Number of worker processes. 1 converts images in this process
+    :return:            Shared tiles, and result of shareable_background_tiles for each image
+    """
+    args = [image_paths, itertools.repeat(sprite_size_8x16), itertools.repeat(sprite0), itertools.repeat(max_bg_slots),
+            itertools.repeat(merge_tiles_max_error)]
+    with stage('find_shared_tiles'):
+        if jobs <= 1 or len(image_paths) <= 1:
+            shareable = list(map(shareable_background_tiles, *args))
+        else:
+            with ProcessPoolExecutor(max_workers=min(jobs, len(image_paths))) as executor:
+                shareable = list(executor.map(shareable_background_tiles, *args))
+        shared_tiles = shared_tile_dictionary([s[0] if s is not None else None for s in shareable], max_bg_slots)
+    return shared_tiles, shareable
+
+
+def write_shared_tiles(outputFolder: Path,
+                       shared_tiles: List[bytes],
+                       shareable: List[Optional[Tuple[List[bytes], int]]],
+                       tables: List[PictureTables],
+                       packed_data: Optional[List[Dict[str, bytes]]] = None) -> Optional[bytes]:
+    """
+    Write shared background CHR block, and log the ROM space and load time saved by it
+
+    :param outputFolder: Folder to write data files to
+    :param shared_tiles: Shared background tiles
+    :param shareable:    Result of shareable_background_tiles for each image
+    :param tables:       Table values of each picture
+    :param packed_data:  Included data files of each image if packing data, in which case no files are written
+    :return:             Compressed shared background CHR, or None if no tiles are shared
+    """
+    if not shared_tiles:
+        log.info('Shared background CHR: no tiles are used by more than one picture')
+        return None
+    chr_shared = ScreenBuilder.chr(shared_tiles).tobytes()
+    chr_shared_compressed = tokumaru_compressed(chr_shared)
+    if packed_data is None:
+        with open(outputFolder / 'bg_shared.chr', 'wb') as f:
+            f.write(chr_shared)
+        with open(outputFolder / 'bg_shared.tc', 'wb') as f:
+            f.write(chr_shared_compressed)
+    sharing = [i for i, t in enumerate(tables) if t.num_shared_background_tiles]
+    size_unshared = sum(shareable[i][1] for i in sharing)
+    if packed_data is None:
+        size_shared = len(chr_shared_compressed) + sum((outputFolder / f'bg_top_{i}.tc').stat().st_size for i in sharing)
+    else:
+        size_shared = len(chr_shared_compressed) + sum(len(packed_data[i]['bg_top.tc']) for i in sharing)
+    log.info(f'Shared background CHR: {len(shared_tiles)} tiles shared by {len(sharing)} of {len(tables)} pictures')
+    log.info(f'Shared background CHR: {size_unshared} bytes without sharing, {size_shared} bytes with sharing '
+             f'({size_unshared - size_shared} bytes of ROM saved)')
+    # Decompression time is roughly proportional to the number of tiles
+    tiles_unshared = sum(len(shareable[i][0]) for i in sharing)
+    tiles_shared = len(shared_tiles) + sum(tables[i].num_background_tiles_top - len(shared_tiles) for i in sharing)
+    log.info(f'Shared background CHR: loading the pictures in sequence decompresses {tiles_shared} background tiles instead of {tiles_unshared} '
+             f'({100.0 * (1.0 - tiles_shared / tiles_unshared):.1f}% less background CHR load time)')
+    return chr_shared_compressed
+
+
+def write_pack(outputFolder: Path,
+               packed_data: List[Dict[str, bytes]],
+               chr_shared_compressed: Optional[bytes]) -> Dict[str, List[int]]:
+    """
+    Write included data of all images to a single data file, with a single write.
+    Identical data, such as the palettes of a sequence of pictures, is only stored once.
+
+    :param outputFolder:          Folder to write data file to
+    :param packed_data:           Included data files of each image
+    :param chr_shared_compressed: Compressed shared background CHR, or None
+    :return:                      Label of data -> offset of data of each image in data file
+    """
+    chunks = []
+    chunk_offsets: Dict[bytes, int] = {}
+    size = 0
+
+    def add(data: bytes) -> int:
+        nonlocal size
+        offset = chunk_offsets.get(data)
+        if offset is None:
+            offset = chunk_offsets[data] = size
+            chunks.append(data)
+            size += len(data)
+        return offset
+
+    offsets = {label: [add(data[name]) for data in packed_data] for name, label in INCLUDED_DATA_FILES.items()}
+    unpacked_size = sum(len(data[name]) for data in packed_data for name in INCLUDED_DATA_FILES)
+    if chr_shared_compressed is not None:
+        offsets['SharedBackgroundCHR'] = [add(chr_shared_compressed)]
+        unpacked_size += len(chr_shared_compressed)
+    with stage('write_pack'):
+        with open(outputFolder / PACK_FILENAME, 'wb') as f:
+            f.write(b''.join(chunks))
+    log.info(f'Packed data: {size} bytes in {PACK_FILENAME} ({unpacked_size - size} bytes saved by storing identical data once)')
+    if size > PRG_BANK_SIZE:
+        log.warning(f'Packed data of {size} bytes does not fit in a {PRG_BANK_SIZE} byte PRG bank')
+    return offsets
+
+
+def write_build_data(outputFolder: Path,
+                     tables: List[PictureTables],
+                     packed_data: Optional[List[Dict[str, bytes]]],
+                     shared_tiles: Optional[List[bytes]],
+                     shareable: Optional[List[Optional[Tuple[List[bytes], int]]]],
+                     sprite_size_8x16: bool,
+                     prg_bank: int,
+                     prefix_dir: str,
+                     written_includes: Optional[tuple] = None,
+                     num_delta_frames: int = 0) -> tuple:
+    """
+    Write data common to all images, and the include files unless unchanged
+
+    :param outputFolder:     Folder to write files to
+    :param tables:           Table values of each picture
+    :param packed_data:      Included data files of each image if packing data, otherwise None
+    :param shared_tiles:     Shared background tiles, or None if not sharing tiles
+    :param shareable:        Result of shareable_background_tiles for each image, if sharing tiles
+    :param written_includes: Values last written to include files, or None
+    :param num_delta_frames: Number of delta frames in sequence data file, 0 if none
+    :return:                 Values written to include files
+    """
+    chr_shared_compressed = None
+    if shared_tiles is not None:
+        chr_shared_compressed = write_shared_tiles(outputFolder, shared_tiles, shareable, tables, packed_data)
+    pack_offsets = write_pack(outputFolder, packed_data, chr_shared_compressed) if packed_data is not None else None
+    includes = (list(tables), pack_offsets, num_delta_frames)
+    if includes != written_includes:
+        with stage('write_includes'):
+            write_includes(outputFolder, tables, sprite_size_8x16, prg_bank, prefix_dir, len(shared_tiles or []), pack_offsets,
+                           num_delta_frames)
+    return includes
+
+
+def write_profile_report(report_path: Path,
+                         image_paths: List[Path],
+                         results: List[BuildResult],
+                         build_records: List[dict],
+                         jobs: int,
+                         total_wall_time: float):
+    """
+    Write JSON report of profiled stages and print a summary table
+
+    :param report_path:     Path of JSON report
+    :param image_paths:     Paths to input images
+    :param results:         BuildResult of each image, with profile records
+    :param build_records:   Profile records of stages run once for all images
+    :param jobs:            Number of worker processes
+    :param total_wall_time: Wall time of whole build in seconds
+    """
+    report = {
+        'total_wall_time': total_wall_time,
+        'jobs': jobs,
+        'images': [{'index': result.image_index,
+                    'path': str(image_paths[result.image_index]),
+                    'cache_hit': result.cache_hit,
+                    'load_cycles': result.tables.load_cycles if result.tables is not None else None,
+                    'load_frames': sum(result.tables.load_cycles.values()) / CPU_CYCLES_PER_FRAME if result.tables is not None else None,
+                    'stages': result.profile} for result in results],
+        'build': build_records,
+    }
+    with open(report_path, 'wt') as f:
+        json.dump(report, f, indent=2)
+    all_records = [record for result in results for record in result.profile] + build_records
+    print(summary_table(all_records))
+    print(f'Total wall time: {1000 * total_wall_time:.1f} ms. Profile written to {report_path}')
+
+
+def read_nes_palette(palette_file: Optional[Path]) -> Optional[bytes]:
+    """
+    Read NES palette mapping file if present
+
+    :param palette_file: Path to 192-byte .pal file, or None
+    :return:             NES color palette as 64 RGB values, or None
+    """
+    if palette_file is None:
+        return None
+    with open(palette_file, 'rb') as f:
+        return f.read(192)
+
+
+def log_cache_statistics(cache: Optional[BuildCache], results: List[BuildResult]):
+    """
+    Log build cache hits and misses, and evict least recently used entries
+    """
+    if cache is None:
+        return
+    num_hits = sum(result.cache_hit is True for result in results)
+    num_misses = sum(result.cache_hit is False for result in results)
+    log.info(f'Build cache: {num_hits} hits, {num_misses} misses')
+    num_evicted = cache.evict()
+    if num_evicted:
+        log.info(f'Build cache: evicted {num_evicted} least recently used entries')
+
+
+def log_load_times(image_paths: List[Path], tables: List[Optional[PictureTables]], max_load_frames: float = 0) -> int:
+    """
+    Log estimated time taken by CrunchyLib_LoadPicture to load each picture
+
+    :param image_paths:     Paths to input images
+    :param tables:          Table values of each picture, None for failed pictures
+    :param max_load_frames: If non-zero, log an error for pictures taking more NTSC frames to load
+    :return:                Number of pictures taking more than max_load_frames to load
+    """
+    num_over_budget = 0
+    for image_path, t in zip(image_paths, tables):
+        if t is None or not t.load_cycles:
+            continue
+        cycles = sum(t.load_cycles.values())
+        frames = cycles / CPU_CYCLES_PER_FRAME
+        steps = ', '.join(f'{step} {step_cycles}' for step, step_cycles in t.load_cycles.items())
+        log.info(f'Load time of image {image_path}: {cycles} CPU cycles, {frames:.2f} frames ({steps})')
+        if max_load_frames and frames > max_load_frames:
+            log.error(f'Image {image_path} takes an estimated {frames:.2f} frames to load, more than max_load_frames = {max_load_frames}')
+            num_over_budget += 1
+    return num_over_budget
+
+
+def verify_images(outputFolder: Path,
+                  image_paths: List[Path],
+                  tables: List[Optional[PictureTables]],
+                  packed_data: List[Optional[Dict[str, bytes]]],
+                  shared_tiles: Optional[List[bytes]],
+                  nes_palette: Optional[bytes],
+                  sprite_size_8x16: bool,
+                  sprite0: bool,
+                  lossy: bool = False) -> int:
+    """
+    Render each picture from its included data, decoded the way CrunchyLib does, and compare it to its image pixel by pixel.
+
+    The rendered picture of a differing image is written to verify_<index>.png if the NES palette is known.
+
+    :param outputFolder:  Folder data files were written to
+    :param image_paths:   Paths to input images
+    :param tables:        Table values of each picture, None for failed pictures
+    :param packed_data:   Included data files of each picture if packing data, otherwise data is read from the data files
+    :param shared_tiles:  Shared background tiles, or None if not sharing tiles
+    :param nes_palette:   NES color palette as 64 RGB values, or None
+    :param lossy:         If true, differences are expected, and only logged
+    :return:              Number of pictures differing from their image, unless lossy
+    """
+    chr_shared_compressed = tokumaru_compressed(ScreenBuilder.chr(shared_tiles).tobytes()) if shared_tiles else b''
+    num_differing = 0
+    for i, t in enumerate(tables):
+        if t is None:
+            continue
+        with stage('verify'):
+            data = included_data(outputFolder, packed_data, i)
+            picture = render_data_files(t, data, sprite_size_8x16, chr_shared_compressed)
+            matches = verify_picture(outputFolder, image_paths[i], data['palettes.bin'], picture, f'verify_{i}.png', nes_palette, sprite0, lossy)
+        num_differing += not matches
+    return num_differing
+
+
+def verify_picture(outputFolder: Path,
+                   image_path: Path,
+                   palettes: bytes,
+                   picture: np.ndarray,
+                   render_filename: str,
+                   nes_palette: Optional[bytes],
+                   sprite0: bool,
+                   lossy: bool,
+                   description: str = 'rendered picture') -> bool:
+    """
+    Compare a rendered picture to its image pixel by pixel, writing the rendered picture if it differs and the NES palette is known
+
+    :param image_path:      Path to input image
+    :param palettes:        Palettes of the picture converted from the image
+    :param picture:         Rendered picture, from render_picture
+    :param render_filename: File name to write rendered picture to
+    :param lossy:           If true, differences are expected, and only logged
+    :param description:     Description of rendered picture for log messages
+    :return:                False if the rendered picture differs from the image, unless lossy
+    """
+    differing = differing_pixels(np.asarray(Image.open(image_path), dtype=np.uint8), palettes, picture, sprite0)
+    if not differing.any():
+        log.info(f'Verified image {image_path}: {description} matches the image')
+        return True
+    y, x = (int(v[0]) for v in np.nonzero(differing))
+    message = f'Image {image_path}: {int(differing.sum())} pixels of the {description} differ from the image, first at ({x},{y})'
+    if nes_palette is not None:
+        Image.fromarray(ppu_colors_to_rgb(picture, nes_palette)).save(outputFolder / render_filename)
+        message += f'. Rendered picture written to {render_filename}'
+    if lossy:
+        log.info(message)
+        return True
+    log.error(message)
+    return False
+
+
+def included_data(outputFolder: Path, packed_data: List[Optional[Dict[str, bytes]]], image_index: int) -> Dict[str, bytes]:
+    """
+    :param outputFolder: Folder data files were written to
+    :param packed_data:  Included data files of each picture if packing data, otherwise data is read from the data files
+    :param image_index:  Index of picture
+    :return:             Data file name, without image index suffix -> file contents, for the included data files of picture
+    """
+    if packed_data[image_index] is not None:
+        return packed_data[image_index]
+    files = artifact_files(outputFolder, image_index)
+    return {name: files[name].read_bytes() for name in INCLUDED_DATA_FILES}
+
+
+def build_sequence(outputFolder: Path,
+                   image_paths: List[Path],
+                   tables: List[PictureTables],
+                   packed_data: List[Optional[Dict[str, bytes]]],
+                   sprite_size_8x16: bool,
+                   max_bg_slots: int,
+                   vblank_cycles: int) -> Optional[int]:
+    """
+    Encode the pictures as an animation sequence, and write its data file: Following the first picture,
+    a delta frame changes each picture to the next one, and the last picture back to the first one.
+
+    Delta frames place new tiles in the background pattern table up to max_bg_slots, and in the sprite pattern table
+    from its end, like the sprite tiles of pictures.
+
+    :param outputFolder:  Folder to write data file to
+    :param image_paths:   Paths to input images
+    :param tables:        Table values of each picture
+    :param packed_data:   Included data files of each picture if packing data, otherwise data is read from the data files
+    :param max_bg_slots:  Maximum number of background tile slots
+    :param vblank_cycles: Budget of CPU cycles for applying each chunk of a delta frame
+    :return:              Number of delta frames, or None if the pictures can't be encoded as a sequence
+    """
+    # Sprite tiles before the sprite#0 tile, which is always the last one
+    sprite_slots = range((0xFF >> int(sprite_size_8x16)) - 1, -1, -1)
+    with stage('sequence'):
+        states = []
+        for i, t in enumerate(tables):
+            try:
+                states.append(loaded_picture_state(t, included_data(outputFolder, packed_data, i), sprite_size_8x16))
+            except ValueError as e:
+                log.error(f'Image {image_paths[i]} can\'t be part of a sequence: {e}')
+                return None
+        try:
+            frames = sequence_deltas(states, sprite_size_8x16, range(max_bg_slots), sprite_slots, vblank_cycles)
+        except ValueError as e:
+            log.error(f'Images can\'t be encoded as a sequence: {e}')
+            return None
+        data = b''.join(frame.data() for frame in frames)
+        with open(outputFolder / SEQUENCE_FILENAME, 'wb') as f:
+            f.write(data)
+    for i, frame in enumerate(frames):
+        log.info(f'Delta frame to image {image_paths[(i + 1) % len(frames)]}: {len(frame.data())} bytes in {len(frame.chunks)} chunks ' +
+                 f'of up to {max(frame.chunk_cycles)} CPU cycles, {frame.num_new_background_tiles} new background tiles, ' +
+                 f'{frame.num_new_sprite_tiles} new sprite tiles')
+    log.info(f'Sequence: {len(data)} bytes in {SEQUENCE_FILENAME}, played at up to ' +
+             f'{60 / max(len(frame.chunks) for frame in frames):.1f} frames per second by applying one chunk per vblank')
+    return len(frames)
+
+
+def verify_sequence(outputFolder: Path,
+                    image_paths: List[Path],
+                    tables: List[PictureTables],
+                    packed_data: List[Optional[Dict[str, bytes]]],
+                    nes_palette: Optional[bytes],
+                    sprite_size_8x16: bool,
+                    sprite0: bool,
+                    lossy: bool = False) -> int:
+    """
+    Render each picture of a sequence after applying the delta frames to the first picture the way CrunchyLib does,
+    and compare it to its image pixel by pixel.
+
+    The rendered picture of a differing image is written to verify_sequence_<index>.png if the NES palette is known.
+
+    :param outputFolder: Folder data files were written to
+    (remaining parameters as for verify_images)
+    :return:             Number of delta frames resulting in a picture differing from its image, unless lossy
+    """
+    num_differing = 0
+    with stage('verify'):
+        data = (outputFolder / SEQUENCE_FILENAME).read_bytes()
+        state = loaded_picture_state(tables[0], included_data(outputFolder, packed_data, 0), sprite_size_8x16)
+        pos = 0
+        for i in list(range(1, len(tables))) + [0]:
+            pos = apply_delta_frame(state, data, pos)
+            picture = render_picture(state.nametable, state.palettes, state.oam, [state.chr], [], sprite_size_8x16)
+            palettes = included_data(outputFolder, packed_data, i)['palettes.bin']
+            num_differing += not verify_picture(outputFolder, image_paths[i], palettes, picture, f'verify_sequence_{i}.png', nes_palette,
+                                                sprite0, lossy, 'picture rendered after applying the delta frames')
+    return num_differing
+
+
+def copy_sources(outputFolder: Path, prefix_dir: str):
+    """
+    Copy CrunchyLib / CrunchyView sources and assembler build files to output folder
+    """
     scriptFolder = get_script_directory()
     # CrunchyLib / CrunchyView
     copy_template_file(scriptFolder / 'asm', 'crunchylib.asm', outputFolder, prefix_dir)
@@ -303,6 +911,217 @@ def main(image_paths: List[Path],
     shutil.copy2(scriptFolder / 'asm' / 'main_asm6.asm', outputFolder)
 
 
+def watch_images(watcher: FileWatcher,
+                 image_paths: List[Path],
+                 outputFolder: Path,
+                 palette_file: Optional[Path],
+                 options: BuildOptions,
+                 prg_bank: int,
+                 prefix_dir: str,
+                 jobs: int,
+                 cache: Optional[BuildCache],
+                 max_load_frames: float,
+                 verify: bool,
+                 sequence: bool,
+                 sequence_vblank_cycles: int,
+                 shared_chr: bool,
+                 packed: bool,
+                 profile: bool,
+                 tables: List[Optional[PictureTables]],
+                 packed_data: List[Optional[Dict[str, bytes]]],
+                 written_includes: Optional[tuple]):
+    """
+    Rebuild images whenever their files change, until interrupted with Ctrl+C.
+
+    Only the changed images are converted again, or all images if the palette file changed
+    or tiles are shared between images.
+    Include files are only rewritten when the table values of a picture changed, so that
+    assembler builds depending on them aren't triggered needlessly.
+
+    :param watcher:          Watcher of the image files and palette file
+    :param options:          Conversion settings of the last build
+    :param tables:           Table values of each picture from the last build, None for failed pictures
+    :param packed_data:      Included data files of each picture from the last build, if packing data
+    :param written_includes: Values last written to include files, or None if not written
+    (remaining parameters as for main)
+    """
+    paths = [Path(image_path) for image_path in image_paths]
+    print(f'Watching {len(paths)} images for changes. Press Ctrl+C to stop')
+    try:
+        while True:
+            changed = watcher.wait_for_changes()
+            start_time = time.perf_counter()
+            if palette_file is not None and Path(palette_file) in changed:
+                log.info(f'Palette file {palette_file} changed, rebuilding all images')
+                options = replace(options, nes_palette=read_nes_palette(palette_file))
+                image_indices = list(range(len(paths)))
+            elif shared_chr:
+                image_indices = list(range(len(paths)))
+            else:
+                image_indices = [i for i, path in enumerate(paths) if path in changed]
+            collector = ProfileCollector() if profile else nullcontext()
+            shareable = None
+            if shared_chr:
+                with collector:
+                    shared_tiles, shareable = find_shared_tiles(image_paths, jobs, options.sprite_size_8x16, options.sprite0, options.max_bg_slots,
+                                                                options.merge_tiles_max_error)
+                options = replace(options, shared_tiles=shared_tiles)
+            results = build_images(image_paths, jobs, cache, outputFolder, options, profile=profile, image_indices=image_indices, packed=packed)
+            log_cache_statistics(cache, results)
+            for result in results:
+                tables[result.image_index] = result.tables
+                packed_data[result.image_index] = result.data
+            includes_written = False
+            num_over_budget = log_load_times(image_paths, tables, max_load_frames)
+            num_differing = 0
+            if verify:
+                # All pictures are verified again, as verifying is much faster than converting
+                with collector:
+                    num_differing = verify_images(outputFolder, image_paths, tables, packed_data, options.shared_tiles, options.nes_palette,
+                                                  options.sprite_size_8x16, options.sprite0, options.merge_tiles_max_error > 0)
+            num_delta_frames, num_differing_frames = 0, 0
+            if sequence and all(t is not None for t in tables):
+                with collector:
+                    num_delta_frames = build_sequence(outputFolder, image_paths, tables, packed_data, options.sprite_size_8x16,
+                                                      options.max_bg_slots, sequence_vblank_cycles)
+                    if verify and num_delta_frames is not None:
+                        num_differing_frames = verify_sequence(outputFolder, image_paths, tables, packed_data, options.nes_palette,
+                                                               options.sprite_size_8x16, options.sprite0, options.merge_tiles_max_error > 0)
+            if any(t is None for t in tables):
+                log.error(f'{sum(t is None for t in tables)} of {len(tables)} images failed to convert - include files not updated')
+            elif num_delta_frames is None:
+                log.error('Images could not be encoded as a sequence - include files not updated')
+            elif num_over_budget:
+                log.error(f'{num_over_budget} of {len(tables)} images exceed max_load_frames - include files not updated')
+            elif num_differing:
+                log.error(f'{num_differing} of {len(tables)} images differ from their rendered pictures - include files not updated')
+            elif num_differing_frames:
+                log.error(f'{num_differing_frames} of {num_delta_frames} delta frames result in pictures differing from their images ' +
+                          '- include files not updated')
+            else:
+                with collector:
+                    # Only the first picture of a sequence is loaded as a picture
+                    num_pictures = 1 if sequence else len(tables)
+                    includes = write_build_data(outputFolder, tables[:num_pictures], packed_data[:num_pictures] if packed else None,
+                                                options.shared_tiles, shareable, options.sprite_size_8x16, prg_bank, prefix_dir, written_includes,
+                                                num_delta_frames)
+                includes_written = includes != written_includes
+                written_includes = includes
+            if profile:
+                write_profile_report(outputFolder / 'profile.json', image_paths, results, collector.records, jobs, time.perf_counter() - start_time)
+            print(f'Rebuilt {len(results)} of {len(paths)} images in {1000 * (time.perf_counter() - start_time):.0f} ms' +
+                  (', include files updated' if includes_written else ''))
+    except KeyboardInterrupt:
+        print('Stopped watching')
+
+
+def main(image_paths: List[Path],
+         outputFolder: Path,
+         logFilePath: Path,
+         palette_file: Path,
+         bg_palette: List[int],
+         spr_palette: List[int],
+         sprite_size_8x16: bool,
+         sprite0: bool,
+         max_bg_slots: int,
+         prg_bank: int,
+         prefix_dir: str,
+         jobs: int = 1,
+         cache: Optional[BuildCache] = None,
+         nametable_compression: str = 'greedy',
+         profile: bool = False,
+         shared_chr: bool = False,
+         packed: bool = False,
+         watch: bool = False,
+         watch_interval: float = 0.25,
+         watch_debounce: float = 0.5,
+         palette_metric: str = 'rgb',
+         chr_split_objective: str = 'cpu_time',
+         sprite_packing: str = 'grid',
+         merge_tiles_max_error: int = 0,
+         nametable_block_cycles: int = 0,
+         max_load_frames: float = 0,
+         verify: bool = False,
+         sequence: bool = False,
+         sequence_vblank_cycles: int = 1200):
+    start_time = time.perf_counter()
+    if watch:
+        # Take state of files before building, so edits made during the build trigger a rebuild
+        watched_paths = [Path(image_path) for image_path in image_paths] + ([Path(palette_file)] if palette_file is not None else [])
+        watcher = FileWatcher(watched_paths, watch_interval, watch_debounce)
+    options = BuildOptions(nes_palette=read_nes_palette(palette_file),
+                           bg_palette=bg_palette,
+                           spr_palette=spr_palette,
+                           sprite_size_8x16=sprite_size_8x16,
+                           sprite0=sprite0,
+                           max_bg_slots=max_bg_slots,
+                           nametable_compression=nametable_compression,
+                           palette_metric=palette_metric,
+                           chr_split_objective=chr_split_objective,
+                           sprite_packing=sprite_packing,
+                           merge_tiles_max_error=merge_tiles_max_error,
+                           nametable_block_cycles=nametable_block_cycles)
+    collector = ProfileCollector() if profile else nullcontext()
+    shareable = None
+    if shared_chr:
+        with collector:
+            shared_tiles, shareable = find_shared_tiles(image_paths, jobs, sprite_size_8x16, sprite0, max_bg_slots, merge_tiles_max_error)
+        options = replace(options, shared_tiles=shared_tiles)
+    # Build each image
+    outputFolder.mkdir(exist_ok=True)
+    results = build_images(image_paths, jobs, cache, outputFolder, options, profile=profile, packed=packed)
+    log_cache_statistics(cache, results)
+    tables = [result.tables for result in results]
+    packed_data = [result.data for result in results]
+    written_includes = None
+    num_over_budget = log_load_times(image_paths, tables, max_load_frames)
+    num_differing = 0
+    if verify:
+        with collector:
+            num_differing = verify_images(outputFolder, image_paths, tables, packed_data, options.shared_tiles, options.nes_palette,
+                                          sprite_size_8x16, sprite0, merge_tiles_max_error > 0)
+    num_delta_frames, num_differing_frames = 0, 0
+    if sequence and all(t is not None for t in tables):
+        with collector:
+            num_delta_frames = build_sequence(outputFolder, image_paths, tables, packed_data, sprite_size_8x16, max_bg_slots, sequence_vblank_cycles)
+            if verify and num_delta_frames is not None:
+                num_differing_frames = verify_sequence(outputFolder, image_paths, tables, packed_data, options.nes_palette, sprite_size_8x16,
+                                                       sprite0, merge_tiles_max_error > 0)
+    if any(result.error is not None for result in results):
+        log.error(f'{sum(result.error is not None for result in results)} of {len(results)} images failed to convert')
+        if not watch:
+            return 1
+    elif num_delta_frames is None:
+        log.error('Images could not be encoded as a sequence')
+        if not watch:
+            return 1
+    elif num_over_budget:
+        log.error(f'{num_over_budget} of {len(results)} images exceed max_load_frames')
+        if not watch:
+            return 1
+    elif num_differing:
+        log.error(f'{num_differing} of {len(results)} images differ from their rendered pictures')
+        if not watch:
+            return 1
+    elif num_differing_frames:
+        log.error(f'{num_differing_frames} of {num_delta_frames} delta frames result in pictures differing from their images')
+        if not watch:
+            return 1
+    else:
+        with collector:
+            # Only the first picture of a sequence is loaded as a picture
+            num_pictures = 1 if sequence else len(tables)
+            written_includes = write_build_data(outputFolder, tables[:num_pictures], packed_data[:num_pictures] if packed else None,
+                                                options.shared_tiles, shareable, sprite_size_8x16, prg_bank, prefix_dir, num_delta_frames=num_delta_frames)
+        if profile:
+            write_profile_report(outputFolder / 'profile.json', image_paths, results, collector.records, jobs, time.perf_counter() - start_time)
+    copy_sources(outputFolder, prefix_dir)
+    if watch:
+        watch_images(watcher, image_paths, outputFolder, palette_file, options, prg_bank, prefix_dir, jobs, cache,
+                     max_load_frames, verify, sequence, sequence_vblank_cycles, shared_chr, packed, profile,
+                     tables, packed_data, written_includes)
+
+
 def get_pal_file_path(pal_file_path: str) -> Path:
     """
     Convert a string path to Pathlib path.
@@ -324,6 +1143,8 @@ def get_pal_file_path(pal_file_path: str) -> Path:
 
 
 if __name__ == '__main__':
+    # Allow worker processes in executable built with pyinstaller
+    multiprocessing.freeze_support()
     parser = argparse.ArgumentParser(description=f'CrunchyNES image converter {VERSION_STRING}')
     parser.add_argument('--input', type=str, required=True,
                         nargs='+',
@@ -357,11 +1178,75 @@ if __name__ == '__main__':
                         default=None,
                         help='Binary 192-byte file specifying a particular NES palette. '
                              'NES PPU colors will be created by color mapping')
+    parser.add_argument('--palette_metric', type=str,
+                        default='rgb',
+                        choices=list(PALETTE_METRICS),
+                        help='Color distance for mapping image colors to the NES palette. "rgb" is the squared RGB distance, '
+                             '"redmean" and "lab" (CIE76) approximate perceived color difference')
     parser.add_argument('--prefix_dir', type=str,
                         default='',
                         help='Prefix directory path to prepend to files included in source. Must include trailing separator. '
                              'If using ASM6 as assembler this is needed to correctly use source directory instead of CWD.'
                              'With CA65 this parameter is redundant.')
+    parser.add_argument('--nametable_compression', type=str,
+                        default='greedy',
+                        choices=list(RLEI_COMPRESSORS),
+                        help='Nametable RLEi encoder. "optimal" finds the smallest encoding, but is slower than "greedy"')
+    parser.add_argument('--chr_split_objective', type=str,
+                        default='cpu_time',
+                        choices=CHR_SPLIT_OBJECTIVES,
+                        help='How to choose the rows to switch CHR bank at, for pictures using more than one CHR bank. '
+                             '"cpu_time" switches as high up as possible, leaving the most frame time after the last switch. '
+                             '"common_tiles" minimizes the tiles duplicated in several banks. '
+                             '"compressed_chr" minimizes the compressed CHR size, but is slower')
+    parser.add_argument('--sprite_packing', type=str,
+                        default='grid',
+                        choices=SPRITE_PACKINGS,
+                        help='How to place sprites. "grid" places sprites on the sprite grid. '
+                             '"free" places sprites at any position to use fewer sprites, '
+                             'while keeping within 8 sprites per scanline where possible')
+    parser.add_argument('--merge_tiles_max_error', type=int, default=0,
+                        help='If non-zero, pictures needing a mid-frame CHR bank switch instead merge similar background tiles '
+                             'differing in up to this many bitplane bits, if this fits them into the BG tile slots. '
+                             'The error introduced is shown in the build log')
+    parser.add_argument('--nametable_block_cycles', type=int, default=0,
+                        help='If non-zero, split each compressed nametable into blocks that CrunchyLib_StreamNametableBlock '
+                             'uploads within this many CPU cycles, to stream the nametable one block per NMI with rendering enabled')
+    parser.add_argument('--max_load_frames', type=float, default=0,
+                        help='If non-zero, fail the build if CrunchyLib_LoadPicture is estimated to take more than this many '
+                             'NTSC frames to load a picture. Estimated load times are shown in the build log')
+    parser.add_argument('--verify', action='store_true',
+                        help='After building, render each picture from its output data the way CrunchyLib decodes it, '
+                             'and fail the build if it differs from the input image. Differences are only logged '
+                             'with --merge_tiles_max_error')
+    parser.add_argument('--sequence', action='store_true',
+                        help='Encode the input images as an animation sequence: The first image as a picture, followed by delta frames '
+                             'changing it to each next image and back to the first one')
+    parser.add_argument('--sequence_vblank_cycles', type=int, default=1200,
+                        help='Budget of CPU cycles of vblank time for CrunchyLib_ApplyDeltaChunk to apply each chunk of a delta frame')
+    parser.add_argument('--shared_chr', action='store_true',
+                        help='Share background tiles used by several pictures in a CHR block uploaded once, '
+                             'so switching between the pictures only decompresses their own tiles')
+    parser.add_argument('--packed', action='store_true',
+                        help=f'Pack the data of all images into a single {PACK_FILENAME} file, '
+                             'instead of writing separate data files for each image')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Number of images to convert in parallel worker processes. 0 uses all CPUs')
+    parser.add_argument('--cache_dir', type=str,
+                        default=None,
+                        help='Directory for caching converted images between builds. Caching is disabled if not set')
+    parser.add_argument('--cache_max_mb', type=int,
+                        default=256,
+                        help='Maximum size of build cache in megabytes. Least recently used entries are evicted')
+    parser.add_argument('--profile', action='store_true',
+                        help='Record wall time and peak memory of each conversion stage. '
+                             'Writes profile.json to output directory and prints a summary')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running after the build, and rebuild images whenever the input images or palette file change')
+    parser.add_argument('--watch_interval', type=float, default=0.25,
+                        help='Time in seconds between checks of watched files')
+    parser.add_argument('--watch_debounce', type=float, default=0.5,
+                        help='Time in seconds watched files must stay unchanged before rebuilding')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='Verbose logging')
     args = parser.parse_args()
@@ -372,6 +1257,10 @@ if __name__ == '__main__':
     # Force max_bg_slots to be a multiple of 16
     if args.max_bg_slots % 16 != 0:
         log.error(f'max_bg_slots = {args.max_bg_slots} is not a multiple of 16')
+    # Pictures of a sequence are played from a single CHR bank, without a block of shared tiles
+    if args.sequence and args.shared_chr:
+        log.error('--sequence can not be combined with --shared_chr')
+        sys.exit(1)
     # Call main conversion program
     rc=main(args.input,
               Path(args.output),
@@ -383,5 +1272,23 @@ if __name__ == '__main__':
               bool(args.sprite0),
               args.max_bg_slots,
               args.prgbank,
-              args.prefix_dir)
+              args.prefix_dir,
+              args.jobs if args.jobs > 0 else os.cpu_count(),
+              BuildCache(Path(args.cache_dir), args.cache_max_mb * 1024 * 1024) if args.cache_dir is not None else None,
+              args.nametable_compression,
+              args.profile,
+              args.shared_chr,
+              args.packed,
+              args.watch,
+              args.watch_interval,
+              args.watch_debounce,
+              args.palette_metric,
+              args.chr_split_objective,
+              args.sprite_packing,
+              args.merge_tiles_max_error,
+              args.nametable_block_cycles,
+              args.max_load_frames,
+              args.verify,
+              args.sequence,
+              args.sequence_vblank_cycles)
     sys.exit(rc)
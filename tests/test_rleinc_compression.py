@@ -0,0 +1,236 @@
+"""
+Differential test of the RLEi encoder against the slicing implementation it replaced,
+and round-trip test of compressed nametable blocks
+"""
+import random
+from array import array
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+from RLEiCompression import rleinc_compressed, nametable_decompressed, MAX_RLE_LENGTH, MAX_RLE_LENGTH_SHORT, MAX_COMPRESSED_BLOCK_SIZE
+from ScreenBuilder import ScreenBuilder
+
+from typing import Tuple, List, Sequence
+
+BERNIE_PATH = Path(__file__).resolve().parent.parent / 'testimages' / 'Bernie-converted.png'
+
+
+def slicing_rleinc_compressed(input_data: Sequence[int], rleinc_base: int) -> Tuple[List[int], int]:
+    """
+    Frozen copy of rleinc_compressed before it was made linear-time, slicing the input after every token
+    """
+    # Regular RLE
+    def rle(v) -> int:
+        first_byte = v[0]
+        i = 0
+        while i < len(v) and i < MAX_RLE_LENGTH and v[i] == first_byte:
+            i += 1
+        return i
+    # RLE-inc
+
+    def rleinc(v) -> int:
+        first_byte = v[0]
+        i = 0
+        while i < len(v) and i < MAX_RLE_LENGTH and v[i] == first_byte + i:
+            i += 1
+        return i
+
+    def encode_bytes(e: List[int]) -> List[int]:
+        eb = []
+        hdr_nibbles = []
+        data_bytes = []
+        last_nibble_extends = False
+        while len(e) > 0:
+            hdr, data = e[0]
+            e = e[1:]
+            last_nibble_extends = False
+            if hdr == 0 or hdr == 1:
+                hdr_nibbles.append(hdr)
+                data_bytes.append(data)
+            elif 2 <= hdr <= 8:
+                # rle-inc
+                hdr_nibbles.append(hdr)
+                if hdr == 8:
+                    hdr_nibbles.append(e[0][0])
+                    data_bytes.append([])
+                    e = e[1:]
+                    last_nibble_extends = True
+                data_bytes.append(data)
+            else:
+                # rle
+                hdr_nibbles.append(hdr)
+                if hdr == 15:
+                    hdr_nibbles.append(e[0][0])
+                    data_bytes.append([])
+                    e = e[1:]
+                    last_nibble_extends = True
+                data_bytes.append(data)
+            can_output = len(hdr_nibbles) == 2 or (len(hdr_nibbles) == 3 and (not last_nibble_extends)) or len(hdr_nibbles) == 4
+            if can_output:
+                # Output two nibbles in byte stream
+                eb.append((hdr_nibbles[1] << 4) | hdr_nibbles[0])
+                hdr_nibbles = hdr_nibbles[2:]
+                eb.extend(data_bytes[0])
+                eb.extend(data_bytes[1])
+                data_bytes = data_bytes[2:]
+            elif len(hdr_nibbles) == 5 and last_nibble_extends:
+                # Output two nibbles in byte stream
+                eb.append((hdr_nibbles[1] << 4) | hdr_nibbles[0])
+                hdr_nibbles = hdr_nibbles[2:]
+                eb.extend(data_bytes[0])
+                eb.extend(data_bytes[1])
+                data_bytes = data_bytes[2:]
+        if len(hdr_nibbles) > 1:
+            eb.append((hdr_nibbles[1] << 4) | hdr_nibbles[0])
+            hdr_nibbles = hdr_nibbles[2:]
+            eb.extend(data_bytes[0])
+            eb.extend(data_bytes[1])
+            data_bytes = data_bytes[2:]
+        if len(hdr_nibbles) > 0:
+            eb.append(hdr_nibbles[0])
+            hdr_nibbles = hdr_nibbles[1:]
+            eb.extend(data_bytes[0])
+            data_bytes = data_bytes[1:]
+        assert len(hdr_nibbles) == 0 and len(data_bytes) == 0
+        return eb
+
+    def skip_bytes(d: List[int], rleinc_base: int, num_bytes: int):
+        rleinc_base_new = max(d[0:num_bytes]) + 1
+        return d[num_bytes:], max([rleinc_base_new, rleinc_base])
+    # Encode
+    d = input_data[:]
+    e = []
+    rle_value = 0
+    while len(d) > 0:
+        # Attempt each encoding and find compression ratio
+        rle_len = rle(d)
+        rle_cr = 0.5 / rle_len if d[0] == rle_value else (0.5 + 0.5 + 1) / rle_len
+        rleinc_len = rleinc(d)
+        rleinc_cr = 0.5 / rleinc_len
+        plain_1_cr = (0.5 + 1) / 1
+        if rleinc_cr <= min([plain_1_cr, rle_cr]) and d[0] == rleinc_base and rleinc_len >= 1:
+            # Encode incrementing RLE
+            assert 1 <= rleinc_len <= MAX_RLE_LENGTH, 'Max RLEINC encoding wrong'
+            if rleinc_len > MAX_RLE_LENGTH_SHORT:
+                rleinc_len_first_nibble = MAX_RLE_LENGTH_SHORT + 1
+            else:
+                rleinc_len_first_nibble = rleinc_len
+            e.append((rleinc_len_first_nibble + 1, []))
+            d, rleinc_base = skip_bytes(d, rleinc_base, rleinc_len)
+            if rleinc_len > MAX_RLE_LENGTH_SHORT:
+                e.append((rleinc_len - (MAX_RLE_LENGTH_SHORT + 1), []))
+        elif rle_cr <= min([plain_1_cr]) and (d[0] == rle_value or rle_len >= 2):
+            if d[0] != rle_value:
+                # Switch to new rle_value
+                e.append((1, array('B', d[0:1])))
+                rle_value = d[0]
+            # Encode regular RLE
+            assert 1 <= rle_len <= MAX_RLE_LENGTH, 'Max RLE encoding wrong'
+            if rle_len > MAX_RLE_LENGTH_SHORT:
+                rle_len_first_nibble = MAX_RLE_LENGTH_SHORT + 1
+            else:
+                rle_len_first_nibble = rle_len
+            e.append((9 + rle_len_first_nibble - 1, []))
+            d, rleinc_base = skip_bytes(d, rleinc_base, rle_len)
+            if rle_len > MAX_RLE_LENGTH_SHORT:
+                e.append((rle_len - (MAX_RLE_LENGTH_SHORT + 1), []))
+        else:
+            # Single literal byte
+            e.append((0, d[0:1]))
+            d, rleinc_base = skip_bytes(d, rleinc_base, 1)
+    return encode_bytes(e), rleinc_base
+
+
+def random_buffer(rng: random.Random) -> List[int]:
+    """
+    Random nametable-like data, mixing repeated values, increasing runs and literals
+    """
+    data = []
+    length = rng.randint(1, 300)
+    while len(data) < length:
+        kind = rng.randrange(3)
+        run_length = rng.randint(1, 2 * MAX_RLE_LENGTH)
+        value = rng.randrange(256)
+        if kind == 0:
+            data += [value] * run_length
+        elif kind == 1:
+            data += [(value + i) & 0xFF for i in range(run_length)]
+        else:
+            data += [rng.randrange(256) for i in range(run_length)]
+    return data[:length]
+
+
+def assert_same_encoding(data: Sequence[int], rleinc_base: int):
+    encoded, next_rleinc_base = rleinc_compressed(array('B', data), rleinc_base)
+    expected, expected_rleinc_base = slicing_rleinc_compressed(array('B', data), rleinc_base)
+    assert list(encoded) == list(expected)
+    assert next_rleinc_base == expected_rleinc_base
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_random_buffers(seed: int):
+    rng = random.Random(seed)
+    for i in range(100):
+        assert_same_encoding(random_buffer(rng), rng.choice([0, rng.randrange(256)]))
+
+
+@pytest.mark.parametrize('length', [1, 2, MAX_RLE_LENGTH_SHORT, MAX_RLE_LENGTH_SHORT + 1, MAX_RLE_LENGTH, MAX_RLE_LENGTH + 1])
+def test_run_lengths(length: int):
+    assert_same_encoding([7] * length, 0)
+    assert_same_encoding(list(range(length)), 0)
+    assert_same_encoding(list(range(200, 200 + length)), 200)
+
+
+def test_bernie_nametable_rows():
+    image = Image.open(BERNIE_PATH)
+    image.load()
+    builder = ScreenBuilder(image, True, True, 256)
+    nametable = builder.nametable()
+    width = ScreenBuilder.NAMETABLE_WIDTH
+    num_rows = len(nametable) // width
+    for a in range(num_rows):
+        for b in range(a + 1, min(a + 4, num_rows) + 1):
+            assert_same_encoding(nametable[a * width:b * width], builder.num_common_tile_indices)
+    assert_same_encoding(nametable, builder.num_common_tile_indices)
+
+
+def noisy_nametable(rng: random.Random) -> array:
+    """
+    Nametable of mostly literal bytes with short runs, compressing to blocks of all sizes up to the limit
+    """
+    data = array('B')
+    while len(data) < ScreenBuilder.NAMETABLE_WIDTH * 32:
+        if rng.random() < 0.85:
+            data.append(rng.randrange(256))
+        else:
+            data.extend([rng.randrange(256)] * rng.randint(2, 8))
+    return data[:ScreenBuilder.NAMETABLE_WIDTH * 32]
+
+
+def block_lengths(compressed: Sequence[int]) -> List[int]:
+    """
+    Length byte of each block of a compressed nametable
+    """
+    lengths = []
+    pos = 0
+    while compressed[pos] != 0:
+        lengths.append(compressed[pos])
+        pos += compressed[pos]
+    return lengths
+
+
+def test_nametable_blocks_at_size_limit(monkeypatch):
+    image = Image.new('P', (ScreenBuilder.NAMETABLE_WIDTH * 8, ScreenBuilder.NAMETABLE_HEIGHT * 8), 0)
+    builder = ScreenBuilder(image, True, True, 256)
+    lengths = []
+    for seed in range(40):
+        nametable = noisy_nametable(random.Random(seed))
+        monkeypatch.setattr(builder, 'nametable', lambda: nametable)
+        compressed = builder.nametable_compressed()
+        # A block length wrapping to 0 ends the nametable early
+        assert list(nametable_decompressed(compressed)) == list(nametable)
+        lengths += block_lengths(compressed)
+    # Length byte includes the 2 header bytes
+    assert max(lengths) == MAX_COMPRESSED_BLOCK_SIZE + 2
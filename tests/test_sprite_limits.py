@@ -0,0 +1,50 @@
+"""
+Test of the OAM and sprites-per-scanline limits of the sprite layer
+"""
+import logging
+
+import pytest
+from PIL import Image
+
+from ScreenBuilder import ScreenBuilder, SPRITE_PACKINGS
+
+WIDTH = 256
+HEIGHT = 240
+TILE_SIZE = 8
+# Color 1 of the first sprite palette
+SPRITE_COLOR = 17
+
+
+def sprite_image(cells) -> Image.Image:
+    """
+    Blank background with an 8x8 sprite tile in each of cells, each tile differing from the others
+
+    :param cells: Column and row of each 8x8 sprite tile
+    """
+    image = Image.new('P', (WIDTH, HEIGHT), 0)
+    image.putpalette([0] * 3 * 256)
+    pixels = image.load()
+    for i, (cx, cy) in enumerate(cells):
+        for bit in range(TILE_SIZE):
+            pixels[cx * TILE_SIZE + bit, cy * TILE_SIZE] = SPRITE_COLOR
+            if i >> bit & 1:
+                pixels[cx * TILE_SIZE + bit, cy * TILE_SIZE + 1 + bit % 7] = SPRITE_COLOR
+    return image
+
+
+@pytest.mark.parametrize('sprite_packing', SPRITE_PACKINGS)
+def test_too_many_sprites(sprite_packing: str):
+    # 8 rows of 8 sprites, one more than the OAM entries left by sprite#0
+    image = sprite_image([(2 + 3 * x, 2 + 2 * y) for y in range(8) for x in range(8)])
+    with pytest.raises(ValueError, match='Could not fit sprites in OAM'):
+        ScreenBuilder(image, False, True, 256, sprite_packing=sprite_packing)
+
+
+@pytest.mark.parametrize('sprite_packing', SPRITE_PACKINGS)
+def test_scanline_overflow_is_logged(sprite_packing: str, caplog):
+    # 10 sprites on the same scanlines
+    image = sprite_image([(2 + 3 * x, 4) for x in range(10)])
+    with caplog.at_level(logging.ERROR):
+        builder = ScreenBuilder(image, False, True, 256, sprite_packing=sprite_packing)
+    assert len(builder.sprites) == 10
+    assert any('Sprites-per-scanline overflow' in record.getMessage() for record in caplog.records)
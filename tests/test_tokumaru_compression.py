@@ -0,0 +1,61 @@
+"""
+Round-trip test of the Tokumaru CHR compressor and decompressor
+"""
+import random
+
+import pytest
+
+from TokumaruCompression import tokumaru_compressed, tokumaru_decompressed, MAX_TILES
+
+TILE_SIZE = 16
+
+
+def random_tiles(rng: random.Random, num_tiles: int) -> bytes:
+    """
+    Random tiles, mixing noise with tiles of few colors and repeated rows
+    """
+    chr_data = bytearray()
+    for i in range(num_tiles):
+        kind = rng.randrange(3)
+        if kind == 0:
+            chr_data += bytes(rng.randrange(256) for j in range(TILE_SIZE))
+        elif kind == 1:
+            # Two colors, so each plane is all zeros or all ones
+            chr_data += bytes([rng.choice([0x00, 0xFF]) if j % 8 == 0 else 0 for j in range(TILE_SIZE)])
+        else:
+            rows = [rng.randrange(256) for j in range(2)]
+            chr_data += bytes([rows[0]] * 8 + [rows[1]] * 8)
+    return bytes(chr_data)
+
+
+def assert_round_trip(chr_data: bytes):
+    assert tokumaru_decompressed(tokumaru_compressed(chr_data)) == chr_data
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_random_tiles(seed: int):
+    rng = random.Random(seed)
+    assert_round_trip(random_tiles(rng, rng.randint(1, MAX_TILES)))
+
+
+@pytest.mark.parametrize('num_tiles', [1, 2])
+def test_few_tiles(num_tiles: int):
+    # Previously padded to 3 tiles for the external compressor
+    assert_round_trip(random_tiles(random.Random(num_tiles), num_tiles))
+
+
+def test_max_tiles():
+    chr_data = random_tiles(random.Random(256), MAX_TILES)
+    # Tile count of 256 is stored as 0
+    assert tokumaru_compressed(chr_data)[0] == 0
+    assert_round_trip(chr_data)
+
+
+@pytest.mark.parametrize('tile', [bytes(TILE_SIZE), bytes([0xFF] * TILE_SIZE), bytes(range(TILE_SIZE))])
+def test_identical_tiles(tile: bytes):
+    for num_tiles in [1, 2, 3, 64, MAX_TILES]:
+        assert_round_trip(tile * num_tiles)
+
+
+def test_empty():
+    assert tokumaru_compressed(b'') == b''